@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other by flat names from their own directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "traffic_light_dector"))
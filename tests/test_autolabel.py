@@ -0,0 +1,146 @@
+import csv
+import glob
+import os
+
+import cv2
+import numpy as np
+
+from autolabel import AutoLabeler
+from fake_carla import FakeWorld, SyntheticSource, Transform
+from light_classifier import GREEN, RED
+
+
+class StubProjector(object):
+    """
+    Matches the i-th detection to light matches[i] and reads light states
+    from a dict instead of projecting.
+    """
+
+    def __init__(self, matches, states):
+        self.matches = matches
+        self.light_states = states
+        self.poses = []
+
+    def associate(self, camera_transform, detections):
+        self.poses.append(camera_transform)
+        return np.array(self.matches[:len(detections)], dtype=np.int64), None
+
+    def states(self, indices, captured=None):
+        states = captured if captured is not None else self.light_states
+        return [states.get(int(i)) for i in indices]
+
+
+def camera_frames(count):
+    """
+    Frames and poses as a camera on a fake world delivers them.
+    """
+    world = FakeWorld(SyntheticSource(320, 240, lights=2, variants=1))
+    camera = world.spawn_actor(world.get_blueprint_library().find("sensor.camera.rgb"))
+    images = []
+    camera.listen(images.append)
+    for _ in range(count):
+        world.tick()
+    return [(np.frombuffer(image.raw_data, np.uint8).reshape(image.height, image.width, 4)[..., :3].copy(),
+             image.frame, image.transform) for image in images]
+
+
+BOXES = [[40.0, 20.0, 52.0, 50.0, 0.9, 9.0], [100.0, 30.0, 112.0, 60.0, 0.8, 9.0]]
+
+
+def labeler(tmp_path, matches=(0, 1), states=None, **options):
+    states = states if states is not None else {0: GREEN, 1: RED}
+    options.setdefault("refine", False)
+    return AutoLabeler(StubProjector(list(matches), states), "Town01", str(tmp_path) + os.sep, **options)
+
+
+def read_csv(tmp_path):
+    paths = glob.glob(os.path.join(str(tmp_path), "*carla_autolabel_Town01.csv"))
+    assert len(paths) == 1
+    with open(paths[0], newline="") as f:
+        return list(csv.reader(f, delimiter=";"))
+
+
+def test_writes_rows_frame_and_crops(tmp_path):
+    frame, frame_id, pose = camera_frames(1)[0]
+    auto = labeler(tmp_path)
+    assert auto(frame, frame_id, BOXES, pose) == 2
+    auto.close()
+    assert auto.projector.poses == [pose]
+
+    rows = read_csv(tmp_path)
+    name = "Town01_{}".format(frame_id)
+    assert rows[1:] == [[name, GREEN, "40", "20", "52", "50", "None", str(frame_id), "None", str(frame_id)],
+                        [name, RED, "100", "30", "112", "60", "None", str(frame_id), "None", str(frame_id)]]
+    saved = cv2.imread(os.path.join(str(tmp_path), "Img", name + ".png"))
+    assert np.array_equal(saved, frame)
+    crop = cv2.imread(os.path.join(str(tmp_path), "Crops", RED, "{}_1.png".format(name)))
+    assert np.array_equal(crop, frame[30:60, 100:112])
+    assert os.path.exists(os.path.join(str(tmp_path), "Crops", GREEN, "{}_0.png".format(name)))
+    assert auto.stats() == {"frames": 1, "detections": 2, "unmatched": 0, "duplicates": 0, "saved": 2,
+                            "dropped": 0}
+
+
+def test_skips_unchanged_lights_until_their_state_changes(tmp_path):
+    frames = camera_frames(3)
+    auto = labeler(tmp_path)
+    counts = [auto(frame, frame_id, BOXES, pose) for frame, frame_id, pose in frames[:2]]
+    auto.projector.light_states[1] = GREEN
+    frame, frame_id, pose = frames[2]
+    counts.append(auto(frame, frame_id, BOXES, pose))
+    auto.close()
+    assert counts == [2, 0, 1]
+    assert auto.duplicates == 3
+    assert [row[1] for row in read_csv(tmp_path)[1:]] == [GREEN, RED, GREEN]
+    assert len(os.listdir(os.path.join(str(tmp_path), "Img"))) == 2
+
+
+def test_dedup_threshold_zero_and_min_gap(tmp_path):
+    frames = camera_frames(4)
+    auto = labeler(tmp_path, dedup_threshold=0, min_gap=2)
+    counts = [auto(frame, frame_id, BOXES, pose) for frame, frame_id, pose in frames]
+    auto.close()
+    # Identical crops are kept without dedup, but at most every second frame.
+    assert counts == [2, 0, 2, 0]
+
+
+def test_samples_every_nth_frame(tmp_path):
+    frames = camera_frames(5)
+    auto = labeler(tmp_path, sample_every=2, dedup_threshold=0)
+    counts = [auto(frame, frame_id, BOXES, pose) for frame, frame_id, pose in frames]
+    auto.close()
+    assert counts == [2, 0, 2, 0, 2]
+    assert len(auto.projector.poses) == 3
+    assert auto.frames == 5
+
+
+def test_filters_classes_scores_unmatched_and_unknown_states(tmp_path):
+    frame, frame_id, pose = camera_frames(1)[0]
+    boxes = BOXES + [[10.0, 10.0, 20.0, 40.0, 0.9, 2.0],     # a car
+                     [10.0, 10.0, 20.0, 40.0, 0.3, 9.0],     # below the score threshold
+                     [150.0, 10.0, 160.0, 40.0, 0.9, 9.0],   # no map light
+                     [200.0, 10.0, 210.0, 40.0, 0.9, 9.0]]   # light off
+    auto = labeler(tmp_path, matches=(0, 1, -1, 2), states={0: GREEN, 1: RED, 2: None})
+    labelled = auto.label(frame, boxes, pose)
+    assert labelled == [(0, GREEN, [20, 50, 40, 52]), (1, RED, [30, 60, 100, 112])]
+    assert (auto.detections, auto.unmatched) == (4, 1)
+    # States captured at the frame's tick win over the current ones.
+    assert [state for _, state, _ in auto.label(frame, boxes, pose, {0: RED, 1: RED})] == [RED, RED]
+    auto.close()
+    assert not glob.glob(os.path.join(str(tmp_path), "*.csv"))
+
+
+def test_frame_is_dropped_while_the_writer_is_busy(tmp_path):
+    frame, frame_id, pose = camera_frames(1)[0]
+    auto = labeler(tmp_path)
+    writer = auto.log.getWriter()
+    taken = 0
+    while writer._slots.acquire(blocking=False):
+        taken += 1
+    try:
+        assert auto(frame, frame_id, BOXES, pose) == 0
+    finally:
+        for _ in range(taken):
+            writer._slots.release()
+    auto.close()
+    assert (auto.dropped, auto.saved) == (2, 0)
+    assert read_csv(tmp_path)[1:] == []
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from backends import BACKENDS, DEFAULT_PB, OpenCVDnnBackend, StandInBackend, compare, load_inputs, make_backend
+
+
+class RacyNet(object):
+    """
+    cv2.dnn.Net stand-in that, like the real one, keeps the last input and
+    answers forward() from it.
+    """
+
+    def __init__(self):
+        self.blob = None
+
+    def setPreferableBackend(self, backend):
+        pass
+
+    def setPreferableTarget(self, target):
+        pass
+
+    def setInput(self, blob):
+        self.blob = blob
+
+    def forward(self, names):
+        time.sleep(0.002)
+        return [self.blob[:, :1, 0, 0].copy() for _ in names]
+
+
+def test_opencv_backend_keeps_concurrent_calls_apart(monkeypatch):
+    monkeypatch.setattr(cv2.dnn, "readNet", lambda model_file: RacyNet())
+    backend = OpenCVDnnBackend("model.onnx")
+    errors = []
+
+    def run(value):
+        image = np.full((1, 8, 8, 3), value, dtype=np.float32)
+        for _ in range(20):
+            if backend.predict_scales(image)[0][0, 0] != value:
+                errors.append(value)
+
+    threads = [threading.Thread(target=run, args=(float(i),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_every_backend_is_registered():
+    assert sorted(BACKENDS) == ["onnxruntime", "opencv", "standin", "tf", "tflite"]
+    with pytest.raises(ValueError):
+        make_backend("coreml")
+
+
+def test_standin_outputs_have_the_yolov3_layout():
+    backend = make_backend("standin", num_classes=80)
+    image = np.random.RandomState(0).rand(2, 96, 96, 3).astype(np.float32)
+    outputs = backend.predict_scales(image)
+    assert [output.shape for output in outputs] == [(2, 12, 12, 3, 85), (2, 6, 6, 3, 85), (2, 3, 3, 3, 85)]
+    pred_bbox = backend.predict(image[:1])
+    assert pred_bbox.shape == (3 * (144 + 36 + 9), 85)
+    assert ((pred_bbox[:, 4:] >= 0) & (pred_bbox[:, 4:] <= 1)).all()
+
+
+def test_batched_and_single_calls_agree():
+    backend = StandInBackend()
+    images = np.random.RandomState(1).rand(3, 64, 64, 3).astype(np.float32)
+    batched = backend.predict_scales(images)
+    for i in range(3):
+        for whole, single in zip(batched, backend.predict_scales(images[i:i + 1])):
+            np.testing.assert_allclose(whole[i], single[0], rtol=1e-5, atol=1e-6)
+
+
+def test_frame_dict_call_fills_pred_bbox():
+    backend = make_backend("standin")
+    data = backend({"image_data": np.full((1, 64, 64, 3), 0.5, dtype=np.float32)})
+    np.testing.assert_array_equal(data["pred_bbox"], backend.predict(data["image_data"]))
+    assert backend.warmup(64, batch_sizes=(1, 2)) >= 0
+
+
+class StandInNet(RacyNet):
+    """
+    cv2.dnn.Net stand-in answering with the stand-in model's outputs, so an
+    OpenCVDnnBackend must reproduce StandInBackend exactly.
+    """
+
+    def __init__(self):
+        RacyNet.__init__(self)
+        self.model = StandInBackend()
+        self.names = None
+
+    def forward(self, names):
+        self.names = names
+        return self.model.predict_scales(self.blob.transpose(0, 2, 3, 1))
+
+
+def test_opencv_backend_matches_the_model_it_runs(monkeypatch):
+    net = StandInNet()
+    monkeypatch.setattr(cv2.dnn, "readNet", lambda model_file: net)
+    backend = OpenCVDnnBackend("model.onnx")
+    image = np.random.RandomState(2).rand(1, 64, 64, 3).astype(np.float32)
+    np.testing.assert_array_equal(backend.predict(image), net.model.predict(image))
+    assert net.names == ["pred_sbbox/concat_2", "pred_mbbox/concat_2", "pred_lbbox/concat_2"]
+
+
+def test_compare_reports_differences_to_the_first_backend(tmp_path):
+    frames = np.random.RandomState(3).randint(0, 256, (4, 48, 64, 3)).astype(np.uint8)
+    np.savez(str(tmp_path / "frames.npz"), frames=frames)
+    inputs = load_inputs(str(tmp_path / "frames.npz"), 3, 64)
+    assert [image.shape for image in inputs] == [(1, 64, 64, 3)] * 3
+
+    same, other = StandInBackend(), StandInBackend(seed=1)
+    other.name = "standin-1"
+    results = compare([StandInBackend(), same], inputs, warmup=1)
+    assert list(results) == ["standin"] and results["standin"]["max_abs_diff"] == 0.0
+    results = compare([same, other], inputs, warmup=1)
+    assert "max_abs_diff" not in results["standin"] and results["standin-1"]["max_abs_diff"] > 0
+    assert results["standin"]["fps"] > 0
+
+
+def test_real_backends_agree_with_tf():
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("tensorflow_yolov3.carla.utils")
+    if not os.path.exists(DEFAULT_PB):
+        pytest.skip("needs the frozen YOLOv3 graph")
+    inputs = load_inputs(None, 2, 416)
+    results = compare([make_backend("tf"), make_backend("opencv")], inputs, warmup=0)
+    assert results["opencv"]["max_abs_diff"] < 1e-2
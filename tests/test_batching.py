@@ -0,0 +1,81 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from backends import make_backend
+from batching import BatchInferenceEngine
+
+SIZE = 64
+
+
+class CountingBackend(object):
+    """
+    Records the batch size of every call to a stand-in backend.
+    """
+
+    def __init__(self, delay=0.0):
+        self.backend = make_backend("standin", num_classes=80)
+        self.num_classes = self.backend.num_classes
+        self.delay = delay
+        self.calls = []
+
+    def predict_scales(self, image_data):
+        self.calls.append(image_data.shape[0])
+        time.sleep(self.delay)
+        return self.backend.predict_scales(image_data)
+
+
+def inputs(n, seed=0):
+    return [np.random.RandomState(seed + i).rand(SIZE, SIZE, 3).astype(np.float32) for i in range(n)]
+
+
+def test_batched_predictions_match_single_runs():
+    backend = CountingBackend()
+    engine = BatchInferenceEngine(backend, max_batch_size=4)
+    images = inputs(3)
+    batched = engine.run_batch(images)
+    for image, pred_bbox in zip(images, batched):
+        np.testing.assert_allclose(pred_bbox, engine.run_batch([image[None]])[0], rtol=1e-5, atol=1e-5)
+    assert backend.calls == [3, 1, 1, 1]
+    assert batched[0].shape == (3 * ((SIZE // 8) ** 2 + (SIZE // 16) ** 2 + (SIZE // 32) ** 2), 85)
+
+
+def test_concurrent_requests_are_grouped():
+    backend = CountingBackend(delay=0.02)
+    images = inputs(8)
+    results = [None] * len(images)
+    with BatchInferenceEngine(backend, max_batch_size=4, max_wait=0.2) as engine:
+        def request(i):
+            results[i] = engine.infer(images[i])
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(images))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5.0)
+    assert max(backend.calls) == 4
+    assert sum(backend.calls) == 8 and len(backend.calls) <= 3
+    assert engine.mean_batch_size() == 8.0 / len(backend.calls)
+    single = BatchInferenceEngine(CountingBackend())
+    for image, pred_bbox in zip(images, results):
+        np.testing.assert_allclose(pred_bbox, single.run_batch([image])[0], rtol=1e-5, atol=1e-5)
+
+
+def test_lone_request_waits_at_most_max_wait():
+    backend = CountingBackend()
+    with BatchInferenceEngine(backend, max_batch_size=4, max_wait=0.05) as engine:
+        engine.infer(inputs(1)[0])  # warm up
+        start = time.time()
+        engine.infer(inputs(1)[0])
+        elapsed = time.time() - start
+    assert backend.calls == [1, 1]
+    assert 0.04 <= elapsed < 0.5
+
+
+def test_submit_needs_a_started_engine():
+    engine = BatchInferenceEngine(CountingBackend())
+    with pytest.raises(RuntimeError):
+        engine.submit(inputs(1)[0])
+    with pytest.raises(ValueError):
+        BatchInferenceEngine(CountingBackend(), max_batch_size=0)
@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import benchmarks
+from benchmarks import STEPS, LogStep, recorded_frames, regressions, run_suite, synthetic_frames, time_step
+
+SIZE = (320, 240)
+
+
+def test_every_step_runs_or_is_skipped_for_missing_imports():
+    report = run_suite(sizes=[SIZE], count=2, iterations=2)
+    assert set(report["results"]) | set(report["skipped"]) == set("{}@320x240".format(name) for name in STEPS)
+    # Only the steps through tensorflow_yolov3 may be missing.
+    assert set(report["skipped"]) <= {"image_preporcess@320x240", "postprocess_nms@320x240"}
+    for result in report["results"].values():
+        assert result["iterations"] == 2 and result["fps"] > 0
+        assert result["p50_ms"] <= result["p99_ms"]
+    assert report["frames"] == "synthetic"
+    json.dumps(report)
+
+
+def test_frame_sets_carry_candidates():
+    frames = synthetic_frames(*SIZE, count=2)
+    assert len(frames) == 2 and (frames.height, frames.width) == (240, 320)
+    assert [len(boxes) for boxes in frames.boxes] == [benchmarks.N_LIGHTS] * 2
+    assert frames.candidates[0].shape == (benchmarks.N_LIGHTS, 6)
+    assert frames.inputs[0].shape == (1, benchmarks.INPUT_SIZE, benchmarks.INPUT_SIZE, 3)
+
+
+def test_recorded_frames_are_resized_and_use_model_detections(tmp_path):
+    source = np.random.RandomState(0).randint(0, 120, (3, 120, 160, 3)).astype(np.uint8)
+    np.savez(str(tmp_path / "frames.npz"), frames=source)
+    frames = recorded_frames(str(tmp_path / "frames.npz"), 320, 240, 2)
+    assert len(frames) == 2 and frames.frames[0].shape == (240, 320, 3)
+    assert len(frames.boxes) == 2
+    np.savez(str(tmp_path / "empty.npz"), frames=source[:0])
+    with pytest.raises(ValueError):
+        recorded_frames(str(tmp_path / "empty.npz"), 320, 240, 2)
+
+
+def test_log_step_cleans_up():
+    step = LogStep(synthetic_frames(*SIZE, count=2))
+    directory = step.directory
+    result = time_step(step, 2, benchmarks.LOG_FLUSH_EVERY + 1, warmup=0)
+    assert result["iterations"] == benchmarks.LOG_FLUSH_EVERY + 1
+    assert not os.path.exists(directory)
+
+
+def test_regressions_use_the_tolerance():
+    baseline = {"results": {"a@1x1": {"fps": 100.0}, "b@1x1": {"fps": 100.0}}}
+    report = {"results": {"a@1x1": {"fps": 80.0}, "b@1x1": {"fps": 90.0}, "c@1x1": {"fps": 1.0}}}
+    assert regressions(report, baseline, 0.15) == [("a@1x1", 100.0, 80.0)]
+    assert regressions(report, baseline, 0.25) == []
+
+
+def test_main_fails_on_a_regression(tmp_path, monkeypatch, capsys):
+    output = str(tmp_path / "now.json")
+    baseline = str(tmp_path / "before.json")
+    with open(baseline, "w") as f:
+        json.dump({"commit": "abc", "results": {"inference@320x240": {"fps": 1e9}}}, f)
+    monkeypatch.setattr(sys, "argv", ["benchmarks.py", "--steps", "inference", "--sizes", "320x240", "--count", "1",
+                                      "-n", "2", "-o", output, "--baseline", baseline])
+    with pytest.raises(SystemExit) as exit_info:
+        benchmarks.main()
+    assert exit_info.value.code == 1
+    assert "REGRESSION inference@320x240" in capsys.readouterr().out
+    with open(output) as f:
+        assert list(json.load(f)["results"]) == ["inference@320x240"]
+
+    monkeypatch.setattr(sys, "argv", ["benchmarks.py", "--steps", "inference,warp"])
+    with pytest.raises(SystemExit) as exit_info:
+        benchmarks.main()
+    assert exit_info.value.code == 2
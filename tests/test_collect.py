@@ -0,0 +1,134 @@
+import csv
+import os
+
+import pytest
+
+from collect import DONE, FAILED, Collector, JobState, make_jobs, orchestrate, summarize, town_name
+
+
+def options(out, **overrides):
+    values = {"out": str(out) + os.sep, "every": 1, "frames_only": True, "archive": False,
+              "archive_compression": None, "width": 160, "height": 120, "input_size": 96,
+              "backend": "standin", "model": None, "intra_op_threads": 1, "inter_op_threads": 1}
+    values.update(overrides)
+    return values
+
+
+def test_jobs_cover_every_combination():
+    jobs = make_jobs(["Town01", "Town02"], ["ClearNoon", "WetNoon"], [0, 3], 10)
+    assert len(jobs) == 8 and len(set(job.job_id for job in jobs)) == 8
+    assert jobs[0].job_id == "Town01_ClearNoon_0"
+    assert [town_name(v) for v in ("2", "9", "Town05")] == ["Town02", "Town01", "Town05"]
+
+
+def test_frames_only_job_writes_frames_and_index(tmp_path):
+    job = make_jobs(["Town01"], ["WetNoon"], [1], 6)[0]
+    collector = Collector("fake", options(tmp_path, every=2))
+    result = collector.run(job)
+    assert (result["frames"], result["recorded"]) == (6, 3)
+    with open(os.path.join(str(tmp_path), job.job_id, "frames.csv")) as f:
+        rows = list(csv.reader(f, delimiter=";"))
+    assert rows[0] == ["Filename", "Town", "Weather", "Frame"]
+    assert len(rows) == 4 and all(row[1:3] == ["Town01", "WetNoon"] for row in rows[1:])
+    for row in rows[1:]:
+        assert os.path.exists(os.path.join(str(tmp_path), job.job_id, row[0]))
+
+
+def test_archived_job_can_be_read_back(tmp_path):
+    from frame_archive import FrameArchive
+
+    job = make_jobs(["Town02"], ["ClearNoon"], [0], 4)[0]
+    result = Collector("fake", options(tmp_path, archive=True)).run(job)
+    assert result["recorded"] == 4
+    archive = FrameArchive(os.path.join(str(tmp_path), job.job_id, "frames.tlarchive"))
+    assert len(archive) == 4
+    assert archive[0].shape == (120, 160, 3)
+    assert [record["town"] for record in archive.records] == ["Town02"] * 4
+
+
+def test_annotated_job_runs_detection(tmp_path):
+    pytest.importorskip("tensorflow_yolov3.carla.config")
+    job = make_jobs(["Town01"], ["ClearNoon"], [0], 3)[0]
+    collector = Collector("fake", options(tmp_path, frames_only=False, width=640, height=480, input_size=416))
+    try:
+        result = collector.run(job)
+        backend = collector.backend
+        assert collector.run(job)["frames"] == 3
+        assert collector.backend is backend
+    finally:
+        collector.close()
+    assert result["frames"] == 3
+
+
+def test_state_resumes_and_retries(tmp_path):
+    path = str(tmp_path / "state.json")
+    jobs = make_jobs(["Town01"], ["ClearNoon"], [0, 1], 2)
+    state = JobState(path)
+    state.finish(jobs[0], {"frames": 2})
+    state.fail(jobs[1], "boom")
+    resumed = JobState(path)
+    assert resumed.entry(jobs[0])["status"] == DONE
+    assert resumed.entry(jobs[1])["status"] == FAILED
+    assert resumed.pending(jobs, max_attempts=2) == [jobs[1]]
+    assert resumed.pending(jobs, max_attempts=1) == []
+
+
+def test_orchestrate_runs_jobs_on_fake_endpoints(tmp_path):
+    jobs = make_jobs(["Town01", "Town02"], ["ClearNoon"], [0], 3)
+    limits = {"memory_mb": None, "cpu_seconds": None, "niceness": 0, "cpus_per_worker": 0}
+    state = JobState(str(tmp_path / "state.json"))
+    results, wall_seconds = orchestrate(jobs, ["fake", "fake"], options(tmp_path), limits, state)
+    assert sorted(result["job_id"] for result in results) == sorted(job.job_id for job in jobs)
+    assert all(state.entry(job)["status"] == DONE for job in jobs)
+    summary = summarize(results, wall_seconds)
+    assert summary["frames"] == 6 and sorted(summary["per_town"]) == ["Town01", "Town02"]
+    # Finished jobs are skipped on the next run.
+    assert orchestrate(jobs, ["fake"], options(tmp_path), limits, state)[0] == []
+
+
+def crash_on_spawn_point_9(run):
+    def crashing_run(self, job):
+        if job.spawn_point == 9:
+            os._exit(3)
+        return run(self, job)
+    return crashing_run
+
+
+def test_crashing_job_does_not_charge_jobs_that_never_started(tmp_path, monkeypatch):
+    import multiprocessing
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the crashing job is patched into forked workers")
+    monkeypatch.setattr(Collector, "run", crash_on_spawn_point_9(Collector.run))
+    jobs = make_jobs(["Town01"], ["ClearNoon"], [0, 9, 1, 2], 2)
+    limits = {"memory_mb": None, "cpu_seconds": None, "niceness": 0, "cpus_per_worker": 0}
+    state = JobState(str(tmp_path / "state.json"))
+    results, _ = orchestrate(jobs, ["fake"], options(tmp_path), limits, state, max_attempts=2)
+
+    crashing = state.entry(jobs[1])
+    assert (crashing["status"], crashing["attempts"]) == (FAILED, 2)
+    assert "crashed" in crashing["error"]
+    for job in jobs[:1] + jobs[2:]:
+        entry = state.entry(job)
+        assert (entry["status"], entry["attempts"]) == (DONE, 1)
+    assert len(results) == 3
+
+
+def test_actors_are_destroyed_when_setup_fails(tmp_path, monkeypatch):
+    import collect
+    import fake_carla
+
+    clients = []
+
+    def connect(endpoint, width, height, timeout=10.0):
+        client = fake_carla.Client()
+        clients.append(client)
+        return client, fake_carla
+
+    monkeypatch.setattr(collect, "connect", connect)
+    # The car spawns, the camera blueprint is missing.
+    monkeypatch.setattr(fake_carla.FakeBlueprintLibrary, "blueprint_ids", ["vehicle.audi.a2"])
+    job = make_jobs(["Town01"], ["ClearNoon"], [0], 2)[0]
+    with pytest.raises(IndexError):
+        Collector("fake", options(tmp_path)).run(job)
+    assert clients[0].get_world().get_actors() == []
@@ -0,0 +1,104 @@
+import csv
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from dataset_writer import StreamingDatasetWriter
+
+MODULES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "traffic_light_dector")
+
+# Writes a row and a 480x640 image per step until it is stopped.
+WRITER = textwrap.dedent("""
+    import sys
+    import numpy as np
+    sys.path.insert(0, sys.argv[1])
+    from dataset_writer import StreamingDatasetWriter
+
+    out = sys.argv[2]
+    rng = np.random.RandomState(0)
+    with StreamingDatasetWriter(out + "/index.csv", ["Filename", "Town", "Frame"], batch_size=4,
+                                flush_interval=0.05, workers=2, max_pending_images=4) as writer:
+        frame = 0
+        while True:
+            name = "{}.png".format(frame)
+            writer.write_image(out + "/" + name, rng.randint(0, 256, (480, 640, 3)).astype(np.uint8))
+            writer.write_row([name, "Town01", frame])
+            frame += 1
+""")
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f, delimiter=";"))
+
+
+def run_until_rows(out, rows=12, timeout=30.0):
+    process = subprocess.Popen([sys.executable, "-c", WRITER, MODULES, str(out)])
+    deadline = time.time() + timeout
+    path = os.path.join(str(out), "index.csv")
+    while time.time() < deadline:
+        if os.path.exists(path) and len(read_rows(path)) > rows:
+            return process
+        time.sleep(0.05)
+    process.kill()
+    pytest.fail("the writer did not flush {} rows in {} s".format(rows, timeout))
+
+
+def check_dataset(out):
+    rows = read_rows(os.path.join(str(out), "index.csv"))
+    assert rows[0] == ["Filename", "Town", "Frame"]
+    assert all(len(row) == 3 and row[1] == "Town01" for row in rows[1:])
+    assert [int(row[2]) for row in rows[1:]] == list(range(len(rows) - 1))
+    images = [name for name in os.listdir(str(out)) if name.endswith(".png") and ".partial" not in name]
+    assert images
+    for name in images:
+        image = cv2.imread(os.path.join(str(out), name))
+        assert image is not None and image.shape == (480, 640, 3), name
+    return rows, images
+
+
+def test_interrupted_writer_finishes_rows_and_images(tmp_path):
+    process = run_until_rows(tmp_path)
+    process.send_signal(signal.SIGINT)
+    assert process.wait(timeout=30) != 0
+    rows, images = check_dataset(tmp_path)
+    assert not [name for name in os.listdir(str(tmp_path)) if ".partial" in name]
+    # Closing on the way out saved every image queued before the interrupt.
+    assert set(row[0] for row in rows[1:]) <= set(images)
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="needs SIGKILL")
+def test_killed_writer_leaves_whole_rows_and_images(tmp_path):
+    process = run_until_rows(tmp_path)
+    process.kill()
+    process.wait(timeout=30)
+    # Images at their final names are complete, unfinished ones only ever
+    # exist under their .partial name.
+    check_dataset(tmp_path)
+
+
+def test_appends_without_second_header(tmp_path):
+    path = os.path.join(str(tmp_path), "data", "index.csv")
+    with StreamingDatasetWriter(path, ["Filename", "Frame"], batch_size=2) as writer:
+        writer.write_row(["a.png", 1])
+        writer.write_row({"Frame": 2, "Filename": "b.png"})
+    with StreamingDatasetWriter(path, ["Filename", "Frame"]) as writer:
+        writer.write_row(["c.png", 3])
+    assert read_rows(path) == [["Filename", "Frame"], ["a.png", "1"], ["b.png", "2"], ["c.png", "3"]]
+    assert writer.rows_written == 1
+
+
+def test_failed_image_leaves_no_file(tmp_path):
+    path = os.path.join(str(tmp_path), "index.csv")
+    with StreamingDatasetWriter(path, ["Filename"]) as writer:
+        writer.write_image(os.path.join(str(tmp_path), "ok.png"), np.zeros((8, 8, 3), np.uint8))
+        writer.write_image(os.path.join(str(tmp_path), "bad.png"), np.zeros((0, 0, 3), np.uint8))
+    assert (writer.images_written, writer.image_errors) == (1, 1)
+    assert sorted(os.listdir(str(tmp_path))) == ["index.csv", "ok.png"]
@@ -0,0 +1,109 @@
+import cv2
+import numpy as np
+import pytest
+
+from display import DISPLAY_KINDS, Cv2Sink, EveryNthSink, MultiSink, NullSink, make_sink
+from light_classifier import synthetic_frame
+from traffic_light import Light
+
+
+class RecordingSink(NullSink):
+    name = "recording"
+
+    def __init__(self, quit_on=None, key=None):
+        NullSink.__init__(self)
+        self.shown = []
+        self.shown_crops = 0
+        self.quit_on = quit_on
+        self.key = key
+        self.closed = False
+
+    def _show(self, data):
+        self.shown.append(data["frame_id"])
+        return data["frame_id"] == self.quit_on
+
+    def _show_crop(self, crop):
+        self.shown_crops += 1
+        return self.key
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def no_highgui(monkeypatch):
+    calls = []
+    keys = iter([-1, ord("r"), ord("q")])
+    monkeypatch.setattr(cv2, "imshow", lambda window, image: calls.append((window, image.shape)))
+    monkeypatch.setattr(cv2, "waitKey", lambda delay: next(keys, -1))
+    monkeypatch.setattr(cv2, "destroyAllWindows", lambda: calls.append(("destroy", None)))
+    return calls
+
+
+def test_null_sink_shows_nothing(no_highgui):
+    sink = make_sink("none")
+    assert isinstance(sink, NullSink)
+    assert sink.show({"frame": np.zeros((4, 4, 3), np.uint8)}) is False
+    assert sink.show_crop(np.zeros((4, 4, 3), np.uint8)) is None
+    assert no_highgui == []
+    assert (sink.frames, sink.crops) == (1, 1) and sink.cost_ms() >= 0.0
+
+
+def test_every_nth_sink_forwards_frames_and_their_crops():
+    inner = RecordingSink(key=ord("r"))
+    sink = EveryNthSink(inner, 3)
+    assert sink.name == "recording/3"
+    keys = []
+    for frame_id in range(7):
+        keys.append(sink.show_crop(None))
+        sink.show({"frame_id": frame_id})
+    assert inner.shown == [0, 3, 6]
+    assert keys == [ord("r"), None, None, ord("r"), None, None, ord("r")]
+    sink.set_every(1)
+    sink.show_crop(None)
+    sink.show({"frame_id": 7})
+    sink.show({"frame_id": 8})
+    assert inner.shown == [0, 3, 6, 8]
+    sink.close()
+    assert inner.closed
+
+
+def test_multi_sink_quits_if_any_sink_quits():
+    first, second = RecordingSink(key=None), RecordingSink(quit_on=1, key=ord("x"))
+    sink = MultiSink([first, second])
+    assert sink.name == "recording+recording"
+    assert [sink.show({"frame_id": i}) for i in range(2)] == [False, True]
+    assert first.shown == second.shown == [0, 1]
+    assert sink.show_crop(None) == ord("x")
+
+
+def test_cv2_sink_resizes_and_reports_the_quit_key(no_highgui):
+    sink = make_sink("cv2", every=2)
+    assert isinstance(sink, EveryNthSink) and isinstance(sink.sink, Cv2Sink)
+    frame = np.zeros((120, 160, 3), np.uint8)
+    assert sink.show({"frame": frame}) is False
+    assert no_highgui == [("Pygame", (600, 800, 3))]
+    assert sink.sink.show_crop(frame[:30, :12]) == ord("r")
+    assert [window for window, _ in no_highgui[1:]] == ["Traffic Light", "Traffic Light COLOR"]
+    assert sink.sink.show({"frame": frame}) is True
+    sink.close()
+    assert no_highgui[-1] == ("destroy", None)
+
+
+def test_pygame_kinds_need_pygame():
+    assert DISPLAY_KINDS == ("both", "pygame", "cv2", "none")
+    pygame = pytest.importorskip("pygame")
+    surface = pygame.Surface((4, 4))
+    sink = make_sink("both", surface)
+    assert isinstance(sink, MultiSink) and sink.name == "pygame+cv2"
+
+
+def test_headless_light_classifies_without_highgui(no_highgui):
+    frame, boxes = synthetic_frame(320, 240, 3, seed=2)
+    # Detections are (x0, y0, x1, y1, score, class).
+    bboxes = [[x0, y0, x1, y1, 0.9, 9] for y0, y1, x0, x1 in boxes]
+    light = Light(show=False, classes={9: "traffic light"})
+    assert light.process_traffic_light(frame, bboxes) is not None
+    assert len(light.lights) == 3 and light.state is not None
+    assert light.sink.crops >= 1
+    assert no_highgui == []
@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+
+from frame_archive import FrameArchive, FrameArchiveWriter, chunk_path, export_csv, is_archive
+
+
+def frames(n, width=32, height=24):
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(n)]
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_round_trip(tmp_path, compression):
+    path = str(tmp_path / "session.tlarchive")
+    written = frames(10)
+    with FrameArchiveWriter(path, 32, 24, chunk_size=4, compression=compression) as writer:
+        for i, frame in enumerate(written):
+            boxes = [[1, 2, 5, 9]] if i % 3 == 0 else []
+            assert writer.append(frame, 100 + i, boxes, ["Red"] * len(boxes), "Town01", "ClearNoon") == i
+
+    assert is_archive(path)
+    archive = FrameArchive(path)
+    assert len(archive) == 10
+    for original, stored in zip(written, archive):
+        np.testing.assert_array_equal(original, stored)
+    np.testing.assert_array_equal(archive[-1], written[-1])
+    assert archive.records[3] == {"i": 3, "frame": 103, "town": "Town01", "weather": "ClearNoon",
+                                  "boxes": [[1, 2, 5, 9]], "labels": ["Red"]}
+    assert [record["i"] for record, _ in archive.annotated()] == [0, 3, 6, 9]
+    for chunk in range(3):
+        assert os.path.exists(chunk_path(path, chunk, compressed=True)) == (compression is not None)
+        assert os.path.exists(chunk_path(path, chunk)) == (compression is None)
+
+
+def test_reader_picks_up_appended_frames(tmp_path):
+    path = str(tmp_path / "live.tlarchive")
+    writer = FrameArchiveWriter(path, 32, 24, flush_every=1)
+    writer.append(frames(1)[0])
+    archive = FrameArchive(path)
+    assert len(archive) == 1
+    writer.append(frames(2)[1])
+    archive.refresh()
+    assert len(archive) == 2
+    writer.close()
+    with pytest.raises(IndexError):
+        archive[2]
+
+
+def test_torn_index_line_is_ignored(tmp_path):
+    path = str(tmp_path / "torn.tlarchive")
+    with FrameArchiveWriter(path, 32, 24) as writer:
+        for frame in frames(3):
+            writer.append(frame)
+    with open(os.path.join(path, "index.jsonl"), "a") as f:
+        f.write('{"i": 3, "fra')
+    assert len(FrameArchive(path)) == 3
+
+
+def test_writer_rejects_bad_input(tmp_path):
+    path = str(tmp_path / "bad.tlarchive")
+    with pytest.raises(ValueError):
+        FrameArchiveWriter(path, 32, 24, compression="lz4")
+    with FrameArchiveWriter(path, 32, 24) as writer:
+        with pytest.raises(ValueError):
+            writer.append(np.zeros((24, 33, 3), dtype=np.uint8))
+    with pytest.raises(IOError):
+        FrameArchiveWriter(path, 32, 24)
+
+
+def test_export_writes_one_row_per_box(tmp_path):
+    path = str(tmp_path / "export.tlarchive")
+    with FrameArchiveWriter(path, 32, 24) as writer:
+        writer.append(frames(1)[0], 7, [[1, 2, 5, 9], [10, 2, 15, 9]], ["Red", "Green"], "Town02")
+        writer.append(frames(2)[1], 8)
+    out = str(tmp_path / "Dataset") + os.sep
+    assert export_csv(FrameArchive(path), out) == 2
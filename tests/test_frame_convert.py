@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from frame_convert import FrameConverter, legacy_convert, letterbox_frame
+
+
+def bgra(width, height, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (height, width, 4), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("width, height, input_size", [(640, 480, 416), (1920, 1080, 416), (300, 500, 320)])
+def test_converter_matches_the_legacy_path(width, height, input_size):
+    raw = bgra(width, height)
+    data = FrameConverter(width, height, input_size)(raw.tobytes())
+    frame, image_data, _ = legacy_convert(raw.tobytes(), width, height, input_size)
+
+    np.testing.assert_array_equal(data["frame"], raw[:, :, :3])
+    np.testing.assert_array_equal(data["frame"], frame)
+    np.testing.assert_array_equal(data["image"], raw[:, :, 2::-1])
+    assert data["frame_size"] == (height, width)
+    assert data["image_data"].shape == image_data.shape == (1, input_size, input_size, 3)
+    # uint8 against float32 resizing rounds differently by at most one level.
+    np.testing.assert_allclose(data["image_data"], image_data, atol=1.01 / 255.0)
+
+
+def test_converter_matches_image_preporcess():
+    utils = pytest.importorskip("tensorflow_yolov3.carla.utils")
+    raw = bgra(640, 480)
+    data = FrameConverter(640, 480, 416)(raw.tobytes())
+    # game_loop passed the RGB image to image_preporcess.
+    expected = utils.image_preporcess(np.copy(data["image"]), [416, 416])
+    np.testing.assert_allclose(data["image_data"][0], expected, atol=1.01 / 255.0)
+
+
+def test_slots_stay_valid_for_buffers_conversions():
+    converter = FrameConverter(64, 48, 32, buffers=2)
+    first = converter(bgra(64, 48, 1).tobytes())
+    kept = first["frame"].copy(), first["image_data"].copy()
+    second = converter(bgra(64, 48, 2).tobytes())
+    assert (first["slot"], second["slot"]) == (0, 1)
+    np.testing.assert_array_equal(first["frame"], kept[0])
+    np.testing.assert_array_equal(first["image_data"], kept[1])
+    third = converter(bgra(64, 48, 3).tobytes())
+    assert third["slot"] == 0 and third["frame"] is first["frame"]
+    assert converter.frames_converted == 3
+
+
+def test_letterbox_frame_matches_the_converter():
+    raw = bgra(200, 120)
+    data = FrameConverter(200, 120, 96)(raw.tobytes())
+    np.testing.assert_array_equal(letterbox_frame(data["frame"], 96), data["image_data"])
+    out = np.zeros((1, 96, 96, 3), dtype=np.float32)
+    assert letterbox_frame(data["frame"], 96, out) is out
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from frame_sync import FrameSync
+
+
+class Image(object):
+    def __init__(self, frame):
+        self.frame = frame
+
+
+def test_wait_for_returns_the_image_of_its_tick():
+    sync = FrameSync(capacity=4)
+    for frame in (1, 2, 3):
+        sync.put(Image(frame))
+    assert sync.wait_for(2, 0.1).frame == 2
+    assert sync.stats() == {"received": 3, "delivered": 1, "dropped": 1, "late": 0, "missed": 0, "timeouts": 0}
+    assert sync.wait_for(3, 0.1).frame == 3
+
+
+def test_wait_for_blocks_until_the_image_arrives():
+    sync = FrameSync()
+    threading.Timer(0.05, sync.put, (Image(7),)).start()
+    start = time.time()
+    assert sync.wait_for(7, 2.0).frame == 7
+    assert time.time() - start < 1.0
+
+
+def test_late_images_are_not_served():
+    sync = FrameSync()
+    assert sync.wait_for(5, 0.01) is None
+    sync.put(Image(4))
+    sync.put(Image(5))
+    sync.put(Image(6))
+    assert sync.wait_for(6, 0.1).frame == 6
+    stats = sync.stats()
+    assert (stats["timeouts"], stats["late"], stats["delivered"]) == (1, 2, 1)
+
+
+def test_lost_image_is_replaced_by_the_next_newer_one():
+    sync = FrameSync()
+    sync.put(Image(3))
+    sync.put(Image(5))
+    assert sync.wait_for(4, 0.1).frame == 5
+    stats = sync.stats()
+    assert (stats["missed"], stats["dropped"]) == (1, 1)
+    # Frame 5 was handed out, so it is never served twice.
+    assert sync.wait_for(5, 0.01) is None
+
+
+def test_full_ring_drops_the_oldest_image():
+    sync = FrameSync(capacity=2)
+    for frame in range(1, 6):
+        sync.put(Image(frame))
+    assert sync.dropped == 3
+    assert sync.wait_newest(0.1).frame == 5
+    assert sync.latest() is None
+    assert sync.dropped == 4
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        FrameSync(capacity=0)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import light_classifier
+from light_classifier import (GREEN, RED, YELLOW, classify_lights, legacy_label, mask_colors, synthetic_frame,
+                              threshold_features)
+from traffic_light import Light
+
+
+def crop(lamp=None, background=(30, 40, 50), size=(30, 12), lamp_rows=6):
+    """
+    A dark BGR crop with a lamp of the given color in its upper third.
+    """
+    image = np.empty(size + (3,), dtype=np.uint8)
+    image[:] = background
+    if lamp is not None:
+        image[8:8 + lamp_rows, 4:8] = lamp
+    return image
+
+
+CROPS = {
+    "green": (crop((0, 255, 0)), GREEN),
+    "red": (crop((0, 0, 255)), RED),
+    "yellow": (crop((0, 255, 255), lamp_rows=10), YELLOW),
+    # A small yellow lamp keeps the mean of G below 20, which reads as red.
+    "small yellow": (crop((0, 255, 255)), RED),
+    # Saturated red over a bright green glow is too green for red.
+    "red glow": (crop((0, 255, 255), background=(0, 230, 0)), YELLOW),
+    "orange": (crop((0, 210, 255), background=(0, 230, 0)), None),
+    "dim": (crop((0, 180, 180)), None),
+    "bright white": (crop((255, 255, 255), lamp_rows=10), YELLOW),
+}
+
+
+def original_state(image):
+    """
+    The label the original Light.get_state gives a crop.
+    """
+    light = Light(show=False, classes={9: "traffic light"})
+    light.get_state(image.copy(), 0.9)
+    return None if light.state is None else light.state.split(",")[0]
+
+
+@pytest.mark.parametrize("name", sorted(CROPS))
+def test_fixed_crops_match_get_state(name):
+    image, expected = CROPS[name]
+    assert original_state(image) == expected
+    assert legacy_label(image.copy()) == expected
+    result = classify_lights(image, [[0, image.shape[0], 0, image.shape[1]]], [0.9])
+    assert [light.label for light in result] == [expected]
+
+
+def test_black_and_empty_crops_are_skipped():
+    frame = np.zeros((60, 60, 3), dtype=np.uint8)
+    frame[0:30, 30:42] = crop((0, 255, 0))
+    boxes = [[0, 30, 0, 12], [0, 30, 30, 42], [10, 10, 5, 20], [100, 130, 0, 12]]
+    result = classify_lights(frame, boxes, [0.5, 0.6, 0.7, 0.8])
+    assert [(light.label, light.score, light.bbox) for light in result] == [(GREEN, 0.6, (30, 0, 42, 30))]
+    assert classify_lights(frame, [], []) == []
+
+
+@pytest.mark.parametrize("spread", [False, True])
+def test_frame_batches_match_per_crop_labels(spread, monkeypatch):
+    if spread:
+        # Forces the per-crop reductions used for boxes far apart.
+        monkeypatch.setattr(light_classifier, "MAX_REGION_RATIO", 0.0)
+    for seed in range(5):
+        frame, boxes = synthetic_frame(320, 240, 6, seed=seed)
+        # Overlapping and partly outside boxes too.
+        boxes = boxes + [[boxes[0][0] + 5, boxes[0][1] + 5, boxes[0][2], boxes[0][3]], [230, 260, 310, 330]]
+        result = classify_lights(frame, boxes, [0.9] * len(boxes))
+        expected = []
+        for y0, y1, x0, x1 in boxes:
+            piece = frame[max(y0, 0):min(y1, 240), max(x0, 0):min(x1, 320)]
+            if piece.size and piece.any():
+                expected.append(legacy_label(piece.copy()))
+        assert [light.label for light in result] == expected
+        assert RED in expected
+
+
+def test_features_and_mask_follow_the_thresholds():
+    image = np.array([[[10, 255, 199], [0, 200, 255], [0, 0, 0]]], dtype=np.uint8)
+    features = threshold_features(image)
+    assert features[0].tolist() == [[1, 0, 255, 1], [0, 1, 200, 1], [0, 0, 0, 0]]
+    assert mask_colors(image)[0].tolist() == [[0, 255, 0], [0, 200, 255], [0, 0, 0]]
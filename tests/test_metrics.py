@@ -0,0 +1,108 @@
+import json
+import os
+import socket
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import JSON, PROMETHEUS, Histogram, Metrics, MetricsExporter, NullMetrics, make_metrics
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_histogram_interpolates_inside_buckets():
+    histogram = Histogram((0.01, 0.02, 0.05))
+    for value in (0.005, 0.015, 0.015, 0.03, 0.1):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.percentile(20) == pytest.approx(0.01)
+    assert histogram.percentile(50) == pytest.approx(0.01 + 0.01 * 1.5 / 2)
+    assert histogram.percentile(100) == pytest.approx(0.1)
+    summary = histogram.summary()
+    assert summary["count"] == 5
+    assert summary["mean_ms"] == pytest.approx(33.0)
+    assert summary["max_ms"] == pytest.approx(100.0)
+    assert Histogram().percentile(90) == 0.0
+
+
+def test_snapshot_has_stages_counters_gauges_and_collectors():
+    metrics = Metrics()
+    with metrics.time("inference"):
+        pass
+    metrics.observe("inference", 0.004)
+    metrics.count("dropped_frames")
+    metrics.count("dropped_frames", 2)
+    metrics.gauge("queue_depth", 3, queue="inference")
+    metrics.add_collector(lambda m: m.gauge("frames_in_flight", 1))
+    metrics.add_collector(lambda m: 1 / 0)
+    snapshot = json.loads(metrics.to_json())
+    assert snapshot["stages"]["inference"]["count"] == 2
+    assert snapshot["counters"] == [{"name": "dropped_frames", "labels": {}, "value": 3}]
+    gauges = dict((g["name"], g) for g in snapshot["gauges"])
+    assert gauges["queue_depth"] == {"name": "queue_depth", "labels": {"queue": "inference"}, "value": 3}
+    assert gauges["frames_in_flight"]["value"] == 1 and gauges["rss_mb"]["value"] > 0
+
+
+def test_prometheus_text_format():
+    metrics = Metrics(buckets=(0.01, 0.1))
+    metrics.observe("tick", 0.005)
+    metrics.observe("tick", 0.05)
+    metrics.count("dropped_frames", stage="display")
+    lines = metrics.to_prometheus().splitlines()
+    assert "# TYPE traffic_light_stage_seconds histogram" in lines
+    assert 'traffic_light_stage_seconds_bucket{stage="tick",le="0.01"} 1' in lines
+    assert 'traffic_light_stage_seconds_bucket{stage="tick",le="+Inf"} 2' in lines
+    assert 'traffic_light_stage_seconds_count{stage="tick"} 2' in lines
+    assert "# TYPE traffic_light_dropped_frames_total counter" in lines
+    assert 'traffic_light_dropped_frames_total{stage="display"} 1' in lines
+    assert any(line.startswith("traffic_light_rss_mb ") for line in lines)
+
+
+def test_null_metrics_records_nothing():
+    metrics, exporter = make_metrics(False, path="unused.json")
+    assert isinstance(metrics, NullMetrics) and exporter is None
+    with metrics.time("tick") as timer:
+        pass
+    assert timer is metrics.time("inference")
+    metrics.count("dropped_frames")
+    assert not metrics.enabled
+
+
+def test_json_export_rolls_over(tmp_path):
+    path = str(tmp_path / "out" / "metrics.jsonl")
+    metrics = Metrics()
+    exporter = MetricsExporter(metrics, path, JSON, interval=60.0, max_bytes=1)
+    exporter.write()
+    metrics.count("frames")
+    exporter.close()
+    assert os.path.exists(path + ".1")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1 and json.loads(lines[0])["counters"][0]["value"] == 1
+
+
+def test_prometheus_export_and_http_endpoint(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    port = free_port()
+    metrics, exporter = make_metrics(True, path, PROMETHEUS, interval=60.0, port=port)
+    metrics.observe("render", 0.002)
+    try:
+        url = "http://127.0.0.1:{}".format(port)
+        body = urllib.request.urlopen(url + "/metrics", timeout=5).read().decode("utf-8")
+        assert 'traffic_light_stage_seconds_count{stage="render"} 1' in body
+        snapshot = json.loads(urllib.request.urlopen(url + "/metrics.json", timeout=5).read().decode("utf-8"))
+        assert snapshot["stages"]["render"]["count"] == 1
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other", timeout=5)
+    finally:
+        exporter.close()
+    with open(path) as f:
+        assert "# TYPE traffic_light_stage_seconds histogram" in f.read()
+    assert not os.path.exists(path + ".partial")
+    with pytest.raises(ValueError):
+        MetricsExporter(metrics, fmt="csv")
@@ -0,0 +1,87 @@
+import queue
+import random
+import threading
+import time
+
+import pytest
+
+from pipeline import BLOCK, DROP_OLDEST, BoundedQueue, FramePacket, Pipeline, QueueClosed, Stage
+
+
+def test_block_queue_waits_for_room():
+    q = BoundedQueue(2, BLOCK)
+    q.put(1)
+    q.put(2)
+    with pytest.raises(queue.Full):
+        q.put(3, timeout=0.01)
+    threading.Timer(0.05, q.get).start()
+    q.put(3, timeout=1.0)
+    assert [q.get(), q.get()] == [2, 3]
+    assert q.dropped == 0
+
+
+def test_drop_oldest_queue_never_blocks():
+    q = BoundedQueue(2, DROP_OLDEST)
+    for item in range(5):
+        q.put(item, timeout=0)
+    assert q.dropped == 3
+    assert [q.get(), q.get()] == [3, 4]
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+
+
+def test_closed_queue_drains_then_raises():
+    q = BoundedQueue(2)
+    q.put(1)
+    q.close()
+    with pytest.raises(QueueClosed):
+        q.put(2)
+    assert q.get() == 1
+    with pytest.raises(QueueClosed):
+        q.get()
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        BoundedQueue(0)
+    with pytest.raises(ValueError):
+        BoundedQueue(1, "newest")
+    with pytest.raises(ValueError):
+        Stage("s", lambda data: data, executor="fiber")
+
+
+def slow_double(data):
+    time.sleep(random.uniform(0, 0.01))
+    return dict(data, value=data["value"] * 2)
+
+
+def test_stage_results_keep_frame_order():
+    with Pipeline([Stage("first", slow_double, workers=4), Stage("second", slow_double, workers=3)],
+                  maxsize=4, policy=BLOCK) as pipeline:
+        results = []
+        for frame_id in range(30):
+            pipeline.put(FramePacket(frame_id, {"value": frame_id}))
+            results += pipeline.drain()
+        while len(results) < 30:
+            results.append(pipeline.get(timeout=5.0))
+        stats = pipeline.stats()
+    assert [packet.frame_id for packet in results] == list(range(30))
+    assert [packet.data["value"] for packet in results] == [4 * i for i in range(30)]
+    assert all("second" in packet.timestamps for packet in results)
+    assert stats["processed"] == {"first": 30, "second": 30}
+
+
+def fail_on_odd(data):
+    if data["value"] % 2:
+        raise ValueError("odd")
+    return data
+
+
+def test_stage_skips_failed_frames():
+    with Pipeline([Stage("check", fail_on_odd, workers=2)], maxsize=8, policy=BLOCK) as pipeline:
+        for frame_id in range(7):
+            pipeline.put(FramePacket(frame_id, {"value": frame_id}))
+        results = [pipeline.get(timeout=5.0) for _ in range(4)]
+        stats = pipeline.stats()
+    assert [packet.frame_id for packet in results] == [0, 2, 4, 6]
+    assert stats["errors"] == {"check": 3}
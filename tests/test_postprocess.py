@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import detector
+from postprocess import ClassFilteredPostprocessor, synthetic_predictions
+
+LIGHT = detector.TRAFFIC_LIGHT_CLASS
+
+
+def prediction(x, y, w, h, confidence, cls, num_classes=80):
+    row = np.zeros(5 + num_classes, dtype=np.float32)
+    row[:5] = x, y, w, h, confidence
+    row[5:] = 0.001
+    row[5 + cls] = 0.9
+    return row
+
+
+@pytest.mark.parametrize("class_ids", [(LIGHT,), (0, 2, LIGHT), None])
+def test_matches_postprocess_boxes_and_nms(class_ids):
+    utils = pytest.importorskip("tensorflow_yolov3.carla.utils")
+    pred = synthetic_predictions(n_objects=300, lights=20)
+    frame_size = (1080, 1920)
+    bboxes = utils.postprocess_boxes(pred, frame_size, 416, detector.SCORE_THRESHOLD)
+    bboxes = utils.nms(bboxes, detector.IOU_THRESHOLD, method="nms")
+    expected = np.array([b for b in bboxes if class_ids is None or int(b[5]) in class_ids]).reshape(-1, 6)
+    expected = expected[np.lexsort((-expected[:, 4], expected[:, 5]))]
+    result = ClassFilteredPostprocessor(416, class_ids).run(pred, frame_size)
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_boxes_are_mapped_back_to_the_frame():
+    # A 1920x1080 frame is letterboxed into 416x234 at a vertical offset of 91.
+    pred = np.stack([prediction(208, 208, 52, 26, 1.0, LIGHT)])
+    bboxes = ClassFilteredPostprocessor(416).run(pred, (1080, 1920))
+    scale = 416 / 1920.0
+    np.testing.assert_allclose(bboxes[0, :4], [182 / scale, (195 - 91) / scale, 234 / scale, (221 - 91) / scale],
+                               rtol=1e-5)
+    assert bboxes[0, 5] == LIGHT
+    assert abs(bboxes[0, 4] - 0.9) < 1e-6
+
+
+def test_only_target_classes_above_the_threshold_are_kept():
+    pred = np.stack([prediction(100, 100, 20, 40, 1.0, LIGHT),
+                     prediction(300, 100, 20, 40, 1.0, 0),
+                     prediction(200, 200, 20, 40, 0.2, LIGHT)])
+    bboxes = ClassFilteredPostprocessor(416).run(pred, (416, 416))
+    assert bboxes.shape == (1, 6) and bboxes[0, 5] == LIGHT
+    assert ClassFilteredPostprocessor(416, class_ids=None).run(pred, (416, 416)).shape == (2, 6)
+
+
+def test_a_prediction_only_counts_for_its_arg_max_class():
+    row = prediction(100, 100, 20, 40, 1.0, 0)
+    row[5 + LIGHT] = 0.8  # above the threshold, but not the arg-max
+    bboxes = ClassFilteredPostprocessor(416).run(row[None], (416, 416))
+    assert bboxes.shape == (0, 6)
+
+
+def test_nms_is_class_aware():
+    pred = np.stack([prediction(100, 100, 20, 40, 1.0, LIGHT),
+                     prediction(101, 101, 20, 40, 0.9, LIGHT),
+                     prediction(100, 100, 20, 40, 0.95, 2)])
+    bboxes = ClassFilteredPostprocessor(416, class_ids=(2, LIGHT)).run(pred, (416, 416))
+    assert sorted(bboxes[:, 5]) == [2, LIGHT]
+    assert abs(bboxes[bboxes[:, 5] == LIGHT][0, 4] - 0.9) < 1e-6
+
+
+def test_frame_dict_is_filled():
+    data = {"pred_bbox": synthetic_predictions(n_objects=50, lights=5), "frame_size": (480, 640)}
+    assert ClassFilteredPostprocessor(416)(data)["bboxes"].shape[1] == 6
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from fake_carla import Location, Rotation, Transform
+from projection import (LightProjector, TrafficLightIndex, intrinsics, project, town_index, traffic_lights,
+                        transform_matrix)
+
+# 800x600 at 90 degrees: focal length 400 px, principal point (400, 300).
+WIDTH, HEIGHT, FOV = 800, 600, 90.0
+
+
+class Box(object):
+    def __init__(self, location, extent):
+        self.location = location
+        self.extent = extent
+
+
+class StubLight(object):
+    type_id = "traffic.traffic_light"
+
+    def __init__(self, x, y, z=2.0, extent=(0.5, 0.5, 1.0), state="Red"):
+        self.transform = Transform(Location(x, y, 0.0))
+        self.bounding_box = Box(Location(0.0, 0.0, z), Location(*extent))
+        self.state = state
+        self.queried = 0
+
+    def get_transform(self):
+        return self.transform
+
+    def get_state(self):
+        self.queried += 1
+        return "TrafficLightState." + self.state
+
+
+class StubMap(object):
+    name = "Town07"
+
+
+class StubWorld(object):
+    def __init__(self, actors):
+        self.actors = actors
+
+    def get_actors(self):
+        return self.actors
+
+    def get_map(self):
+        return StubMap()
+
+
+def camera(x=0.0, y=0.0, z=0.0, yaw=0.0):
+    return Transform(Location(x, y, z), Rotation(yaw=yaw))
+
+
+def test_transform_matrix_rotates_and_translates():
+    point = np.array([1.0, 0.0, 0.0, 1.0])
+    assert np.allclose(transform_matrix(camera(5.0, 6.0, 7.0)) @ point, [6.0, 6.0, 7.0, 1.0])
+    assert np.allclose(transform_matrix(camera(yaw=90.0)) @ point, [0.0, 1.0, 0.0, 1.0])
+    pitched = Transform(Location(), Rotation(pitch=90.0))
+    assert np.allclose(transform_matrix(pitched) @ point, [0.0, 0.0, 1.0, 1.0])
+
+
+def test_project_known_points():
+    calibration = intrinsics(WIDTH, HEIGHT, FOV)
+    assert calibration[0, 0] == pytest.approx(400.0)
+    points = np.array([[10.0, 0.0, 0.0], [10.0, 2.0, 1.0], [-10.0, 0.0, 0.0]])
+    pixels, depth = project(points, camera(), calibration)
+    assert np.allclose(pixels[:2], [[400.0, 300.0], [480.0, 260.0]])
+    assert np.allclose(depth, [10.0, 10.0, -10.0])
+    # The same point seen by a camera moved and turned towards it.
+    pixels, depth = project(np.array([[0.0, 10.0, 0.0]]), camera(yaw=90.0), calibration)
+    assert np.allclose(pixels, [[400.0, 300.0]]) and depth[0] == pytest.approx(10.0)
+
+
+def test_light_box_projects_to_expected_pixels():
+    world = StubWorld([StubLight(20.0, 0.0)])
+    projector = LightProjector(TrafficLightIndex.from_world(world), WIDTH, HEIGHT, FOV)
+    indices, boxes, depths = projector.visible(camera())
+    # Corners span x 19.5..20.5, y -0.5..0.5, z 1..3.
+    expected = [400 - 400 * 0.5 / 19.5, 300 - 400 * 3 / 19.5, 400 + 400 * 0.5 / 19.5, 300 - 400 * 1 / 20.5]
+    assert indices.tolist() == [0]
+    assert np.allclose(boxes, [expected])
+    assert depths[0] == pytest.approx(20.0)
+
+
+def test_index_near_uses_radius_across_cells():
+    lights = [StubLight(0.0, 0.0), StubLight(30.0, 0.0), StubLight(-45.0, 20.0), StubLight(200.0, 0.0)]
+    index = TrafficLightIndex.from_world(StubWorld(lights), cell_size=50.0)
+    assert len(index) == 4 and len(index.cells) == 3
+    assert sorted(index.near((0.0, 0.0, 2.0), 40.0).tolist()) == [0, 1]
+    assert sorted(index.near((0.0, 0.0, 2.0), 60.0).tolist()) == [0, 1, 2]
+    assert index.near((1000.0, 0.0, 2.0), 60.0).tolist() == []
+
+
+def test_associate_picks_nearest_containing_light():
+    # Two lights in line ahead, one behind the camera, one far off to the side.
+    lights = [StubLight(40.0, 0.0, state="Green"), StubLight(20.0, 0.0), StubLight(-20.0, 0.0), StubLight(20.0, 30.0)]
+    projector = LightProjector(TrafficLightIndex.from_world(StubWorld(lights)), WIDTH, HEIGHT, FOV)
+    detections = np.array([
+        [392.0, 242.0, 408.0, 278.0, 0.9, 9.0],   # inside both boxes ahead
+        [397.0, 282.0, 403.0, 290.0, 0.8, 9.0],   # below the near light, inside the far one
+        [10.0, 10.0, 40.0, 40.0, 0.7, 9.0],       # no light there
+    ])
+    matches, (indices, boxes, depths) = projector.associate(camera(), detections)
+    assert sorted(indices.tolist()) == [0, 1]
+    assert matches.tolist() == [1, 0, -1]
+    assert projector.states(matches[:2]) == ["Red", "Green"]
+    assert [light.queried for light in lights] == [1, 1, 0, 0]
+    empty, _ = projector.associate(camera(), [])
+    assert empty.tolist() == []
+
+
+def test_capture_keeps_states_of_the_capture_tick():
+    light = StubLight(20.0, 0.0, state="Green")
+    projector = LightProjector(TrafficLightIndex.from_world(StubWorld([light])), WIDTH, HEIGHT, FOV)
+    captured = projector.capture(camera())
+    light.state = "Red"
+    assert projector.states([0], captured) == ["Green"]
+    assert projector.states([0]) == ["Red"]
+
+
+def test_town_index_is_built_once_per_town():
+    world = StubWorld([StubLight(20.0, 0.0)])
+    index = town_index(world)
+    world.actors = []
+    assert town_index(world) is index
+    assert traffic_lights(world) == []
@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+
+from quality import QualityController, QualityLevel, level_cost, quality_ladder, simulate
+
+
+def feed(controller, seconds, windows=1):
+    changes = []
+    for _ in range(windows * controller.window):
+        level = controller.update(seconds)
+        if level is not None:
+            changes.append(level)
+    return changes
+
+
+def test_ladder_goes_from_best_to_cheapest():
+    levels = quality_ladder([320, 608, 416], max_infer_every=3, max_display_every=2)
+    assert levels == [QualityLevel(608, 1, 1), QualityLevel(416, 1, 1), QualityLevel(320, 1, 1),
+                      QualityLevel(320, 2, 1), QualityLevel(320, 3, 1), QualityLevel(320, 3, 2)]
+    costs = [level_cost(level, 60.0) for level in levels]
+    assert costs == sorted(costs, reverse=True)
+
+
+def test_budget_is_the_tighter_of_fps_and_latency():
+    levels = quality_ladder()
+    assert QualityController(levels, 20).budget == 0.05
+    assert QualityController(levels, 20, 40).budget == 0.04
+    assert QualityController(levels, latency_ms=80).budget == 0.08
+
+
+def test_over_budget_moves_one_level_cheaper(tmp_path):
+    log = str(tmp_path / "quality.jsonl")
+    controller = QualityController(quality_ladder(), 20, log_file=log)
+    assert feed(controller, 0.08) == [QualityLevel(416, 1, 1)]
+    assert controller.index == 1
+    with open(log) as f:
+        adjustment = json.loads(f.readline())
+    assert (adjustment["from"], adjustment["to"], adjustment["input_size"]) == (0, 1, 416)
+
+
+def test_over_budget_jumps_to_a_level_predicted_to_fit():
+    levels = quality_ladder()
+    controller = QualityController(levels, 20, start=levels[3])
+    feed(controller, 0.02)      # 320 every 2nd tick leaves headroom
+    feed(controller, 0.03)      # 320 too
+    feed(controller, 0.04)      # 416 fits without headroom
+    assert controller.index == 1
+    # 320 is predicted at 150 ms from the last switch, the recent 20 ms
+    # measurement of 320 every 2nd tick fits.
+    assert feed(controller, 0.2) == [QualityLevel(320, 2, 1)]
+
+
+def test_decides_on_the_percentile_not_the_mean():
+    controller = QualityController(quality_ladder(), 20)
+    # Mean 41 ms, but three loops in twenty take 100 ms.
+    for i in range(controller.window):
+        controller.update(0.1 if i % 7 == 0 else 0.03)
+    assert controller.index == 1
+
+
+def test_infrequent_inference_is_averaged_over_its_period():
+    levels = quality_ladder()
+    controller = QualityController(levels, 20, start=QualityLevel(320, 2, 1), retry_after=1000)
+    # Inference every other tick: 80 ms and 10 ms loops average to 45 ms.
+    for i in range(controller.window):
+        controller.update(0.08 if i % 2 == 0 else 0.01)
+    assert controller.level == QualityLevel(320, 2, 1)
+    assert abs(controller.measured[controller.index][0] - 0.045) < 1e-9
+
+
+def test_level_known_over_budget_is_not_retried():
+    levels = quality_ladder()
+    controller = QualityController(levels, 20, retry_after=5)
+    feed(controller, 0.08)      # 608 over budget
+    assert controller.index == 1
+    # 416 leaves headroom, but 608 is predicted at 80 ms from the switch.
+    assert feed(controller, 0.03, windows=50) == []
+    assert controller.index == 1
+
+
+def test_level_is_retried_once_the_loop_got_faster():
+    levels = quality_ladder()
+    controller = QualityController(levels, 20, retry_after=5)
+    feed(controller, 0.08)
+    feed(controller, 0.03, windows=6)
+    assert controller.index == 1
+    # The switch measured 608 at 80 ms against 416 at 30 ms; at 15 ms 608 is
+    # predicted at 40 ms.
+    assert feed(controller, 0.015, windows=1) == [QualityLevel(608, 1, 1)]
+
+
+def test_backoff_doubles_after_each_failure():
+    levels = quality_ladder()
+    controller = QualityController(levels, 20, retry_after=3)
+    retries = []
+    for window in range(60):
+        # 608 never fits, 416 always leaves headroom and the predictions
+        # always say 608 fits.
+        seconds = 0.08 if controller.index == 0 else 0.01
+        for _ in range(controller.window):
+            controller.update(seconds)
+        if controller.index == 0:
+            retries.append(controller.windows)
+        controller._pairs.clear()
+        controller.measured.pop(0, None)
+    gaps = np.diff(retries)
+    assert len(retries) >= 3
+    assert all(later > earlier for earlier, later in zip(gaps, gaps[1:]))
+
+
+def test_settles_without_oscillating():
+    levels = quality_ladder()
+    for inference_ms, settled in [(25.0, QualityLevel(416, 1, 1)), (60.0, QualityLevel(320, 2, 1))]:
+        controller = QualityController(levels, 20)
+        times = simulate(controller, inference_ms, 2000)
+        assert controller.level == settled
+        assert len(controller.adjustments) <= 4
+        assert (times[1000:] > controller.budget).mean() < 0.1
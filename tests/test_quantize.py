@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from light_classifier import synthetic_frame
+from quantize import convert, evaluate, load_inputs_of, output_path, precision_recall
+
+
+def test_perfect_and_empty_detections():
+    truth = [[[0, 0, 10, 10]], [[20, 20, 30, 40], [50, 50, 60, 70]]]
+    assert precision_recall(truth, truth) == (1.0, 1.0)
+    assert precision_recall(truth, [[], []]) == (1.0, 0.0)
+    assert precision_recall([[], []], [[[0, 0, 5, 5, 0.9, 9]], []]) == (0.0, 1.0)
+    assert precision_recall([], []) == (1.0, 1.0)
+
+
+def test_each_truth_box_is_matched_once():
+    truth = [[[0, 0, 10, 10]]]
+    # A duplicate of the same light only counts once.
+    found = [[[0, 0, 10, 10, 0.9, 9], [1, 0, 10, 10, 0.8, 9]]]
+    assert precision_recall(truth, found) == (0.5, 1.0)
+
+
+def test_iou_threshold_and_best_match():
+    truth = [[[0, 0, 10, 10], [8, 0, 18, 10]]]
+    # The first box overlaps both lights, the second only the right one
+    # well; the best overlaps are paired first.
+    found = [[[4, 0, 14, 10, 0.9, 9], [8, 0, 18, 10, 0.9, 9]]]
+    assert precision_recall(truth, found) == (1.0, 1.0)
+    assert precision_recall(truth, found, iou_threshold=0.5) == (0.5, 0.5)
+    shifted = [[[5, 0, 15, 10, 0.9, 9]]]
+    assert precision_recall([[[0, 0, 10, 10]]], shifted) == (1.0, 1.0)
+    assert precision_recall([[[0, 0, 10, 10]]], shifted, iou_threshold=0.4) == (0.0, 0.0)
+
+
+def test_output_paths_and_modes():
+    assert output_path("tensorflow_yolov3/yolov3_coco.pb", "tflite-fp16") == "tensorflow_yolov3/yolov3_coco_fp16.tflite"
+    assert output_path("models/yolov3.onnx", "onnx-int8") == "models/yolov3_int8.onnx"
+    with pytest.raises(ValueError):
+        convert("tflite-int4", "model.pb", "model.onnx", [])
+
+
+def test_evaluate_reports_latency_and_detections(tmp_path):
+    frames = [synthetic_frame(320, 240, 3, seed=i)[0] for i in range(3)] + [synthetic_frame(160, 120, 1)[0]]
+    inputs = load_inputs_of(frames, 96)
+    assert [image.shape for image in inputs] == [(1, 96, 96, 3)] * 4
+    assert not np.array_equal(inputs[0], inputs[3])
+
+    model = tmp_path / "standin.model"
+    model.write_bytes(b"\0" * 1000)
+    stats, found = evaluate("standin", str(model), frames, input_size=96)
+    assert len(found) == 4
+    assert stats["file_mb"] == pytest.approx(0.001)
+    assert 0 < stats["p50_ms"] <= stats["p99_ms"]
+    precision, recall = precision_recall(found, found)
+    assert (precision, recall) == (1.0, 1.0)
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+import pytest
+
+from backends import make_backend
+from fake_carla import SyntheticSource
+from frame_archive import FrameArchive, FrameArchiveWriter
+from postprocess import ClassFilteredPostprocessor
+from replay import (LimitedSource, NpzSource, PngDirectorySource, ReplayHarness, StageTimer, VideoSource,
+                    open_source)
+
+
+def frames(n, width=64, height=48):
+    rng = np.random.RandomState(1)
+    return [rng.randint(0, 256, (height, width, 3)).astype(np.uint8) for _ in range(n)]
+
+
+class StubLight(object):
+    def __init__(self):
+        self.calls = []
+
+    def process_traffic_light(self, frame, bboxes):
+        self.calls.append((frame.shape, len(bboxes)))
+
+
+def test_png_directory_plays_in_natural_order(tmp_path):
+    written = frames(11)
+    for i, frame in enumerate(written):
+        cv2.imwrite(str(tmp_path / "frame_{}.png".format(i)), frame)
+    cv2.imwrite(str(tmp_path / "other.png"), written[0])
+    source = open_source(str(tmp_path))
+    assert isinstance(source, PngDirectorySource) and len(source) == 11
+    for original, replayed in zip(written, source):
+        np.testing.assert_array_equal(original, replayed)
+    with pytest.raises(IOError):
+        PngDirectorySource(str(tmp_path), "missing_*.png")
+
+
+def test_open_source_picks_npz_archive_and_video(tmp_path):
+    written = frames(3)
+    np.savez(str(tmp_path / "frames.npz"), frames=np.stack(written))
+    source = open_source(str(tmp_path / "frames.npz"))
+    assert isinstance(source, NpzSource)
+    assert len(list(source)) == 3
+
+    path = str(tmp_path / "session.tlarchive")
+    with FrameArchiveWriter(path, 64, 48) as writer:
+        for frame in written:
+            writer.append(frame)
+    assert isinstance(open_source(path), FrameArchive)
+    assert isinstance(open_source(str(tmp_path / "drive.mp4")), VideoSource)
+    assert len(list(LimitedSource(open_source(path), 2))) == 2
+
+
+def test_stage_timer_summary():
+    timer = StageTimer()
+    timer.samples["convert"] = [0.001, 0.002, 0.003]
+    with timer.measure("tick"):
+        pass
+    summary = timer.summary()
+    assert sorted(summary) == ["convert", "tick"]
+    assert summary["convert"]["mean"] == pytest.approx(2.0)
+    assert summary["convert"]["max"] == pytest.approx(3.0)
+    assert summary["convert"]["p50"] == pytest.approx(2.0)
+    assert sorted(summary["tick"]) == ["max", "mean", "p50", "p90", "p99"]
+
+
+def test_harness_runs_every_frame_through_the_stages():
+    backend = make_backend("standin", num_classes=80)
+    light = StubLight()
+    # The class-filtered decoder, detector.postprocess needs TensorFlow.
+    harness = ReplayHarness(SyntheticSource(160, 120, frames=5), backend, input_size=96, light=light,
+                            postprocess=ClassFilteredPostprocessor(96, [9], score_threshold=0.0))
+    data = harness.step()
+    assert data["frame"].shape == (120, 160, 3)
+    assert data["image_data"].shape == (1, 96, 96, 3)
+    assert data["frame_id"] == 1
+
+    report = harness.run()
+    assert report["frames"] == 5
+    assert report["detections"] == sum(count for _, count in light.calls)
+    assert sorted(report["stages_ms"]) == ["convert", "inference", "light", "postprocess", "preprocess", "tick"]
+    # Every frame was ticked, plus the tick that found the source exhausted.
+    assert len(harness.timer.samples["tick"]) == 6
+    assert len(light.calls) == 5 and light.calls[0][0] == (120, 160, 3)
+    assert report["fps"] > 0 and report["peak_rss_mb"] > 0
+    assert harness.step() is None
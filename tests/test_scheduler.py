@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from scheduler import FULL, ROI, SKIP, InferenceScheduler, merge_windows
+
+LIGHT = 9
+CAR = 2
+
+
+class Scripted(object):
+    """
+    Postprocess step returning the next scripted boxes, in the coordinates of
+    the frame or window it was given, and recording those sizes.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.sizes = []
+
+    def __call__(self, data):
+        self.sizes.append(tuple(data["frame_size"]))
+        data["bboxes"] = self.outputs.pop(0) if self.outputs else []
+        return data
+
+
+def scheduler(outputs, full_every=3, between=ROI, roi=None):
+    return InferenceScheduler(lambda data: data, 416, full_every, roi, between, postprocess=Scripted(outputs))
+
+
+def run(schedule, ticks):
+    decisions = []
+    for _ in range(ticks):
+        data = {"frame": np.zeros((480, 640, 3), np.uint8), "frame_size": (480, 640)}
+        data = schedule(data)
+        decisions.append(schedule.last_decision)
+    return decisions, data
+
+
+def test_merge_windows_joins_overlaps():
+    assert merge_windows([(0, 0, 10, 10), (5, 5, 20, 20), (30, 30, 40, 40)]) == [(0, 0, 20, 20), (30, 30, 40, 40)]
+    assert merge_windows([(0, 0, 10, 10), (10, 0, 20, 10)]) == [(0, 0, 10, 10), (10, 0, 20, 10)]
+
+
+def test_without_lights_roi_mode_follows_full_every():
+    schedule = scheduler([])
+    decisions, data = run(schedule, 7)
+    assert decisions == [FULL, ROI, ROI, FULL, ROI, ROI, FULL]
+    assert schedule.stats() == {"full": 3, "partial": 0, "skipped": 4}
+    assert data["bboxes"] == []
+
+
+def test_roi_follows_a_light_in_frame_coordinates():
+    light = [300.0, 100.0, 310.0, 130.0, 0.9, LIGHT]
+    # The first window is 96x120 from (257, 55), the next is centered on the
+    # light found in it; the light moves 2 px right every tick.
+    schedule = scheduler([[light], [[45.0, 45.0, 55.0, 75.0, 0.9, LIGHT]], [[45.0, 45.0, 55.0, 75.0, 0.9, LIGHT]]])
+    decisions, data = run(schedule, 3)
+    assert decisions == [FULL, ROI, ROI]
+    assert schedule.postprocess.sizes == [(480, 640), (120, 96), (120, 96)]
+    assert np.allclose(data["bboxes"], [[304.0, 100.0, 314.0, 130.0, 0.9, LIGHT]])
+    assert schedule.stats() == {"full": 1, "partial": 2, "skipped": 0}
+
+
+def test_losing_every_light_forces_full_detection():
+    light = [300.0, 100.0, 310.0, 130.0, 0.9, LIGHT]
+    schedule = scheduler([[light, [0.0, 300.0, 100.0, 400.0, 0.9, CAR]], [], []], full_every=10)
+    decisions, _ = run(schedule, 5)
+    # Only the light is followed; once it is gone the next tick is full, and
+    # without lights the schedule then waits for full_every again.
+    assert decisions == [FULL, ROI, FULL, ROI, ROI]
+    assert schedule.stats() == {"full": 2, "partial": 1, "skipped": 2}
+
+
+def test_skip_mode_reuses_the_last_detections():
+    light = [300.0, 100.0, 310.0, 130.0, 0.9, LIGHT]
+    schedule = scheduler([[light], [light]], full_every=2, between=SKIP)
+    decisions, data = run(schedule, 4)
+    assert decisions == [FULL, SKIP, FULL, SKIP]
+    assert np.allclose(data["bboxes"], [light])
+    assert schedule.stats() == {"full": 2, "partial": 0, "skipped": 2}
+
+
+def test_full_detection_limited_to_a_region():
+    schedule = scheduler([[[10.0, 20.0, 20.0, 50.0, 0.9, LIGHT]]], roi=(0.25, 0.0, 0.75, 0.5))
+    _, data = run(schedule, 1)
+    assert schedule.postprocess.sizes == [(240, 320)]
+    assert np.allclose(data["bboxes"], [[170.0, 20.0, 180.0, 50.0, 0.9, LIGHT]])
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        scheduler([], between="sometimes")
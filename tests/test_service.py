@@ -0,0 +1,140 @@
+import http.client
+import threading
+
+import numpy as np
+import pytest
+
+import detector
+from backends import make_backend
+from light_classifier import synthetic_frame
+from service import DetectionClient, DetectionService, ServiceBusy, respond, serve
+
+SIZE = 160
+
+
+class GatedBackend(object):
+    """
+    Stand-in backend whose runs wait until the test opens the gate.
+    """
+
+    def __init__(self):
+        self.backend = make_backend("standin")
+        self.num_classes = self.backend.num_classes
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def predict_scales(self, image_data):
+        self.entered.set()
+        self.gate.wait(5.0)
+        return self.backend.predict_scales(image_data)
+
+
+def frame_bytes(width=320, height=240):
+    frame, _ = synthetic_frame(width, height, 3, box_size=(40, 16))
+    return frame, frame.tobytes()
+
+
+def test_detect_replies_with_lights():
+    frame, buffer = frame_bytes()
+    with DetectionService(make_backend("standin"), input_size=SIZE) as service:
+        status, reply = respond(service, buffer, 240, 320, 3, 5)
+    assert status == 200 and reply["frame"] == 5
+    for light in reply["lights"]:
+        assert set(light) == {"bbox", "score", "state"}
+        assert light["score"] >= service.score_threshold
+
+
+def test_full_service_answers_busy():
+    backend = GatedBackend()
+    frame, buffer = frame_bytes()
+    with DetectionService(backend, input_size=SIZE, max_queue=1) as service:
+        first = threading.Thread(target=service.detect, args=(buffer, 240, 320, 3))
+        first.start()
+        assert backend.entered.wait(5.0)
+        with pytest.raises(ServiceBusy):
+            service.detect(buffer, 240, 320, 3)
+        status, reply = respond(service, buffer, 240, 320, 3, 9)
+        backend.gate.set()
+        first.join(5.0)
+        stats = service.stats()
+        # The slot is free again.
+        assert respond(service, buffer, 240, 320, 3, 10)[0] == 200
+    assert (status, reply["error"], reply["frame"]) == (503, "busy", 9)
+    assert (stats["rejected"], stats["requests"], stats["in_flight"]) == (2, 1, 0)
+
+
+def test_bad_frames_are_rejected():
+    with DetectionService(make_backend("standin"), input_size=SIZE) as service:
+        assert respond(service, b"\0" * 10, 240, 320, 3, None)[0] == 400
+        assert respond(service, b"\0" * (240 * 320 * 2), 240, 320, 2, None)[0] == 400
+        assert respond(service, b"", 0, 320, 3, None)[0] == 400
+        assert respond(service, b"", 240, 0, 4, None)[0] == 400
+
+
+def test_only_traffic_lights_are_classified():
+    frame, _ = frame_bytes()
+    light = detector.TRAFFIC_LIGHT_CLASS
+    bboxes = np.array([[10, 10, 30, 60, 0.9, light], [40, 10, 60, 60, 0.9, 2], [70, 10, 90, 60, 0.1, light]])
+    with DetectionService(make_backend("standin"), input_size=SIZE, class_ids=(2, light)) as service:
+        lights = service.classify(frame, bboxes)
+    assert [entry["bbox"] for entry in lights] == [[10, 10, 30, 60]]
+
+
+def post(port, body, headers):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10.0)
+    try:
+        connection.request("POST", "/detect", body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_bad_http_headers_are_answered_with_400():
+    frame, buffer = frame_bytes()
+    with DetectionService(make_backend("standin"), input_size=SIZE) as service:
+        servers = serve(service, port=0)
+        port = servers[0].server_address[1]
+        try:
+            assert post(port, buffer, {"X-Frame-Shape": "240,320,3", "X-Frame-Id": "seven"})[0] == 400
+            assert post(port, b"", {"X-Frame-Shape": "0,0,3"})[0] == 400
+            assert post(port, buffer, {"X-Frame-Shape": "240,320"})[0] == 400
+            assert post(port, buffer, {"X-Frame-Shape": "240,320,3", "X-Frame-Id": "7"})[0] == 200
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+
+@pytest.mark.parametrize("transport", ["unix", "http"])
+def test_clients_get_busy_over_both_transports(tmp_path, transport):
+    backend = GatedBackend()
+    frame, _ = frame_bytes()
+    with DetectionService(backend, input_size=SIZE, max_queue=1) as service:
+        if transport == "unix":
+            address = str(tmp_path / "service.sock")
+            servers = serve(service, unix_path=address)
+        else:
+            servers = serve(service, port=0)
+            address = "http://127.0.0.1:{}".format(servers[0].server_address[1])
+        try:
+            replies = []
+
+            def send_first():
+                with DetectionClient(address) as client:
+                    replies.append(client.detect(frame, 1))
+
+            first = threading.Thread(target=send_first)
+            first.start()
+            assert backend.entered.wait(5.0)
+            with DetectionClient(address) as client:
+                with pytest.raises(ServiceBusy):
+                    client.detect(frame, 2)
+                backend.gate.set()
+                first.join(5.0)
+                assert client.detect(np.dstack([frame, np.zeros(frame.shape[:2], np.uint8)]), 3)["frame"] == 3
+            assert replies[0]["frame"] == 1
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
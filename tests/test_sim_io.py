@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+import fake_carla
+from fake_carla import FakeControl
+from metrics import Metrics
+from sim_io import IDLE, Channel, DriveCommand, PeriodicTask, SimulatorIO, steer_control
+
+
+def world_and_car():
+    client = fake_carla.FakeClient(source_factory=lambda town: fake_carla.SyntheticSource(160, 120, variants=1))
+    world = client.get_world()
+    car = world.spawn_actor(world.get_blueprint_library().filter("vehicle.*")[0])
+    return world, car
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            pytest.fail("timed out")
+        time.sleep(0.005)
+
+
+def test_steer_control_follows_the_keyboard_rules():
+    control = FakeControl()
+    for _ in range(3):
+        steer_control(control, DriveCommand(True, True, 1, False))
+    assert (control.throttle, control.reverse, control.hand_brake) == (1, True, False)
+    assert control.steer == pytest.approx(0.15)
+    steer_control(control, DriveCommand(False, False, -1, True))
+    # Turning the other way first straightens the wheel.
+    assert (control.throttle, control.steer, control.hand_brake) == (0, 0, True)
+    assert steer_control(control, DriveCommand(False, False, -1, True)).steer == pytest.approx(-0.05)
+    assert control.reverse is True
+    steer_control(control, IDLE)
+    assert control.steer == 0
+    control.steer = 0.99
+    assert steer_control(control, DriveCommand(False, False, 1, False)).steer == 1.0
+
+
+def test_channel_keeps_the_latest_value():
+    channel = Channel("first")
+    assert channel.get() == (0, "first")
+    channel.put("second")
+    channel.put("third")
+    assert channel.get() == (2, "third")
+
+
+def test_periodic_task_measures_lateness_and_skips_missed_runs():
+    task = PeriodicTask("control", 10.0)
+    assert task.due(0.0)
+    assert task.ran(0.0) == 0.0
+    assert not task.due(0.05) and task.due(0.1)
+    assert task.ran(0.12) == pytest.approx(0.02)
+    assert task.next_run == pytest.approx(0.2)
+    # Half a second late: one overrun and the schedule restarts from now.
+    assert task.ran(0.7) == pytest.approx(0.5)
+    assert (task.overruns, task.next_run) == (1, pytest.approx(0.8))
+    stats = task.stats()
+    assert stats["runs"] == 3 and stats["target_rate"] == pytest.approx(10.0)
+    assert stats["rate"] == pytest.approx(2 / 0.7)
+    assert stats["jitter_max_ms"] == pytest.approx(500.0)
+
+
+def test_io_thread_ticks_drives_and_changes_weather():
+    world, car = world_and_car()
+    metrics = Metrics()
+    with SimulatorIO(world, car, tick_rate=200.0, control_rate=200.0, metrics=metrics) as io:
+        io.command(DriveCommand(True, False, 1, False))
+        io.set_weather(fake_carla.WeatherParameters.WetNoon)
+        wait_for(lambda: io.telemetry.get()[1] is not None and io.telemetry.get()[1].throttle == 1)
+        assert io.running
+        wait_for(lambda: world.get_weather() is fake_carla.WeatherParameters.WetNoon)
+    assert not io.running and io.error is None
+    telemetry = io.telemetry.get()[1]
+    assert telemetry.frame >= 1 and telemetry.speed == 0.0
+    assert car.get_control().throttle == 1 and car.get_control().steer > 0
+    stats = io.stats()
+    assert stats["tick"]["runs"] >= 1 and stats["control"]["runs"] >= 1
+    assert "tick_jitter" in metrics.stages and "control_jitter" in metrics.stages
+
+
+def test_without_driving_the_car_is_left_alone():
+    world, car = world_and_car()
+    car.set_autopilot(True)
+    with SimulatorIO(world, car, tick_rate=200.0, drive=False) as io:
+        io.command(DriveCommand(True, False, 1, False))
+        wait_for(lambda: io.tick_task.runs >= 3)
+    assert io.control_task.runs == 0
+    assert car.get_control().throttle == 0.0
+
+
+def test_errors_stop_the_thread_and_are_kept():
+    world, car = world_and_car()
+
+    def tick(seconds=None):
+        raise RuntimeError("simulator gone")
+
+    world.tick = tick
+    io = SimulatorIO(world, car, tick_rate=200.0)
+    io.start()
+    wait_for(lambda: not io.running)
+    io.close()
+    assert isinstance(io.error, RuntimeError)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from backends import make_backend
+from frame_convert import letterbox_frame
+from light_classifier import synthetic_frame
+from tiling import TiledDetector, cross_tile_nms, tile_windows
+
+
+def detection(x0, y0, x1, y1, score, cls=9):
+    return [x0, y0, x1, y1, score, cls]
+
+
+def test_overlapping_boxes_keep_the_best_one():
+    detections = np.array([detection(10, 10, 30, 60, 0.6), detection(11, 11, 31, 61, 0.9),
+                           detection(100, 10, 120, 60, 0.5)])
+    kept = cross_tile_nms(detections, iou_threshold=0.45)
+    assert kept[:, 4].tolist() == [0.9, 0.5]
+
+
+def test_box_cut_by_a_tile_edge_is_removed():
+    # A light cut in half at a tile border: IoU 0.5 with the full box, fully covered.
+    detections = np.array([detection(10, 10, 30, 60, 0.9), detection(10, 10, 30, 35, 0.7)])
+    assert len(cross_tile_nms(detections, iou_threshold=0.6, containment=0.7)) == 1
+    assert len(cross_tile_nms(detections, iou_threshold=0.6, containment=1.0)) == 2
+
+
+def test_boxes_of_different_classes_are_kept():
+    detections = np.array([detection(10, 10, 30, 60, 0.9, 9), detection(10, 10, 30, 60, 0.8, 2)])
+    assert sorted(cross_tile_nms(detections)[:, 5].tolist()) == [2, 9]
+    assert cross_tile_nms(np.zeros((0, 6))).shape == (0, 6)
+
+
+def test_tiles_cover_the_region_with_overlap():
+    windows = tile_windows(1920, 1080, 416, overlap=0.25, region=(0, 0, 1, 0.6))
+    assert all(x1 - x0 == 416 and y1 - y0 == 416 for x0, y0, x1, y1 in windows)
+    assert min(w[0] for w in windows) == 0 and max(w[2] for w in windows) == 1920
+    assert min(w[1] for w in windows) == 0 and max(w[3] for w in windows) == 648
+    xs = sorted(set(w[0] for w in windows))
+    assert all(b - a <= 416 * 0.75 for a, b in zip(xs, xs[1:]))
+    # A region smaller than a tile grows to one tile inside the frame.
+    assert tile_windows(640, 480, 416, region=(0.9, 0.9, 1, 1)) == [(224, 64, 640, 480)]
+
+
+def test_tiled_detection_returns_frame_coordinates():
+    frame, boxes = synthetic_frame(1280, 720, 6, box_size=(40, 16), seed=1)
+    tiled = TiledDetector(make_backend("standin"), input_size=416, tile_size=416, region=(0, 0, 1, 0.6))
+    data = tiled({"frame": frame, "frame_size": frame.shape[:2], "image_data": letterbox_frame(frame, 416)})
+    bboxes = np.array(data["bboxes"]).reshape(-1, 6)
+    assert tiled.tiles_run == len(tiled.windows(1280, 720))
+    assert len(bboxes) > 0
+    assert (bboxes[:, 0] >= 0).all() and (bboxes[:, 2] <= 1280).all()
+    assert (bboxes[:, 1] >= 0).all() and (bboxes[:, 3] <= 720).all()
+    # No two kept boxes overlap beyond the thresholds.
+    assert len(cross_tile_nms(bboxes, tiled.iou_threshold)) == len(bboxes)
@@ -0,0 +1,99 @@
+import cv2
+import numpy as np
+
+from light_classifier import GREEN, RED
+from tracker import LightTracker, Track, iou_matrix
+
+BOX = [100, 130, 200, 212]  # (y0, y1, x0, x1)
+COLORS = {GREEN: (0, 255, 0), RED: (0, 0, 255)}
+
+
+def light_frame(label, box=BOX, shape=(240, 320)):
+    frame = np.full(shape + (3,), 20, dtype=np.uint8)
+    y0, y1, x0, x1 = box
+    cv2.circle(frame, ((x0 + x1) // 2, y0 + (y1 - y0) // 3), (x1 - x0) // 3, COLORS[label], -1)
+    return frame
+
+
+def test_track_label_changes_after_hysteresis_observations():
+    track = Track(0, (0, 0, 1, 1), 0.9, 0, 8)
+    track.observe(GREEN, 0, 3)
+    assert track.label == GREEN
+    for frame_id in (1, 2):
+        track.observe(RED, frame_id, 3)
+        assert track.label == GREEN
+    track.observe(RED, 3, 3)
+    assert track.label == RED
+    assert list(track.history) == [(0, GREEN), (3, RED)]
+
+
+def test_flicker_does_not_change_the_label():
+    track = Track(0, (0, 0, 1, 1), 0.9, 0, 8)
+    for frame_id, label in enumerate([GREEN, RED, RED, GREEN, RED, None, RED, GREEN]):
+        track.observe(label, frame_id, 3)
+    assert track.label == GREEN
+    assert list(track.history) == [(0, GREEN)]
+
+
+def test_tracker_smooths_the_color_of_one_light():
+    tracker = LightTracker(hysteresis=3)
+    labels = []
+    for frame_id, label in enumerate([GREEN] * 3 + [RED] * 4):
+        tracks = tracker.update(light_frame(label), [BOX], [0.9], frame_id)
+        assert len(tracks) == 1
+        labels.append(tracks[0].label)
+    assert labels == [GREEN] * 5 + [RED] * 2
+    assert tracks[0].track_id == 0 and tracks[0].lifetime == 7
+
+
+def test_steady_new_color_is_adopted_with_default_thresholds():
+    tracker = LightTracker()
+    for frame_id, label in enumerate([GREEN] * 3 + [RED] * 20):
+        tracks = tracker.update(light_frame(label), [BOX], [0.9], frame_id)
+    assert tracks[0].label == RED
+    assert list(tracks[0].history) == [(0, GREEN), (5, RED)]
+    # Classified on the first frame, the switch and the two confirmations.
+    assert (tracker.classified, tracker.reused) == (4, 19)
+
+
+def test_single_frame_flicker_is_ignored():
+    tracker = LightTracker()
+    for frame_id, label in enumerate([GREEN] * 3 + [RED] + [GREEN] * 5):
+        tracks = tracker.update(light_frame(label), [BOX], [0.9], frame_id)
+    assert tracks[0].label == GREEN and list(tracks[0].history) == [(0, GREEN)]
+
+
+def test_unchanged_crops_are_not_reclassified():
+    tracker = LightTracker()
+    frame = light_frame(GREEN)
+    for frame_id in range(5):
+        tracker.update(frame, [BOX], [0.9], frame_id)
+    assert (tracker.classified, tracker.reused) == (1, 4)
+
+
+def test_tracks_follow_moving_boxes_and_expire():
+    tracker = LightTracker(max_misses=2)
+    for frame_id in range(4):
+        box = [100, 130, 200 + 5 * frame_id, 212 + 5 * frame_id]
+        tracks = tracker.update(light_frame(GREEN, box), [box], [0.9], frame_id)
+    assert [track.track_id for track in tracks] == [0]
+    for frame_id in range(4, 7):
+        tracks = tracker.update(light_frame(GREEN), [], [], frame_id)
+    assert tracks == [] and [track.track_id for track in tracker.finished] == [0]
+
+
+def test_iou_matrix():
+    iou = iou_matrix([[0, 0, 10, 10]], [[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]])
+    np.testing.assert_allclose(iou, [[1.0, 1.0 / 3.0, 0.0]])
+
+
+def test_lighting_noise_does_not_trigger_classification():
+    tracker = LightTracker()
+    rng = np.random.RandomState(0)
+    for frame_id in range(5):
+        frame = light_frame(GREEN)
+        frame[:] = np.clip(frame.astype(np.int16) + rng.randint(-15, 16, frame.shape), 0, 200).astype(np.uint8)
+        y0, y1, x0, x1 = BOX
+        cv2.circle(frame, ((x0 + x1) // 2, y0 + (y1 - y0) // 3), (x1 - x0) // 3, COLORS[GREEN], -1)
+        tracker.update(frame, [BOX], [0.9], frame_id)
+    assert (tracker.classified, tracker.reused) == (1, 4)
@@ -0,0 +1,79 @@
+import functools
+import os
+
+import numpy as np
+
+from backends import StandInBackend, make_backend
+from light_classifier import synthetic_frame
+from worker_pool import DetectionPool
+
+WIDTH, HEIGHT, SIZE = 160, 120, 96
+STANDIN = functools.partial(make_backend, "standin", None, 80, 1, 1)
+
+
+class CrashingBackend(StandInBackend):
+    """
+    Stand-in backend whose process exits on a letterboxed black frame.
+    """
+
+    def predict_scales(self, image_data):
+        image_data = np.asarray(image_data)
+        # The warm-up input is black without padding.
+        if image_data[0, 0, 0].any() and not image_data[0, SIZE // 2, SIZE // 2].any():
+            os._exit(3)
+        return StandInBackend.predict_scales(self, image_data)
+
+
+def frames(n):
+    return [synthetic_frame(WIDTH, HEIGHT, 2, box_size=(40, 16), seed=i)[0] for i in range(n)]
+
+
+def drain(pool, expected):
+    # Frames are views of the pool's shared memory, only the results are kept.
+    results = []
+    for _ in range(600):
+        results += [{key: value for key, value in data.items() if key not in ("frame", "image")}
+                    for data in pool.poll(0.1)]
+        if len(results) >= expected:
+            break
+    return results
+
+
+def test_results_come_back_in_submission_order():
+    with DetectionPool(STANDIN, WIDTH, HEIGHT, workers=2, input_size=SIZE) as pool:
+        pool.wait_ready()
+        for i, frame in enumerate(frames(8)):
+            assert pool.submit(frame, 100 + i)
+        results = drain(pool, 8)
+        stats = pool.stats()
+    assert [data["frame_id"] for data in results] == list(range(100, 108))
+    assert all("bboxes" in data and "lights" in data for data in results)
+    assert (stats["completed"], stats["failed"], stats["restarts"]) == (8, 0, 0)
+
+
+def test_killed_worker_is_restarted_and_its_frames_redone():
+    with DetectionPool(STANDIN, WIDTH, HEIGHT, workers=2, input_size=SIZE, per_worker=4) as pool:
+        pool.wait_ready()
+        for i, frame in enumerate(frames(6)):
+            pool.submit(frame, i)
+        pool._workers[0].process.kill()
+        results = drain(pool, 6)
+        stats = pool.stats()
+    assert [data["frame_id"] for data in results] == list(range(6))
+    assert all("error" not in data for data in results)
+    assert stats["restarts"] == 1 and stats["completed"] == 6
+
+
+def test_frame_killing_every_worker_is_returned_as_failed():
+    factory = functools.partial(CrashingBackend, None, 80, 1, 1)
+    batch = frames(3)
+    batch[1] = np.zeros_like(batch[1])
+    with DetectionPool(factory, WIDTH, HEIGHT, workers=1, input_size=SIZE, max_retries=1) as pool:
+        pool.wait_ready()
+        for i, frame in enumerate(batch):
+            pool.submit(frame, i)
+        results = drain(pool, 3)
+        stats = pool.stats()
+    assert [data["frame_id"] for data in results] == [0, 1, 2]
+    assert "error" in results[1] and "error" not in results[2]
+    assert stats["restarts"] == 2 and stats["failed"] == 1
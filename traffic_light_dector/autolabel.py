@@ -0,0 +1,141 @@
+"""
+Unattended ground-truth capture of traffic light annotations.
+
+Collecting training data used to mean pressing "r" while a crop window was
+focused, which saved data/N.png and data/frame_N.png one at a time, and then
+fixing boxes by hand. AutoLabeler labels every traffic light detection with
+the state of the map's traffic light it projects onto (see projection.py),
+refines its box with log.correctBBx and streams:
+    <base_dir>/<time><file_name>_<town>.csv    rows in the Log layout
+    <base_dir>/Img/<town>_<frame>.png          each sampled frame, once
+    <base_dir>/Crops/<state>/<town>_<frame>_<light>.png
+The crop directories are laid out for `python light_classifier.py`, which
+scores the classifier against them.
+
+Sampling keeps the dataset useful and the loop at simulator rate:
+    sample_every     only every n-th frame is considered
+    dedup_threshold  a light's crop is skipped while its state is unchanged
+                     and its 16x8 thumbnail differs by less than this mean
+                     absolute grey level from the last one saved (0 keeps all)
+    min_gap          frames between two saved crops of one light
+Images are written by the Log's StreamingDatasetWriter without blocking; a
+frame that finds the writer busy is dropped and counted, never waited for.
+"""
+
+import os
+
+import numpy as np
+
+import detector
+from log import Log, correctBBx
+from tracker import thumbnail
+
+
+class AutoLabeler(object):
+    """
+    Labels the detections of a camera with simulator states and writes them
+    as a dataset. Call it once per processed frame.
+    """
+
+    def __init__(self, projector, town, base_dir="Dataset/", file_name="carla_autolabel", sample_every=1,
+                 dedup_threshold=4.0, min_gap=0, score_threshold=detector.LIGHT_SCORE_THRESHOLD, refine=True,
+                 crops=True):
+        self.projector = projector
+        self.log = Log(file_name, town, base_dir)
+        self.sample_every = sample_every
+        self.dedup_threshold = dedup_threshold
+        self.min_gap = min_gap
+        self.score_threshold = score_threshold
+        self.refine = refine
+        self.crops = crops
+
+        self.frames = 0
+        self.detections = 0
+        self.unmatched = 0
+        self.duplicates = 0
+        self.saved = 0
+        self.dropped = 0
+        # Light index -> (frame id, state, thumbnail) of its last saved crop.
+        self._last = {}
+
+    def stats(self):
+        return {"frames": self.frames, "detections": self.detections, "unmatched": self.unmatched,
+                "duplicates": self.duplicates, "saved": self.saved, "dropped": self.dropped}
+
+    def label(self, frame, bboxes, camera_transform, states=None):
+        """
+        Returns (light index, state, [y0, y1, x0, x1]) for every traffic
+        light detection that projects onto a map light with a known state.
+        camera_transform is the pose the frame was captured at and states the
+        light states of that tick (see LightProjector.capture), read from the
+        simulator now when None.
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+        bboxes = bboxes[(bboxes[:, 5] == detector.TRAFFIC_LIGHT_CLASS) & (bboxes[:, 4] >= self.score_threshold)]
+        self.detections += len(bboxes)
+        if len(bboxes) == 0:
+            return []
+        matches, _ = self.projector.associate(camera_transform, bboxes)
+        found = np.flatnonzero(matches >= 0)
+        self.unmatched += len(bboxes) - len(found)
+        states = self.projector.states(matches[found], states)
+
+        height, width = frame.shape[:2]
+        labelled = []
+        for i, state in zip(found, states):
+            if state is None:
+                continue
+            x0, y0, x1, y1 = bboxes[i, :4].astype(int)
+            bbx = [y0, y1, x0, x1]
+            if self.refine:
+                bbx = correctBBx(frame[y0:y1, x0:x1], bbx)
+                bbx[0:2] = np.clip(bbx[0:2], 0, height).tolist()
+            if bbx[1] > bbx[0] and bbx[3] > bbx[2]:
+                labelled.append((int(matches[i]), state, [int(v) for v in bbx]))
+        return labelled
+
+    def is_duplicate(self, light, state, frame_id, thumb):
+        last = self._last.get(light)
+        if last is None or last[1] != state:
+            return False
+        if self.min_gap and frame_id - last[0] < self.min_gap:
+            return True
+        return self.dedup_threshold > 0 and np.abs(thumb - last[2]).mean() < self.dedup_threshold
+
+    def __call__(self, frame, frame_id, bboxes, camera_transform, states=None):
+        """
+        Labels and writes the detections of one frame, see label(). Returns
+        the number of annotations written.
+        """
+        self.frames += 1
+        if (self.frames - 1) % self.sample_every:
+            return 0
+        keep = []
+        for light, state, bbx in self.label(frame, bboxes, camera_transform, states):
+            crop = frame[bbx[0]:bbx[1], bbx[2]:bbx[3]]
+            thumb = thumbnail(crop)
+            if self.is_duplicate(light, state, frame_id, thumb):
+                self.duplicates += 1
+                continue
+            keep.append((light, state, bbx, crop, thumb))
+        if not keep:
+            return 0
+
+        # The frame buffer is reused by the next capture, the writer needs its own copy.
+        written = self.log.getFrameData(frame.copy(), frame_id, [[b[2], b[3], b[0], b[1]] for _, _, b, _, _ in keep],
+                                        [state for _, state, _, _, _ in keep], block=False)
+        if not written:
+            self.dropped += len(keep)
+            return 0
+        writer = self.log.getWriter()
+        for light, state, bbx, crop, thumb in keep:
+            self._last[light] = (frame_id, state, thumb)
+            if self.crops:
+                path = os.path.join(self.log.base_dir, "Crops", state,
+                                    "{}_{}_{}.png".format(self.log.town, frame_id, light))
+                writer.write_image(path, crop.copy(), block=False)
+        self.saved += len(keep)
+        return len(keep)
+
+    def close(self):
+        self.log.recDataCSV()
@@ -0,0 +1,428 @@
+"""
+Inference backends for the frozen YOLOv3 graph.
+
+game_loop, the replay harness and the scheduler call a backend for detection
+instead of holding a tf.Session themselves. A backend turns a letterboxed
+(N, size, size, 3) batch into the pred_sbbox, pred_mbbox and pred_lbbox
+outputs; predict() concatenates them into the (-1, 5 + num_classes) pred_bbox
+array the postprocessing expects, and calling a backend on a frame dict fills
+data["pred_bbox"] like the other detector steps.
+
+    tf          TensorFlow 1 session on yolov3_coco.pb
+    opencv      cv2.dnn on the .pb, or on an ONNX export of it
+    onnxruntime ONNX Runtime on an ONNX export of the graph
+    tflite      TensorFlow Lite on an fp16 or int8 conversion of the graph
+                (see quantize.py)
+    standin     a tiny fixed-weight NumPy network with the outputs of
+                YOLOv3, for benchmarks and runs without the model files
+
+Each backend takes intra_op_threads and inter_op_threads (0 keeps the
+library default). tf, onnxruntime and standin can run several calls at once;
+opencv and tflite hold one net or interpreter whose input and output tensors
+calls would overwrite, so they run one call at a time. The ONNX model is exported once with tf2onnx:
+    python -m tf2onnx.convert --graphdef tensorflow_yolov3/yolov3_coco.pb \\
+        --inputs input/input_data:0[1,416,416,3] \\
+        --outputs pred_sbbox/concat_2:0,pred_mbbox/concat_2:0,pred_lbbox/concat_2:0 \\
+        --output tensorflow_yolov3/yolov3_coco.onnx
+
+Run this module to compare latency, throughput and numerical agreement of the
+pred_bbox output of the available backends:
+    python backends.py --onnx tensorflow_yolov3/yolov3_coco.onnx --frames data/
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import detector
+
+DEFAULT_PB = "tensorflow_yolov3/yolov3_coco.pb"
+DEFAULT_ONNX = "tensorflow_yolov3/yolov3_coco.onnx"
+DEFAULT_TFLITE = "tensorflow_yolov3/yolov3_coco_int8.tflite"
+
+
+class InferenceBackend(object):
+    """
+    Base class. Subclasses implement predict_scales().
+    With a batching.BatchInferenceEngine set as engine, calls on frame dicts
+    from several threads are grouped into batched runs.
+    """
+
+    name = None
+
+    def __init__(self, num_classes=80, intra_op_threads=0, inter_op_threads=0):
+        self.num_classes = num_classes
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.engine = None
+
+    def __call__(self, data):
+        if self.engine is not None:
+            data["pred_bbox"] = self.engine.infer(data["image_data"])
+        else:
+            data["pred_bbox"] = self.predict(data["image_data"])
+        return data
+
+    def predict_scales(self, image_data):
+        """
+        Returns the small, medium and large scale outputs for a
+        (N, size, size, 3) float32 batch.
+        """
+        raise NotImplementedError
+
+    def predict(self, image_data):
+        """
+        Returns the concatenated predictions of the three scales.
+        """
+        outputs = self.predict_scales(image_data)
+        return np.concatenate([np.reshape(output, (-1, 5 + self.num_classes)) for output in outputs], axis=0)
+
+    def warmup(self, input_size=416, batch_sizes=(1,), runs=1):
+        """
+        Runs the model on blank inputs of every batch size, so the one-time
+        allocations and kernel selection of the first run happen before the
+        first real frame. Returns the seconds spent.
+        """
+        start = time.perf_counter()
+        for batch_size in batch_sizes:
+            image_data = np.full((batch_size, input_size, input_size, 3), 0.5, dtype=np.float32)
+            for _ in range(runs):
+                self.predict_scales(image_data)
+        return time.perf_counter() - start
+
+    def close(self):
+        pass
+
+
+class TF1Backend(InferenceBackend):
+    """
+    The frozen graph in a TensorFlow 1 session, as game_loop always ran it.
+    With cache_dir the graph is loaded from its optimized, cached form.
+    """
+
+    name = "tf"
+
+    def __init__(self, pb_file=DEFAULT_PB, num_classes=80, intra_op_threads=0, inter_op_threads=0, cache_dir=None):
+        InferenceBackend.__init__(self, num_classes, intra_op_threads, inter_op_threads)
+        import tensorflow as tf
+        import tensorflow_yolov3.carla.utils as utils
+
+        if cache_dir is not None:
+            from model_cache import optimized_tf_graph
+            names = [name.split(":")[0] for name in detector.RETURN_ELEMENTS]
+            pb_file = optimized_tf_graph(pb_file, names[:1], names[1:], cache_dir)
+        self.graph = tf.Graph()
+        self.return_tensors = utils.read_pb_return_tensors(self.graph, pb_file, detector.RETURN_ELEMENTS)
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def predict_scales(self, image_data):
+        return self.sess.run(
+            [self.return_tensors[1], self.return_tensors[2], self.return_tensors[3]],
+            feed_dict={self.return_tensors[0]: image_data})
+
+    def close(self):
+        self.sess.close()
+
+
+class OpenCVDnnBackend(InferenceBackend):
+    """
+    cv2.dnn on the frozen graph or its ONNX export. OpenCV's TensorFlow
+    importer does not support every op of the graph in every release; the
+    ONNX export is the more reliable input.
+    """
+
+    name = "opencv"
+
+    def __init__(self, model_file=DEFAULT_PB, num_classes=80, intra_op_threads=0, inter_op_threads=0,
+                 cache_dir=None):
+        InferenceBackend.__init__(self, num_classes, intra_op_threads, inter_op_threads)
+        import cv2
+        self.cv2 = cv2
+
+        if intra_op_threads > 0:
+            cv2.setNumThreads(intra_op_threads)
+        self.net = cv2.dnn.readNet(model_file)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = [name.split(":")[0] for name in detector.RETURN_ELEMENTS[1:]]
+        self._lock = threading.Lock()
+
+    def predict_scales(self, image_data):
+        # cv2.dnn takes NCHW blobs.
+        blob = np.ascontiguousarray(image_data.transpose(0, 3, 1, 2), dtype=np.float32)
+        with self._lock:
+            self.net.setInput(blob)
+            return self.net.forward(self.output_names)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    ONNX Runtime on the CPU execution provider. With cache_dir the optimized
+    model is saved on the first load and later loads skip the optimization.
+    """
+
+    name = "onnxruntime"
+
+    def __init__(self, model_file=DEFAULT_ONNX, num_classes=80, intra_op_threads=0, inter_op_threads=0,
+                 cache_dir=None):
+        InferenceBackend.__init__(self, num_classes, intra_op_threads, inter_op_threads)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if cache_dir is not None:
+            from model_cache import onnxruntime_cache
+            cached, exists = onnxruntime_cache(model_file, cache_dir)
+            if exists:
+                model_file = cached
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                options.optimized_model_filepath = cached
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()][:3]
+
+    def predict_scales(self, image_data):
+        return self.session.run(self.output_names, {self.input_name: image_data.astype(np.float32)})
+
+
+class TFLiteBackend(InferenceBackend):
+    """
+    A TensorFlow Lite interpreter, from tflite_runtime if installed, else
+    from TensorFlow. Inputs and outputs of fully integer models are
+    quantized and dequantized here. cache_dir is ignored, the converted
+    model is already optimized.
+    """
+
+    name = "tflite"
+
+    def __init__(self, model_file=DEFAULT_TFLITE, num_classes=80, intra_op_threads=0, inter_op_threads=0,
+                 cache_dir=None):
+        InferenceBackend.__init__(self, num_classes, intra_op_threads, inter_op_threads)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model_file, num_threads=intra_op_threads or None)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        outputs = self.interpreter.get_output_details()
+        # Small, medium, large scale, whatever order the converter chose.
+        order = [name.split("/")[0] for name in detector.RETURN_ELEMENTS[1:]]
+        if all(any(scale in output["name"] for output in outputs) for scale in order):
+            outputs = [next(o for o in outputs if scale in o["name"]) for scale in order]
+        self.outputs = outputs[:3]
+        self.input_shape = tuple(self.input["shape"])
+        self._lock = threading.Lock()
+
+    def predict_scales(self, image_data):
+        with self._lock:
+            return self._invoke(image_data)
+
+    def _invoke(self, image_data):
+        # Converted with a fixed [1, 416, 416, 3] input, other batch or input
+        # sizes need the tensors resized.
+        if image_data.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input["index"], list(image_data.shape))
+            self.interpreter.allocate_tensors()
+            self.input_shape = image_data.shape
+        dtype = self.input["dtype"]
+        if dtype in (np.int8, np.uint8):
+            scale, zero_point = self.input["quantization"]
+            image_data = np.clip(np.round(image_data / scale + zero_point), np.iinfo(dtype).min, np.iinfo(dtype).max)
+        self.interpreter.set_tensor(self.input["index"], image_data.astype(dtype))
+        self.interpreter.invoke()
+
+        results = []
+        for output in self.outputs:
+            # Refreshed after a resize.
+            detail = next(o for o in self.interpreter.get_output_details() if o["index"] == output["index"])
+            value = self.interpreter.get_tensor(detail["index"])
+            if detail["dtype"] in (np.int8, np.uint8):
+                scale, zero_point = detail["quantization"]
+                value = (value.astype(np.float32) - zero_point) * scale
+            results.append(value)
+        return results
+
+
+class StandInBackend(InferenceBackend):
+    """
+    Stand-in for the YOLOv3 graph. Each scale average-pools the input to its
+    grid and projects the cell colors with fixed random weights to the
+    3 anchors x (5 + num_classes) outputs, decoded like the graph's. Bright
+    red or green cells become traffic light candidates, so every later step
+    gets a realistic amount of work. model_file is ignored.
+    """
+
+    name = "standin"
+    STRIDES = (8, 16, 32)
+    ANCHORS = (((10, 13), (16, 30), (33, 23)), ((30, 61), (62, 45), (59, 119)), ((116, 90), (156, 198), (373, 326)))
+
+    def __init__(self, model_file=None, num_classes=80, intra_op_threads=0, inter_op_threads=0, cache_dir=None,
+                 seed=0):
+        InferenceBackend.__init__(self, num_classes, intra_op_threads, inter_op_threads)
+        import cv2
+        self.cv2 = cv2
+        rng = np.random.RandomState(seed)
+        # Rows: R, G, B cell means and a bias.
+        self.weights = rng.normal(0, 0.5, (4, 3, 5 + num_classes)).astype(np.float32)
+        self.weights[:3, :, 4] += np.array([24.0, 24.0, -48.0], dtype=np.float32)[:, None]
+        self.weights[3, :, 4] = -6.0
+        self.weights[3, :, 5:] = -4.0
+        self.weights[3, :, 5 + detector.TRAFFIC_LIGHT_CLASS] = 2.0
+
+    def predict_scales(self, image_data):
+        image_data = np.asarray(image_data, dtype=np.float32)
+        n, size = image_data.shape[:2]
+        outputs = []
+        for stride, anchors in zip(self.STRIDES, self.ANCHORS):
+            grid = size // stride
+            cells = np.stack([self.cv2.resize(image, (grid, grid), interpolation=self.cv2.INTER_AREA)
+                              for image in image_data])
+            logits = (cells @ self.weights[:3].reshape(3, -1)).reshape(n, grid, grid, 3, -1) + self.weights[3]
+            output = np.empty_like(logits)
+            offsets = np.stack(np.meshgrid(np.arange(grid), np.arange(grid)), axis=-1)[None, :, :, None, :]
+            output[..., 0:2] = (1.0 / (1.0 + np.exp(-logits[..., 0:2])) + offsets) * stride
+            output[..., 2:4] = np.exp(np.clip(logits[..., 2:4], -4, 4)) * np.array(anchors, dtype=np.float32)
+            output[..., 4:] = 1.0 / (1.0 + np.exp(-logits[..., 4:]))
+            outputs.append(output)
+        return outputs
+
+
+BACKENDS = {
+    TF1Backend.name: TF1Backend,
+    OpenCVDnnBackend.name: OpenCVDnnBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+    TFLiteBackend.name: TFLiteBackend,
+    StandInBackend.name: StandInBackend,
+}
+
+
+def make_backend(name, model_file=None, num_classes=80, intra_op_threads=0, inter_op_threads=0, cache_dir=None):
+    """
+    Builds the backend registered under name. model_file defaults to the .pb
+    for tf and opencv, to the .onnx export for onnxruntime and to the int8
+    conversion for tflite; standin needs none. cache_dir
+    enables the optimized model cache of tf and onnxruntime (see
+    model_cache.py).
+    """
+    if name not in BACKENDS:
+        raise ValueError("unknown backend '{}', choose from {}".format(name, ", ".join(sorted(BACKENDS))))
+    backend_class = BACKENDS[name]
+    if model_file is None:
+        model_file = {OnnxRuntimeBackend: DEFAULT_ONNX, TFLiteBackend: DEFAULT_TFLITE}.get(backend_class, DEFAULT_PB)
+    return backend_class(model_file, num_classes, intra_op_threads, inter_op_threads, cache_dir)
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def load_inputs(frames, count, input_size):
+    """
+    Returns count letterboxed inputs from a replay source path, or random
+    ones if frames is None.
+    """
+    if frames is None:
+        rng = np.random.RandomState(0)
+        return [rng.rand(1, input_size, input_size, 3).astype(np.float32) for _ in range(count)]
+
+    from frame_convert import FrameConverter
+    from replay import LimitedSource, open_source
+
+    inputs = []
+    converter = None
+    for bgr in LimitedSource(open_source(frames), count):
+        if converter is None:
+            converter = FrameConverter(bgr.shape[1], bgr.shape[0], input_size)
+        data = converter.letterbox({"frame": bgr, "slot": 0})
+        inputs.append(data["image_data"].copy())
+    return inputs
+
+
+def compare(backends, inputs, warmup=2):
+    """
+    Times every backend on the same inputs and compares its pred_bbox with the
+    first backend's. Returns {name: stats}.
+    """
+    results = {}
+    reference = None
+    for backend in backends:
+        for image_data in inputs[:warmup]:
+            backend.predict(image_data)
+        outputs = []
+        latencies = []
+        start = time.perf_counter()
+        for image_data in inputs:
+            t = time.perf_counter()
+            outputs.append(backend.predict(image_data))
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+
+        ms = np.asarray(latencies) * 1000.0
+        stats = {
+            "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "fps": len(inputs) / elapsed,
+        }
+        if reference is None:
+            reference = outputs
+        else:
+            diff = np.abs(np.stack(outputs) - np.stack(reference))
+            stats["max_abs_diff"] = float(diff.max())
+            stats["mean_abs_diff"] = float(diff.mean())
+        results[backend.name] = stats
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pb", default=DEFAULT_PB, help="Frozen YOLOv3 graph")
+    ap.add_argument("--onnx", default=None, help="ONNX export of the graph")
+    ap.add_argument("--tflite", default=DEFAULT_TFLITE, help="TensorFlow Lite conversion of the graph")
+    ap.add_argument("--backends", default="tf,opencv,onnxruntime", help="Comma separated backends, tf first")
+    ap.add_argument("--frames", default=None, help="Replay source for real inputs (PNG dir, video, .npz)")
+    ap.add_argument("-n", "--count", type=int, default=30, help="Inputs per backend")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("--intra", type=int, default=0, help="Intra-op threads")
+    ap.add_argument("--inter", type=int, default=0, help="Inter-op threads")
+    args = vars(ap.parse_args())
+
+    backends = []
+    for name in args["backends"].split(","):
+        model_file = args["onnx"] if name == OnnxRuntimeBackend.name else args["pb"]
+        if name == TFLiteBackend.name:
+            model_file = args["tflite"]
+        if name == OpenCVDnnBackend.name and args["onnx"] is not None:
+            model_file = args["onnx"]
+        try:
+            backends.append(make_backend(name, model_file, 80, args["intra"], args["inter"]))
+        except Exception as error:
+            print("skipping {}: {!r}".format(name, error))
+
+    inputs = load_inputs(args["frames"], args["count"], args["input_size"])
+    results = compare(backends, inputs)
+    for backend in backends:
+        backend.close()
+
+    print("{:12s} {:>9s} {:>9s} {:>9s} {:>8s} {:>12s} {:>12s}".format(
+        "backend", "mean ms", "p50 ms", "p99 ms", "fps", "max diff", "mean diff"))
+    for name, stats in results.items():
+        print("{:12s} {:9.2f} {:9.2f} {:9.2f} {:8.2f} {:>12s} {:>12s}".format(
+            name, stats["mean_ms"], stats["p50_ms"], stats["p99_ms"], stats["fps"],
+            "{:.2e}".format(stats["max_abs_diff"]) if "max_abs_diff" in stats else "reference",
+            "{:.2e}".format(stats["mean_abs_diff"]) if "mean_abs_diff" in stats else "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Batched YOLOv3 inference.
+
+The frozen graph accepts any batch size on input/input_data:0, so several
+frames can share one backend run (one sess.run for the TF backend): they are
+stacked into an (N, 416, 416, 3) feed and the pred_sbbox/pred_mbbox/pred_lbbox
+outputs are split back per frame. The frames come from the inference workers
+of the pipelined client, the tiles of tiling.TiledDetector or the clients of
+service.py, which is how several cameras or vehicles share one model.
+
+BatchInferenceEngine.run_batch() batches a list of frames synchronously.
+submit()/infer() can be called from many threads; a background thread groups
+requests until max_batch_size is reached or the oldest request has waited
+max_wait seconds, whichever comes first.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BatchInferenceEngine(object):
+    """
+    Groups single-frame inference requests into batched runs of a
+    backends.InferenceBackend.
+    """
+
+    def __init__(self, backend, max_batch_size=4, max_wait=0.005):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.batches = 0
+        self.frames = 0
+
+        self._requests = queue.Queue()
+        self._thread = None
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="batch-inference", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if not self._running:
+            return
+        self._running = False
+        self._requests.put(None)
+        self._thread.join()
+
+    def mean_batch_size(self):
+        return self.frames / float(self.batches) if self.batches else 0.0
+
+    def run_batch(self, images):
+        """
+        Runs one backend call over a list of letterboxed inputs, each shaped
+        (416, 416, 3) or (1, 416, 416, 3). Returns one concatenated
+        (-1, 5 + num_classes) prediction array per input, in input order.
+        """
+        feed = np.concatenate([image.reshape((-1,) + image.shape[-3:]) for image in images], axis=0)
+        outputs = self.backend.predict_scales(feed)
+
+        batch = feed.shape[0]
+        pred_bbox = np.concatenate([np.reshape(output, (batch, -1, 5 + self.backend.num_classes))
+                                    for output in outputs], axis=1)
+        self.batches += 1
+        self.frames += batch
+        return list(pred_bbox)
+
+    def submit(self, image_data):
+        """
+        Queues one frame for the next batch and returns a Future of its
+        pred_bbox. The engine must be started.
+        """
+        if not self._running:
+            raise RuntimeError("BatchInferenceEngine is not started")
+        future = Future()
+        self._requests.put((image_data, future))
+        return future
+
+    def infer(self, image_data):
+        """
+        Blocking variant of submit().
+        """
+        return self.submit(image_data).result()
+
+    def _next_batch(self):
+        first = self._requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Serve what was collected, then stop.
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            futures = [request[1] for request in batch]
+            try:
+                results = self.run_batch([request[0] for request in batch])
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            for future, pred_bbox in zip(futures, results):
+                future.set_result(pred_bbox)
+
+        # Fail whatever arrived after close().
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request[1].set_exception(RuntimeError("BatchInferenceEngine closed"))
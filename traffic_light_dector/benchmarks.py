@@ -0,0 +1,342 @@
+"""
+Regression benchmarks of the detection and traffic light steps.
+
+Every step of a frame's way through the client is timed on its own, at
+640x480 and 1920x1080, without a GPU, a display or CARLA:
+    render                 FrameConverter.convert of a BGRA camera buffer
+    letterbox              FrameConverter.letterbox into the network input
+    image_preporcess       utils.image_preporcess, through detector.preprocess
+    inference              the stand-in model (backends.StandInBackend)
+    postprocess            ClassFilteredPostprocessor on its output
+    postprocess_nms        utils.postprocess_boxes and utils.nms, through
+                           detector.postprocess
+    classify_lights        the batched traffic light classifier
+    get_state              Light.get_state on every candidate crop
+    process_traffic_light  Light.process_traffic_light, crops to a NullSink
+    log                    Log.getFrameData into a temporary directory with
+                           a recDataCSV every LOG_FLUSH_EVERY frames, so the
+                           background image writes count per frame
+Frames are synthetic (light_classifier.synthetic_frame, whose lit boxes are
+the light candidates) or come from a replay source, resized to each size,
+with the stand-in model's detections as candidates. Steps whose imports fail,
+e.g. without the tensorflow_yolov3 checkout, are reported as skipped.
+
+Results are written as JSON: {"commit", "python", "results": {"<step>@<w>x<h>":
+{"fps", "mean_ms", "p50_ms", "p99_ms", "iterations"}}, "skipped"}. Given the
+JSON of an earlier commit as --baseline, every step whose throughput dropped
+by more than --tolerance is listed and the exit status is 1:
+    python benchmarks.py --output before.json
+    python benchmarks.py --baseline before.json --tolerance 0.15
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import detector
+
+SIZES = ((640, 480), (1920, 1080))
+INPUT_SIZE = 416
+N_LIGHTS = 6
+CANDIDATE_SCORE = 0.9
+# Frames of the log step between two flushes, fixed so its mean does not
+# depend on the number of iterations.
+LOG_FLUSH_EVERY = 8
+
+
+class FrameSet(object):
+    """
+    BGR frames of one size with their traffic light candidates as
+    [y0, y1, x0, x1] boxes, and what the steps before each step produce.
+    """
+
+    def __init__(self, frames, boxes):
+        from backends import StandInBackend
+        from frame_convert import FrameConverter
+        from postprocess import ClassFilteredPostprocessor
+
+        self.frames = frames
+        self.height, self.width = frames[0].shape[:2]
+        self.boxes = boxes
+        self.bgra = [cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA).tobytes() for frame in frames]
+        converter = FrameConverter(self.width, self.height, INPUT_SIZE)
+        self.inputs = [converter.letterbox({"frame": frame, "slot": 0})["image_data"].copy() for frame in frames]
+        self.model = StandInBackend()
+        self.predictions = [self.model.predict(image_data) for image_data in self.inputs]
+        postprocessor = ClassFilteredPostprocessor(INPUT_SIZE)
+        self.detections = [postprocessor.run(pred, (self.height, self.width)) for pred in self.predictions]
+        if self.boxes is None:
+            self.boxes = [[[int(b[1]), int(b[3]), int(b[0]), int(b[2])] for b in bboxes
+                           if b[4] >= detector.LIGHT_SCORE_THRESHOLD] for bboxes in self.detections]
+        # Candidates as detection rows, the input of Light.
+        self.candidates = [np.array([[x0, y0, x1, y1, CANDIDATE_SCORE, detector.TRAFFIC_LIGHT_CLASS]
+                                     for y0, y1, x0, x1 in boxes]).reshape(-1, 6) for boxes in self.boxes]
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def synthetic_frames(width, height, count):
+    from light_classifier import synthetic_frame
+
+    # Lights scaled with the frame, like a camera of another resolution.
+    box_size = (max(12, height // 24), max(6, height // 60))
+    pairs = [synthetic_frame(width, height, N_LIGHTS, box_size, seed=i) for i in range(count)]
+    return FrameSet([frame for frame, _ in pairs], [boxes for _, boxes in pairs])
+
+
+def recorded_frames(source, width, height, count):
+    from replay import LimitedSource, open_source
+
+    frames = [cv2.resize(np.asarray(frame), (width, height), interpolation=cv2.INTER_AREA)
+              for frame in LimitedSource(open_source(source), count)]
+    if not frames:
+        raise ValueError("no frames in {}".format(source))
+    return FrameSet(frames, None)
+
+
+# ==============================================================================
+# -- steps ---------------------------------------------------------------------
+# ==============================================================================
+# Each step is set up once per frame set and returns the function timed per
+# frame, called with the frame's index.
+
+
+def step_render(frames):
+    from frame_convert import FrameConverter
+
+    converter = FrameConverter(frames.width, frames.height, INPUT_SIZE)
+    return lambda i: converter.convert(frames.bgra[i])
+
+
+def step_letterbox(frames):
+    from frame_convert import FrameConverter
+
+    converter = FrameConverter(frames.width, frames.height, INPUT_SIZE)
+    return lambda i: converter.letterbox({"frame": frames.frames[i], "slot": 0})
+
+
+def step_image_preporcess(frames):
+    import tensorflow_yolov3.carla.utils  # noqa: F401, loaded by detector on first use
+    images = [frame[:, :, ::-1] for frame in frames.frames]
+    return lambda i: detector.preprocess({"image": images[i]}, INPUT_SIZE)
+
+
+def step_inference(frames):
+    return lambda i: frames.model.predict(frames.inputs[i])
+
+
+def step_postprocess(frames):
+    from postprocess import ClassFilteredPostprocessor
+
+    postprocessor = ClassFilteredPostprocessor(INPUT_SIZE)
+    size = (frames.height, frames.width)
+    return lambda i: postprocessor.run(frames.predictions[i], size)
+
+
+def step_postprocess_nms(frames):
+    import tensorflow_yolov3.carla.utils  # noqa: F401, loaded by detector on first use
+    size = (frames.height, frames.width)
+    return lambda i: detector.postprocess({"pred_bbox": frames.predictions[i], "frame_size": size}, INPUT_SIZE)
+
+
+def step_classify_lights(frames):
+    from light_classifier import classify_lights
+
+    scores = [[CANDIDATE_SCORE] * len(boxes) for boxes in frames.boxes]
+    return lambda i: classify_lights(frames.frames[i], frames.boxes[i], scores[i])
+
+
+def _light():
+    from display import NullSink
+    from traffic_light import Light
+
+    return Light(show=False, sink=NullSink(), classes={detector.TRAFFIC_LIGHT_CLASS: "traffic light"})
+
+
+def step_get_state(frames):
+    light = _light()
+
+    def run(i):
+        frame = frames.frames[i]
+        for y0, y1, x0, x1 in frames.boxes[i]:
+            light.get_state(frame[y0:y1, x0:x1], CANDIDATE_SCORE)
+    return run
+
+
+def step_process_traffic_light(frames):
+    light = _light()
+    return lambda i: light.process_traffic_light(frames.frames[i], frames.candidates[i])
+
+
+class LogStep(object):
+    """
+    Log writing into a temporary directory, flushed every LOG_FLUSH_EVERY
+    frames; close() removes the directory.
+    """
+
+    def __init__(self, frames):
+        from log import Log
+
+        self.frames = frames
+        self.directory = tempfile.mkdtemp(prefix="tld_bench_")
+        self.log = Log("benchmark", "town01", os.path.join(self.directory, ""))
+        self.count = 0
+
+    def __call__(self, i):
+        boxes = self.frames.boxes[i]
+        self.log.getFrameData(self.frames.frames[i], self.count, [[x0, x1, y0, y1] for y0, y1, x0, x1 in boxes],
+                              ["GREEN"] * len(boxes))
+        self.count += 1
+        if self.count % LOG_FLUSH_EVERY == 0:
+            self.log.recDataCSV()
+
+    def close(self):
+        self.log.recDataCSV()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+STEPS = OrderedDict([
+    ("render", step_render),
+    ("letterbox", step_letterbox),
+    ("image_preporcess", step_image_preporcess),
+    ("inference", step_inference),
+    ("postprocess", step_postprocess),
+    ("postprocess_nms", step_postprocess_nms),
+    ("classify_lights", step_classify_lights),
+    ("get_state", step_get_state),
+    ("process_traffic_light", step_process_traffic_light),
+    ("log", LogStep),
+])
+
+
+# ==============================================================================
+# -- running and comparing -----------------------------------------------------
+# ==============================================================================
+
+
+def time_step(run, count, iterations, warmup=2):
+    """
+    Calls run on the frame indices in turn. Returns the statistics of the
+    timed iterations; a close() of run is called untimed at the end.
+    """
+    for i in range(warmup):
+        run(i % count)
+    ms = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        run(i % count)
+        ms[i] = (time.perf_counter() - start) * 1000.0
+    if hasattr(run, "close"):
+        run.close()
+    return {"fps": 1000.0 * iterations / ms.sum(), "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)), "p99_ms": float(np.percentile(ms, 99)),
+            "iterations": iterations}
+
+
+def run_suite(steps=None, sizes=SIZES, frames=None, count=8, iterations=50):
+    """
+    Runs the named steps (all by default) at every (width, height) of sizes
+    on synthetic frames or count frames of a replay source. Returns the
+    JSON-ready report.
+    """
+    results = OrderedDict()
+    skipped = OrderedDict()
+    for width, height in sizes:
+        frame_set = (synthetic_frames(width, height, count) if frames is None
+                     else recorded_frames(frames, width, height, count))
+        for name in steps or STEPS:
+            key = "{}@{}x{}".format(name, width, height)
+            try:
+                run = STEPS[name](frame_set)
+            except ImportError as error:
+                skipped[key] = repr(error)
+                continue
+            results[key] = time_step(run, len(frame_set), iterations)
+    return {"commit": git_commit(), "python": platform.python_version(), "frames": frames or "synthetic",
+            "results": results, "skipped": skipped}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Returns (key, baseline fps, fps) of the steps at least tolerance (a
+    fraction) slower than in the baseline report.
+    """
+    slower = []
+    for key, result in report["results"].items():
+        before = baseline["results"].get(key)
+        if before is not None and result["fps"] < before["fps"] * (1.0 - tolerance):
+            slower.append((key, before["fps"], result["fps"]))
+    return slower
+
+
+def print_report(report, baseline=None):
+    print("{:34s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format("step", "fps", "mean ms", "p50 ms", "p99 ms",
+                                                              "change"))
+    for key, result in report["results"].items():
+        before = None if baseline is None else baseline["results"].get(key)
+        change = "" if before is None else "{:+.1%}".format(result["fps"] / before["fps"] - 1.0)
+        print("{:34s} {fps:9.1f} {mean_ms:9.3f} {p50_ms:9.3f} {p99_ms:9.3f} {change:>9s}".format(
+            key, change=change, **result))
+    for key, reason in report["skipped"].items():
+        print("{:34s} skipped: {}".format(key, reason))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--steps", default=None, help="Comma separated steps, all if not given: " + ", ".join(STEPS))
+    ap.add_argument("--sizes", default=",".join("{}x{}".format(w, h) for w, h in SIZES),
+                    help="Comma separated WIDTHxHEIGHT frame sizes")
+    ap.add_argument("--frames", default=None, help="Replay source of recorded frames, synthetic if not given")
+    ap.add_argument("--count", type=int, default=8, help="Distinct frames per size")
+    ap.add_argument("-n", "--iterations", type=int, default=50, help="Timed runs per step and size")
+    ap.add_argument("-o", "--output", default=None, help="JSON file for the results")
+    ap.add_argument("--baseline", default=None, help="JSON results of an earlier commit to compare with")
+    ap.add_argument("--tolerance", type=float, default=0.15,
+                    help="Throughput drop against the baseline that counts as a regression")
+    args = vars(ap.parse_args())
+
+    steps = None if args["steps"] is None else args["steps"].split(",")
+    for name in steps or ():
+        if name not in STEPS:
+            ap.error("unknown step '{}', choose from {}".format(name, ", ".join(STEPS)))
+    sizes = [tuple(int(v) for v in size.split("x")) for size in args["sizes"].split(",")]
+    report = run_suite(steps, sizes, args["frames"], args["count"], args["iterations"])
+
+    baseline = None
+    if args["baseline"] is not None:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args["output"] is not None:
+        with open(args["output"], "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        slower = regressions(report, baseline, args["tolerance"])
+        for key, before, after in slower:
+            print("REGRESSION {}: {:.1f} -> {:.1f} fps (commit {})".format(key, before, after, baseline.get("commit")))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""
+Parallel traffic light data collection over towns, weathers and spawn points.
+
+Every (town, weather preset, spawn point, frame budget) job spawns one car on
+autopilot with one camera, ticks the world for the frame budget and writes
+what it collects to <out>/<job id>/:
+    annotations  detection + Light classification, rows and frames through
+                 Log (the default)
+    frames       every n-th raw frame as frame_N.png plus a frames.csv index,
+                 ready for replay.py (--frames-only)
+With --archive both go into a frames.tlarchive frame archive instead, which
+frame_archive.py exports to the Log layout.
+
+Jobs are spread over worker processes, one per simulator endpoint: a
+"host:port" CARLA server, or "fake" / "fake:<replay source>" for an
+in-process fake_carla server. Workers run under optional memory, CPU time,
+niceness and CPU affinity limits. The state of every job is kept in a JSON
+file that is rewritten atomically after each job, so an interrupted run picks
+up where it stopped; finished jobs are skipped, failed ones retried up to
+--max-attempts times.
+
+    python collect.py --towns 1,2,3 --weathers ClearNoon,WetNoon \\
+        --spawn-points 0,10 --frames 500 --endpoints 127.0.0.1:2000,127.0.0.1:2002
+    python collect.py --endpoints fake,fake --frames-only --frames 50
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import detector
+from backends import BACKENDS, TF1Backend
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+TOWNS = ["Town01", "Town02", "Town03", "Town04", "Town05"]
+
+
+class CollectionJob(namedtuple("CollectionJob", ["town", "weather", "spawn_point", "frames"])):
+    """
+    One collection run. spawn_point indexes the map's spawn points.
+    """
+
+    @property
+    def job_id(self):
+        return "{}_{}_{}".format(self.town, self.weather, self.spawn_point)
+
+
+def make_jobs(towns, weathers, spawn_points, frames):
+    """
+    Returns the jobs of every combination of town, weather and spawn point.
+    """
+    return [CollectionJob(town, weather, spawn_point, frames)
+            for town in towns for weather in weathers for spawn_point in spawn_points]
+
+
+def town_name(value):
+    """
+    Accepts 1-5 like loadTown() or a map name.
+    """
+    if value.isdigit():
+        return TOWNS[int(value) - 1] if 1 <= int(value) <= len(TOWNS) else TOWNS[0]
+    return value
+
+
+# ==============================================================================
+# -- job state -----------------------------------------------------------------
+# ==============================================================================
+
+
+class JobState(object):
+    """
+    Status of every job, persisted as JSON after each change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f).get("jobs", {})
+
+    def entry(self, job):
+        entry = self.jobs.setdefault(job.job_id, {"status": PENDING, "attempts": 0})
+        entry.update(job._asdict())
+        return entry
+
+    def pending(self, jobs, max_attempts):
+        """
+        Returns the jobs neither finished nor out of attempts.
+        """
+        pending = []
+        for job in jobs:
+            entry = self.entry(job)
+            if entry["status"] != DONE and entry["attempts"] < max_attempts:
+                pending.append(job)
+        return pending
+
+    def finish(self, job, result):
+        entry = self.entry(job)
+        entry["attempts"] += 1
+        entry["status"] = DONE
+        entry["result"] = result
+        entry.pop("error", None)
+        self.save()
+
+    def fail(self, job, error):
+        entry = self.entry(job)
+        entry["attempts"] += 1
+        entry["status"] = FAILED
+        entry["error"] = error
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # Write next to the state file and rename, a crash never leaves half a file.
+        partial = self.path + ".partial"
+        with open(partial, "w") as f:
+            json.dump({"jobs": self.jobs, "updated": time.time()}, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.path)
+
+
+# ==============================================================================
+# -- worker --------------------------------------------------------------------
+# ==============================================================================
+
+
+def apply_limits(memory_mb=None, cpu_seconds=None, niceness=0, cpus=None):
+    """
+    Limits the calling process. cpus is a list of CPU ids to pin it to.
+    """
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if cpu_seconds:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    if niceness:
+        os.nice(niceness)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+
+def connect(endpoint, width, height, timeout=10.0):
+    """
+    Returns (client, carla module) for "host:port", "fake" or
+    "fake:<replay source>".
+    """
+    if endpoint == "fake" or endpoint.startswith("fake:"):
+        import fake_carla
+
+        path = endpoint[len("fake:"):]
+        if path:
+            from replay import open_source
+            source_factory = lambda town: open_source(path)
+        else:
+            source_factory = lambda town: fake_carla.SyntheticSource(width, height)
+        return fake_carla.Client(source_factory=source_factory), fake_carla
+
+    import carla
+
+    host, port = endpoint.rsplit(":", 1)
+    client = carla.Client(host, int(port))
+    client.set_timeout(timeout)
+    return client, carla
+
+
+class Collector(object):
+    """
+    Runs collection jobs against one endpoint. The detection backend is built
+    on the first annotated job and reused by the following ones.
+    """
+
+    def __init__(self, endpoint, options):
+        self.endpoint = endpoint
+        self.options = options
+        self.backend = None
+        self.postprocess = None
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
+    def detection(self):
+        if self.backend is None:
+            from backends import make_backend
+            from postprocess import ClassFilteredPostprocessor
+
+            options = self.options
+            self.backend = make_backend(options["backend"], options["model"], 80, options["intra_op_threads"],
+                                        options["inter_op_threads"])
+            self.postprocess = ClassFilteredPostprocessor(options["input_size"],
+                                                          (detector.TRAFFIC_LIGHT_CLASS,))
+        return self.backend, self.postprocess
+
+    def run(self, job):
+        """
+        Collects one job and returns its result dict.
+        """
+        from frame_convert import FrameConverter
+        from dataset_writer import StreamingDatasetWriter
+        from frame_sync import FrameSync
+        from frame_archive import FrameArchiveWriter
+
+        options = self.options
+        job_dir = os.path.join(options["out"], job.job_id) + os.sep
+        client, carla = connect(self.endpoint, options["width"], options["height"])
+        client.load_world(job.town)
+        world = client.get_world()
+        world.set_weather(getattr(carla.WeatherParameters, job.weather))
+
+        car = None
+        camera = None
+        settings = None
+        light = None
+        writer = None
+        archive = None
+        converter = None
+        frames = 0
+        recorded = 0
+        detections = 0
+        start = time.perf_counter()
+        try:
+            blueprints = world.get_blueprint_library()
+            spawn_points = world.get_map().get_spawn_points()
+            car = world.spawn_actor(blueprints.filter('vehicle.*')[0],
+                                    spawn_points[job.spawn_point % len(spawn_points)])
+            camera_bp = blueprints.find('sensor.camera.rgb')
+            camera_bp.set_attribute('image_size_x', str(options["width"]))
+            camera_bp.set_attribute('image_size_y', str(options["height"]))
+            camera_bp.set_attribute('fov', str(90))
+            camera_transform = carla.Transform(carla.Location(x=1.6, z=1.7), carla.Rotation(pitch=0))
+            camera = world.spawn_actor(camera_bp, camera_transform, attach_to=car)
+            images = FrameSync()
+            camera.listen(images.put)
+            car.set_autopilot(True)
+
+            settings = world.get_settings()
+            settings.synchronous_mode = True
+            world.apply_settings(settings)
+
+            archive_path = job_dir + "frames.tlarchive"
+            if options["archive"] and os.path.exists(archive_path):
+                # Left behind by a failed attempt of this job.
+                shutil.rmtree(archive_path)
+            if options["frames_only"] and not options["archive"]:
+                writer = StreamingDatasetWriter(job_dir + "frames.csv", ["Filename", "Town", "Weather", "Frame"])
+            elif not options["frames_only"]:
+                from traffic_light import Light
+                backend, postprocess = self.detection()
+                light = Light(job.town, show=False, base_dir=job_dir)
+
+            start = time.perf_counter()
+            for tick in range(job.frames):
+                frame_id = world.tick()
+                if frame_id is None:
+                    # A replayed source ran out of frames.
+                    break
+                image = images.wait_for(frame_id, 10.0)
+                if image is None:
+                    raise RuntimeError("no camera image for frame {}".format(frame_id))
+                frames += 1
+                if tick % options["every"] != 0:
+                    continue
+
+                if converter is None:
+                    converter = FrameConverter(image.width, image.height, options["input_size"])
+                    if options["archive"]:
+                        archive = FrameArchiveWriter(archive_path, image.width, image.height,
+                                                     compression=options["archive_compression"])
+                data = converter.convert(image.raw_data)
+                if light is None and archive is not None:
+                    archive.append(data["frame"], image.frame, town=job.town, weather=job.weather)
+                    recorded += 1
+                    continue
+                if writer is not None:
+                    file_name = "frame_{}.png".format(image.frame)
+                    writer.write_image(job_dir + file_name, data["frame"].copy())
+                    writer.write_row([file_name, job.town, job.weather, image.frame])
+                    recorded += 1
+                    continue
+
+                data = postprocess(backend(converter.letterbox(data)))
+                detections += len(data["bboxes"])
+                light.process_traffic_light(data["frame"], data["bboxes"])
+                labelled = [l for l in light.lights if l.label is not None]
+                if archive is not None:
+                    archive.append(data["frame"], image.frame, [l.bbox for l in labelled],
+                                   [l.label for l in labelled], job.town, job.weather)
+                    recorded += len(labelled)
+                elif labelled:
+                    # The Log writes the frame in the background, the slot is reused.
+                    frame = data["frame"].copy()
+                    for classified in labelled:
+                        x0, y0, x1, y1 = classified.bbox
+                        light.getData(frame, image.frame, [x0, x1, y0, y1], classified.label)
+                        recorded += 1
+        finally:
+            elapsed = time.perf_counter() - start
+            if writer is not None:
+                writer.close()
+            if archive is not None:
+                archive.close()
+            if light is not None:
+                light.recDataCSV()
+            if settings is not None:
+                settings.synchronous_mode = False
+                world.apply_settings(settings)
+            if camera is not None:
+                camera.stop()
+                camera.destroy()
+            if car is not None:
+                car.destroy()
+
+        return {
+            "job_id": job.job_id,
+            "endpoint": self.endpoint,
+            "town": job.town,
+            "frames": frames,
+            "recorded": recorded,
+            "detections": detections,
+            "seconds": elapsed,
+            "fps": frames / elapsed if elapsed > 0 else 0.0,
+            "pid": os.getpid(),
+        }
+
+
+_collector = None
+_started = None
+
+
+def _init_worker(endpoints, started, options, limits):
+    global _collector, _started
+    # Every worker process owns one endpoint for its lifetime.
+    endpoint, cpus = endpoints.get()
+    apply_limits(limits["memory_mb"], limits["cpu_seconds"], limits["niceness"], cpus)
+    _collector = Collector(endpoint, options)
+    _started = started
+
+
+def _run_job(job):
+    # A SimpleQueue writes before returning, the marker survives a crash.
+    _started.put(job.job_id)
+    return _collector.run(job)
+
+
+# ==============================================================================
+# -- orchestrator --------------------------------------------------------------
+# ==============================================================================
+
+
+def cpu_sets(workers, cpus_per_worker):
+    """
+    Splits the available CPUs into disjoint sets of cpus_per_worker, None for
+    no pinning.
+    """
+    if not cpus_per_worker or not hasattr(os, "sched_getaffinity"):
+        return [None] * workers
+    available = sorted(os.sched_getaffinity(0))
+    return [available[(i * cpus_per_worker) % len(available):][:cpus_per_worker] or None for i in range(workers)]
+
+
+def orchestrate(jobs, endpoints, options, limits, state, max_attempts=2):
+    """
+    Runs the pending jobs on one worker process per endpoint until every job
+    is done or out of attempts. A crashed worker (e.g. killed for exceeding
+    its CPU limit) fails the jobs in flight and the pool is restarted; jobs
+    that had not started yet are run again without losing an attempt.
+    Returns the results of the jobs finished by this run and the wall-clock
+    seconds spent.
+    """
+    start = time.time()
+    results = []
+    context = multiprocessing.get_context()
+    while True:
+        pending = state.pending(jobs, max_attempts)
+        if not pending:
+            break
+        claims = context.Queue()
+        for endpoint, cpus in zip(endpoints, cpu_sets(len(endpoints), limits["cpus_per_worker"])):
+            claims.put((endpoint, cpus))
+        print("{} jobs on {} workers".format(len(pending), len(endpoints)))
+
+        started = context.SimpleQueue()
+        executor = ProcessPoolExecutor(len(endpoints), context, _init_worker, (claims, started, options, limits))
+        futures = {executor.submit(_run_job, job): job for job in pending}
+        crashed = []
+        try:
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as error:
+                    # Every unfinished job lands here, started or not.
+                    crashed.append((job, error))
+                    continue
+                except Exception as error:
+                    state.fail(job, repr(error))
+                    print("{} failed: {!r}".format(job.job_id, error))
+                    continue
+                state.finish(job, result)
+                results.append(result)
+                print("{job_id}: {frames} frames, {recorded} recorded, {fps:.1f} FPS on {endpoint}".format(**result))
+        finally:
+            executor.shutdown(wait=True)
+        if crashed:
+            in_flight = set()
+            while not started.empty():
+                in_flight.add(started.get())
+            for job, error in crashed:
+                # A worker crashing before any job started fails them all,
+                # or the pool would be restarted forever.
+                if job.job_id in in_flight or not in_flight:
+                    state.fail(job, "worker crashed: {!r}".format(error))
+            print("a worker crashed, restarting the pool")
+    return results, time.time() - start
+
+
+def summarize(results, wall_seconds):
+    """
+    Aggregates job results overall, per endpoint and per town.
+    """
+    summary = {"jobs": len(results), "wall_seconds": wall_seconds, "per_endpoint": {}, "per_town": {}}
+    for key in ("frames", "recorded", "detections", "seconds"):
+        summary[key] = sum(result[key] for result in results)
+    summary["fps"] = summary["frames"] / wall_seconds if wall_seconds > 0 else 0.0
+    for group, field in (("per_endpoint", "endpoint"), ("per_town", "town")):
+        for result in results:
+            stats = summary[group].setdefault(result[field], {"jobs": 0, "frames": 0, "recorded": 0, "seconds": 0.0})
+            stats["jobs"] += 1
+            stats["frames"] += result["frames"]
+            stats["recorded"] += result["recorded"]
+            stats["seconds"] += result["seconds"]
+        for stats in summary[group].values():
+            stats["fps"] = stats["frames"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    return summary
+
+
+def print_summary(summary):
+    print("{jobs} jobs  {frames} frames  {recorded} recorded  {wall_seconds:.1f} s  {fps:.1f} FPS overall".format(
+        **summary))
+    for group in ("per_endpoint", "per_town"):
+        for name, stats in sorted(summary[group].items()):
+            print("  {:24s} {jobs:4d} jobs {frames:7d} frames {recorded:7d} recorded {fps:8.1f} FPS".format(
+                name, **stats))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--towns", default="1", help="Comma separated towns, 1-5 or map names")
+    ap.add_argument("--weathers", default="ClearNoon", help="Comma separated carla.WeatherParameters presets")
+    ap.add_argument("--spawn-points", default="0", help="Comma separated spawn point indices")
+    ap.add_argument("--frames", type=int, default=500, help="Frame budget of every job")
+    ap.add_argument("--every", type=int, default=1, help="Record every n-th frame")
+    ap.add_argument("--endpoints", default="127.0.0.1:2000",
+                    help="Comma separated host:port, fake or fake:<replay source>, one worker each")
+    ap.add_argument("--out", default="Dataset/", help="Output directory, one subdirectory per job")
+    ap.add_argument("--state", default=None, help="Job state file, defaults to <out>/collect_state.json")
+    ap.add_argument("--max-attempts", type=int, default=2, help="Runs of a failing job before giving up")
+    ap.add_argument("--frames-only", action="store_true", help="Save raw frames instead of annotations")
+    ap.add_argument("--archive", action="store_true",
+                    help="Record into a frame archive per job instead of PNG files (see frame_archive.py)")
+    ap.add_argument("--archive-compression", choices=["zlib"], default=None,
+                    help="Compress full archive chunks")
+    ap.add_argument("-wi", "--width", type=int, default=640, help="Camera width")
+    ap.add_argument("-he", "--height", type=int, default=480, help="Camera height")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name, help="Inference backend")
+    ap.add_argument("--model", default=None, help="Model file of the backend")
+    ap.add_argument("--intra-op-threads", type=int, default=0, help="Threads inside one operator per worker")
+    ap.add_argument("--inter-op-threads", type=int, default=0, help="Operators run in parallel per worker")
+    ap.add_argument("--memory-mb", type=int, default=None, help="Address space limit per worker")
+    ap.add_argument("--cpu-seconds", type=int, default=None, help="CPU time limit per worker")
+    ap.add_argument("--nice", type=int, default=0, help="Niceness added to the workers")
+    ap.add_argument("--cpus-per-worker", type=int, default=0, help="Pin every worker to this many CPUs")
+    ap.add_argument("--json", default=None, help="Write the summary to this file")
+    args = vars(ap.parse_args())
+
+    jobs = make_jobs([town_name(t) for t in args["towns"].split(",")], args["weathers"].split(","),
+                     [int(p) for p in args["spawn_points"].split(",")], args["frames"])
+    options = {key: args[key] for key in ("out", "every", "frames_only", "archive", "archive_compression", "width", "height", "input_size",
+                                          "backend", "model", "intra_op_threads", "inter_op_threads")}
+    options["every"] = max(1, options["every"])
+    limits = {"memory_mb": args["memory_mb"], "cpu_seconds": args["cpu_seconds"], "niceness": args["nice"],
+              "cpus_per_worker": args["cpus_per_worker"]}
+
+    os.makedirs(args["out"], exist_ok=True)
+    state = JobState(args["state"] or os.path.join(args["out"], "collect_state.json"))
+    done_before = sum(state.entry(job)["status"] == DONE for job in jobs)
+    results, wall_seconds = orchestrate(jobs, args["endpoints"].split(","), options, limits, state,
+                                        args["max_attempts"])
+
+    summary = summarize(results, wall_seconds)
+    summary["done_before"] = done_before
+    failed = [job.job_id for job in jobs if state.entry(job)["status"] != DONE]
+    summary["failed"] = failed
+    print_summary(summary)
+    if done_before:
+        print("{} jobs were already done".format(done_before))
+    if failed:
+        print("failed: {}".format(", ".join(failed)))
+    if args["json"] is not None:
+        with open(args["json"], "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Append-only, streaming writer for traffic light datasets.
+
+Rows are buffered up to batch_size and written together, at the latest every
+flush_interval seconds. Every flush ends with an fsync, so after a crash the
+CSV holds every flushed row and no partial one. Images are encoded and saved
+by a small thread pool; at most max_pending_images wait in memory, further
+calls block until a worker is free. Memory use is therefore bounded no matter
+how long a collection run lasts.
+"""
+
+import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+class StreamingDatasetWriter(object):
+    """
+    Writes CSV rows in bounded batches and images on background workers.
+    Appends to an existing CSV, the header is only written to a new file.
+    """
+
+    def __init__(self, csv_path, header, batch_size=64, flush_interval=5.0, workers=2,
+                 max_pending_images=32, delimiter=";"):
+        self.csv_path = csv_path
+        self.header = list(header)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.images_written = 0
+        self.image_errors = 0
+
+        directory = os.path.dirname(csv_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_file = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        self._file = open(csv_path, "a", newline="")
+        self._writer = csv.writer(self._file, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
+        if new_file:
+            self._writer.writerow(self.header)
+            self._sync()
+
+        self._rows = []
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending_images)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_row(self, row):
+        """
+        Buffers one row, a sequence ordered like the header or a dict keyed
+        by header names.
+        """
+        if isinstance(row, dict):
+            row = [row[name] for name in self.header]
+        with self._lock:
+            self._rows.append(row)
+            due = len(self._rows) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def write_image(self, path, image, block=True):
+        """
+        Saves image to path on a worker thread. The caller must not modify
+        image afterwards. Blocks while max_pending_images are queued, or
+        returns False without saving if block is False.
+        """
+        if not self._slots.acquire(blocking=block):
+            return False
+        try:
+            self._pool.submit(self._save, path, image)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        return True
+
+    def _save(self, path, image):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Write next to the target and rename, so readers never see a
+            # truncated image.
+            root, extension = os.path.splitext(path)
+            partial = root + ".partial" + extension
+            if cv2.imwrite(partial, image):
+                os.replace(partial, path)
+                self.images_written += 1
+            else:
+                self.image_errors += 1
+        except Exception as error:
+            self.image_errors += 1
+            print("cannot write {}: {!r}".format(path, error))
+        finally:
+            self._slots.release()
+
+    def flush(self):
+        """
+        Writes the buffered rows and syncs them to disk.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if rows:
+                self._writer.writerows(rows)
+                self.rows_written += len(rows)
+            self._sync()
+            self._last_flush = time.time()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Flushes the rows and waits for pending images.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._pool.shutdown(wait=True)
+        self.flush()
+        self._file.close()
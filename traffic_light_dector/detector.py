@@ -0,0 +1,54 @@
+"""
+YOLOv3 detection steps of BasicSynchronousClient.game_loop.
+
+Each step reads and extends a frame dict, so the same code runs inline in the
+serial loop or as a pipeline.Stage in the pipelined mode. preprocess and
+postprocess are module level functions so they can be pickled to a process
+pool. Inference is done by a backends.InferenceBackend, which holds the model
+and must stay in a thread.
+
+Frame dict keys:
+    frame       BGR frame handed to Light
+    image       RGB frame fed to the network preprocessing
+    frame_size  (height, width) of image
+    image_data  letterboxed network input with a leading batch axis
+    pred_bbox   raw predictions of the three scales, shape (-1, 5 + num_classes)
+    bboxes      detections after score filtering and NMS
+"""
+
+import numpy as np
+
+RETURN_ELEMENTS = ["input/input_data:0", "pred_sbbox/concat_2:0", "pred_mbbox/concat_2:0", "pred_lbbox/concat_2:0"]
+SCORE_THRESHOLD = 0.3
+IOU_THRESHOLD = 0.45
+# Score a traffic light detection needs to be classified (Light.score_th).
+LIGHT_SCORE_THRESHOLD = 0.5
+# "traffic light" in the COCO class names of the frozen graph
+TRAFFIC_LIGHT_CLASS = 9
+
+
+def _utils():
+    # Imported on first use, the module loads TensorFlow, which the other
+    # backends and the class-filtered postprocessing do not need.
+    import tensorflow_yolov3.carla.utils as utils
+    return utils
+
+
+def preprocess(data, input_size):
+    """
+    Letterboxes data["image"] into data["image_data"].
+    """
+    data["frame_size"] = data["image"].shape[:2]
+    image_data = _utils().image_preporcess(np.copy(data["image"]), [input_size, input_size])
+    data["image_data"] = image_data[np.newaxis, ...]
+    return data
+
+
+def postprocess(data, input_size, score_threshold=SCORE_THRESHOLD, iou_threshold=IOU_THRESHOLD):
+    """
+    Decodes data["pred_bbox"] into frame coordinates and applies NMS.
+    """
+    utils = _utils()
+    bboxes = utils.postprocess_boxes(data["pred_bbox"], data["frame_size"], input_size, score_threshold)
+    data["bboxes"] = utils.nms(bboxes, iou_threshold, method='nms')
+    return data
@@ -0,0 +1,204 @@
+"""
+Display sinks for processed frames and traffic light crops.
+
+game_loop and Light hand every frame dict (see detector.py) and every crop
+to a sink instead of calling pygame or HighGUI directly, so a headless run
+uses NullSink and does no GUI work at all. Every sink measures the time it
+spends, cost_ms() returns the mean per shown frame.
+
+    NullSink      shows nothing
+    PygameSink    blits the frame, draws the boxes and flips the pygame display
+    Cv2Sink       shows a resized frame and the crops in HighGUI windows
+    EveryNthSink  forwards only every n-th frame to another sink
+    MultiSink     forwards to several sinks
+"""
+
+import time
+
+
+class DisplaySink(object):
+    """
+    Base sink. show() returns True when the user asked to quit, show_crop()
+    returns the pressed key code or None.
+    """
+
+    name = "null"
+
+    def __init__(self):
+        self.frames = 0
+        self.crops = 0
+        self.seconds = 0.0
+
+    def show(self, data):
+        start = time.perf_counter()
+        try:
+            return self._show(data)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.frames += 1
+
+    def show_crop(self, crop):
+        start = time.perf_counter()
+        try:
+            return self._show_crop(crop)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.crops += 1
+
+    def cost_ms(self):
+        """
+        Mean milliseconds spent per shown frame, crops included.
+        """
+        return self.seconds * 1000.0 / self.frames if self.frames else 0.0
+
+    def close(self):
+        pass
+
+    def _show(self, data):
+        return False
+
+    def _show_crop(self, crop):
+        return None
+
+
+class NullSink(DisplaySink):
+    name = "null"
+
+
+class PygameSink(DisplaySink):
+    """
+    Shows data["image"] and its boxes on a pygame display surface of the same
+    size. draw is utils.draw_bounding_boxes or a function with its signature.
+    """
+
+    name = "pygame"
+
+    def __init__(self, display, draw=None):
+        DisplaySink.__init__(self)
+        import pygame
+        self.pygame = pygame
+        self.display = display
+        self.draw = draw
+
+    def _show(self, data):
+        self.pygame.surfarray.blit_array(self.display, data["image"].swapaxes(0, 1))
+        if self.draw is not None:
+            self.draw(self.pygame, self.display, data["image"], data["bboxes"])
+        self.pygame.display.flip()
+        return False
+
+
+class Cv2Sink(DisplaySink):
+    """
+    Shows the BGR frame resized to size in a HighGUI window and the crops next
+    to their color masks. Pressing quit_key closes the loop.
+    """
+
+    name = "cv2"
+
+    def __init__(self, size=(800, 600), interpolation=None, window="Pygame", quit_key="q"):
+        DisplaySink.__init__(self)
+        import cv2
+        from light_classifier import mask_colors
+        self.cv2 = cv2
+        self.mask_colors = mask_colors
+        self.size = size
+        self.interpolation = interpolation if interpolation is not None else cv2.INTER_AREA
+        self.window = window
+        self.quit_key = ord(quit_key)
+
+    def _show(self, data):
+        frame = data["frame"]
+        if self.size is not None:
+            frame = self.cv2.resize(frame, self.size, interpolation=self.interpolation)
+        self.cv2.imshow(self.window, frame)
+        return self.cv2.waitKey(1) & 0xFF == self.quit_key
+
+    def _show_crop(self, crop):
+        self.cv2.imshow("Traffic Light", crop)
+        self.cv2.imshow("Traffic Light COLOR", self.mask_colors(crop))
+        return self.cv2.waitKey(1) & 0xFF
+
+    def close(self):
+        self.cv2.destroyAllWindows()
+
+
+class EveryNthSink(DisplaySink):
+    """
+    Forwards one frame out of every n, and the crops of that frame, to sink.
+    """
+
+    def __init__(self, sink, n):
+        DisplaySink.__init__(self)
+        self.sink = sink
+        self.n = max(1, n)
+        self.name = "{}/{}".format(sink.name, self.n)
+        self._forward = True
+
+    def set_every(self, n):
+        """
+        Changes the cadence at runtime, from the next frame on.
+        """
+        self.n = max(1, n)
+        self.name = "{}/{}".format(self.sink.name, self.n)
+
+    def _show(self, data):
+        # Frames are shown after their crops, so the decision made here
+        # applies to the crops of the next frame.
+        quit = self.sink.show(data) if self._forward else False
+        self._forward = (self.frames + 1) % self.n == 0
+        return quit
+
+    def _show_crop(self, crop):
+        return self.sink.show_crop(crop) if self._forward else None
+
+    def close(self):
+        self.sink.close()
+
+
+class MultiSink(DisplaySink):
+    """
+    Forwards to every sink. The first non-None crop key wins.
+    """
+
+    def __init__(self, sinks):
+        DisplaySink.__init__(self)
+        self.sinks = sinks
+        self.name = "+".join(sink.name for sink in sinks)
+
+    def _show(self, data):
+        quit = False
+        for sink in self.sinks:
+            quit = sink.show(data) or quit
+        return quit
+
+    def _show_crop(self, crop):
+        key = None
+        for sink in self.sinks:
+            sink_key = sink.show_crop(crop)
+            if key is None:
+                key = sink_key
+        return key
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def make_sink(kind, display=None, draw=None, every=1):
+    """
+    Builds the sink selected on the command line: "pygame", "cv2", "both" or
+    "none", optionally thinned out to every n-th frame.
+    """
+    if kind == "none":
+        return NullSink()
+    sinks = []
+    if kind in ("pygame", "both"):
+        sinks.append(PygameSink(display, draw))
+    if kind in ("cv2", "both"):
+        sinks.append(Cv2Sink())
+    sink = sinks[0] if len(sinks) == 1 else MultiSink(sinks)
+    return EveryNthSink(sink, every) if every > 1 else sink
+
+
+DISPLAY_KINDS = ("both", "pygame", "cv2", "none")
@@ -0,0 +1,322 @@
+"""
+Local stand-in for the parts of the CARLA API the client uses.
+
+FakeWorld replays frames from a frame source (see replay.py) through the same
+calls a synchronous carla.World offers: tick() advances the frame number and
+delivers the next image to every camera listening on it. Images expose
+frame, transform, width, height and a BGRA raw_data buffer like carla.Image.
+
+FakeClient stands in for carla.Client and a server: load_world() starts a new
+FakeWorld on the frames of source_factory(town), synthetic traffic light
+frames by default. The module also defines Client, Transform, Location,
+Rotation and WeatherParameters, so it can be used in place of the carla
+module (see collect.py).
+"""
+
+import itertools
+
+import cv2
+
+
+class Location(object):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Rotation(object):
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = pitch
+        self.yaw = yaw
+        self.roll = roll
+
+
+class Transform(object):
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+
+class FakeWeather(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "FakeWeather({})".format(self.name)
+
+
+class WeatherParameters(object):
+    """
+    The weather presets of carla.WeatherParameters.
+    """
+
+
+for _preset in ["ClearNoon", "CloudyNoon", "WetNoon", "WetCloudyNoon", "MidRainyNoon", "HardRainNoon",
+                "SoftRainNoon", "ClearSunset", "CloudySunset", "WetSunset", "WetCloudySunset",
+                "MidRainSunset", "HardRainSunset", "SoftRainSunset"]:
+    setattr(WeatherParameters, _preset, FakeWeather(_preset))
+
+
+class FakeImage(object):
+    """
+    Mirrors the attributes of carla.Image used by the client.
+    """
+
+    def __init__(self, frame, bgr, transform=None):
+        self.frame = frame
+        self.transform = transform if transform is not None else Transform()
+        self.height, self.width = bgr.shape[:2]
+        self.raw_data = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA).tobytes()
+        self.fov = 90.0
+
+
+class FakeControl(object):
+    """
+    Mirrors carla.VehicleControl.
+    """
+
+    def __init__(self):
+        self.throttle = 0.0
+        self.steer = 0.0
+        self.brake = 0.0
+        self.hand_brake = False
+        self.reverse = False
+
+
+class FakeActor(object):
+    def __init__(self, world, blueprint, transform=None, parent=None):
+        self.id = world.next_actor_id()
+        self.type_id = blueprint.id
+        self.attributes = dict(blueprint.attributes)
+        self.transform = transform
+        self.parent = parent
+        self.is_alive = True
+        self._world = world
+
+    def get_transform(self):
+        return self.transform
+
+    def destroy(self):
+        self.is_alive = False
+        self._world.remove_actor(self)
+        return True
+
+
+class FakeVehicle(FakeActor):
+    def __init__(self, world, blueprint, transform=None, parent=None):
+        FakeActor.__init__(self, world, blueprint, transform, parent)
+        self._control = FakeControl()
+        self.autopilot = False
+
+    def get_control(self):
+        return self._control
+
+    def apply_control(self, control):
+        self._control = control
+
+    def set_autopilot(self, enabled=True):
+        self.autopilot = enabled
+
+    def get_velocity(self):
+        return Location()
+
+
+class FakeCamera(FakeActor):
+    def __init__(self, world, blueprint, transform=None, parent=None):
+        FakeActor.__init__(self, world, blueprint, transform, parent)
+        self._callback = None
+
+    @property
+    def is_listening(self):
+        return self._callback is not None
+
+    def listen(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def deliver(self, image):
+        if self._callback is not None:
+            self._callback(image)
+
+
+class FakeBlueprint(object):
+    def __init__(self, blueprint_id):
+        self.id = blueprint_id
+        self.attributes = {}
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class FakeBlueprintLibrary(object):
+    blueprint_ids = ["sensor.camera.rgb", "vehicle.audi.a2", "vehicle.tesla.model3"]
+
+    def find(self, blueprint_id):
+        if blueprint_id not in self.blueprint_ids:
+            raise IndexError("blueprint '{}' not found".format(blueprint_id))
+        return FakeBlueprint(blueprint_id)
+
+    def filter(self, pattern):
+        prefix = pattern.rstrip("*")
+        return [FakeBlueprint(b) for b in self.blueprint_ids if b.startswith(prefix)]
+
+
+class FakeSettings(object):
+    def __init__(self):
+        self.synchronous_mode = False
+        self.fixed_delta_seconds = None
+        self.no_rendering_mode = False
+
+
+class FakeMap(object):
+    def __init__(self, name, spawn_points=None):
+        self.name = name
+        self._spawn_points = spawn_points if spawn_points is not None else [None]
+
+    def get_spawn_points(self):
+        return list(self._spawn_points)
+
+
+class FakeWorld(object):
+    """
+    Synchronous world whose camera frames come from a frame source.
+    tick() returns the new frame number, or None once the source is exhausted.
+    """
+
+    def __init__(self, source, map_name="Town01", first_frame=0, spawn_points=None):
+        self._frames = iter(source)
+        self._frame = first_frame
+        self._next_actor_id = 0
+        self._settings = FakeSettings()
+        self._map = FakeMap(map_name, spawn_points)
+        self.actors = []
+        self.weather = None
+        self.exhausted = False
+
+    def next_actor_id(self):
+        self._next_actor_id += 1
+        return self._next_actor_id
+
+    def remove_actor(self, actor):
+        if actor in self.actors:
+            self.actors.remove(actor)
+
+    def get_settings(self):
+        return self._settings
+
+    def apply_settings(self, settings):
+        self._settings = settings
+        return self._frame
+
+    def get_blueprint_library(self):
+        return FakeBlueprintLibrary()
+
+    def get_map(self):
+        return self._map
+
+    def set_weather(self, weather):
+        self.weather = weather
+
+    def get_weather(self):
+        return self.weather
+
+    def spawn_actor(self, blueprint, transform=None, attach_to=None):
+        if blueprint.id.startswith("sensor.camera"):
+            actor = FakeCamera(self, blueprint, transform, attach_to)
+        elif blueprint.id.startswith("vehicle."):
+            actor = FakeVehicle(self, blueprint, transform, attach_to)
+        else:
+            actor = FakeActor(self, blueprint, transform, attach_to)
+        self.actors.append(actor)
+        return actor
+
+    def try_spawn_actor(self, blueprint, transform=None, attach_to=None):
+        return self.spawn_actor(blueprint, transform, attach_to)
+
+    def get_actors(self):
+        return list(self.actors)
+
+    def tick(self, seconds=None):
+        try:
+            bgr = next(self._frames)
+        except StopIteration:
+            self.exhausted = True
+            return None
+        self._frame += 1
+        image = FakeImage(self._frame, bgr)
+        for actor in self.actors:
+            if isinstance(actor, FakeCamera):
+                actor.deliver(image)
+        return self._frame
+
+
+# ==============================================================================
+# -- FakeClient ----------------------------------------------------------------
+# ==============================================================================
+
+
+class SyntheticSource(object):
+    """
+    Yields dark BGR frames with a few lit traffic lights, cycling through
+    variants frames, forever unless frames is given.
+    """
+
+    def __init__(self, width=640, height=480, lights=3, variants=8, frames=None, seed=0):
+        from light_classifier import synthetic_frame
+        self.images = [synthetic_frame(width, height, lights, seed=seed + i)[0] for i in range(variants)]
+        self.frames = frames
+
+    def __iter__(self):
+        images = itertools.cycle(self.images)
+        if self.frames is not None:
+            images = itertools.islice(images, self.frames)
+        return images
+
+
+class FakeClient(object):
+    """
+    Mirrors the carla.Client calls of the client and the collection workers.
+    source_factory(town) returns the frame source of a newly loaded world.
+    """
+
+    towns = ["Town01", "Town02", "Town03", "Town04", "Town05"]
+
+    def __init__(self, host="127.0.0.1", port=2000, source_factory=None, spawn_points=20):
+        self.host = host
+        self.port = port
+        self.timeout = None
+        self.source_factory = source_factory if source_factory is not None else lambda town: SyntheticSource()
+        self.spawn_points = [Transform(Location(x=10.0 * i)) for i in range(spawn_points)]
+        self.world = None
+        self.load_world(self.towns[0])
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def get_server_version(self):
+        return "fake"
+
+    def get_client_version(self):
+        return "fake"
+
+    def get_available_maps(self):
+        return ["/Game/Carla/Maps/" + town for town in self.towns]
+
+    def load_world(self, town):
+        town = town.split("/")[-1]
+        if town not in self.towns:
+            raise RuntimeError("map '{}' not found".format(town))
+        self.world = FakeWorld(self.source_factory(town), town, spawn_points=self.spawn_points)
+        return self.world
+
+    def reload_world(self):
+        return self.load_world(self.world.get_map().name)
+
+    def get_world(self):
+        return self.world
+
+
+Client = FakeClient
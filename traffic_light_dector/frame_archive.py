@@ -0,0 +1,320 @@
+"""
+Chunked, memory-mapped archive of recorded frames.
+
+Saving every frame or annotation as a PNG costs 50-100 ms at 1080p and
+leaves thousands of small files behind. A frame archive is a directory:
+    meta.json           width, height, chunk size and compression
+    chunk_00000.npy     (chunk_size, height, width, 3) uint8 BGR frames
+    chunk_00001.npz     a full chunk compressed with np.savez_compressed
+    index.jsonl         one line per frame: archive position, simulator
+                        frame number, town, weather, boxes and labels
+
+FrameArchiveWriter copies each frame into a memory-mapped chunk (one copy, no
+encoding) and appends its index line, so writing is append-only. Full chunks
+are compressed on a background thread when compression is enabled. A crash
+loses at most the index lines not yet flushed; a torn last line is ignored.
+
+FrameArchive reads an archive: frames of uncompressed chunks are zero-copy
+views of the memory map, compressed chunks are decompressed once and cached.
+Iterating over an archive yields its frames, so it is a replay.py source, and
+export_csv() writes its annotations in the CSV layout of Log.
+
+    python frame_archive.py session.tlarchive --info
+    python frame_archive.py session.tlarchive --export Dataset/
+    python frame_archive.py --benchmark
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+COMPRESSIONS = (None, "zlib")
+META = "meta.json"
+INDEX = "index.jsonl"
+
+
+def chunk_path(path, chunk, compressed=False):
+    return os.path.join(path, "chunk_{:05d}.{}".format(chunk, "npz" if compressed else "npy"))
+
+
+class FrameArchiveWriter(object):
+    """
+    Appends frames of one size to a new archive at path.
+    """
+
+    def __init__(self, path, width, height, chunk_size=256, compression=None, flush_every=32):
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression '{}'".format(compression))
+        if os.path.exists(os.path.join(path, INDEX)):
+            raise IOError("{} already holds an archive".format(path))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.flush_every = flush_every
+        self.frames = 0
+        with open(os.path.join(path, META), "w") as f:
+            json.dump({"version": 1, "width": width, "height": height, "chunk_size": chunk_size,
+                       "compression": compression}, f)
+
+        self._index = open(os.path.join(path, INDEX), "a")
+        self._chunk = None
+        self._compressors = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, frame, frame_id=None, boxes=(), labels=(), town=None, weather=None):
+        """
+        Stores a (height, width, 3) uint8 frame with its annotations, boxes
+        as [x0, y0, x1, y1]. Returns its position in the archive.
+        """
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError("frame of shape {} in an archive of {}x{} frames".format(
+                frame.shape, self.width, self.height))
+        chunk, offset = divmod(self.frames, self.chunk_size)
+        if offset == 0:
+            self._finish_chunk()
+            self._chunk = np.lib.format.open_memmap(chunk_path(self.path, chunk), mode="w+", dtype=np.uint8,
+                                                    shape=(self.chunk_size, self.height, self.width, 3))
+        self._chunk[offset] = frame
+
+        record = {"i": self.frames, "frame": frame_id, "town": town, "weather": weather,
+                  "boxes": [[int(v) for v in box] for box in boxes], "labels": list(labels)}
+        self._index.write(json.dumps(record) + "\n")
+        self.frames += 1
+        if self.frames % self.flush_every == 0:
+            self._index.flush()
+        return record["i"]
+
+    def _finish_chunk(self):
+        if self._chunk is None:
+            return
+        self._chunk.flush()
+        count = (self.frames - 1) % self.chunk_size + 1
+        chunk = (self.frames - 1) // self.chunk_size
+        self._chunk = None
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        if self.compression is not None:
+            thread = threading.Thread(target=self._compress, args=(chunk, count), name="archive-compress")
+            thread.start()
+            self._compressors = [t for t in self._compressors if t.is_alive()] + [thread]
+
+    def _compress(self, chunk, count):
+        source = chunk_path(self.path, chunk)
+        target = chunk_path(self.path, chunk, compressed=True)
+        frames = np.load(source, mmap_mode="r")[:count]
+        partial = target + ".partial"
+        with open(partial, "wb") as f:
+            np.savez_compressed(f, frames=frames)
+        del frames
+        os.replace(partial, target)
+        os.remove(source)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._finish_chunk()
+        for thread in self._compressors:
+            thread.join()
+        self._index.close()
+
+
+class FrameArchive(object):
+    """
+    Random access to the frames and records of an archive.
+    """
+
+    def __init__(self, path, cache_chunks=2):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self.width = self.meta["width"]
+        self.height = self.meta["height"]
+        self.chunk_size = self.meta["chunk_size"]
+        self.cache_chunks = cache_chunks
+        self.records = []
+        self._cache = OrderedDict()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-reads the index, picking up frames a writer appended meanwhile.
+        """
+        records = []
+        with open(os.path.join(self.path, INDEX)) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                records.append(json.loads(line))
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def _chunk(self, chunk):
+        frames = self._cache.get(chunk)
+        if frames is not None:
+            self._cache.move_to_end(chunk)
+            return frames
+        compressed = chunk_path(self.path, chunk, compressed=True)
+        if os.path.exists(compressed):
+            with np.load(compressed) as archive:
+                frames = archive["frames"]
+        else:
+            frames = np.load(chunk_path(self.path, chunk), mmap_mode="r")
+        self._cache[chunk] = frames
+        while len(self._cache) > self.cache_chunks:
+            self._cache.popitem(last=False)
+        return frames
+
+    def __getitem__(self, i):
+        """
+        Returns frame i, a read-only view where the chunk is not compressed.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("frame {} of an archive of {}".format(i, len(self)))
+        chunk, offset = divmod(i, self.chunk_size)
+        return self._chunk(chunk)[offset]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def annotated(self):
+        """
+        Yields (record, frame) for every frame with boxes.
+        """
+        for record in self.records:
+            if record["boxes"]:
+                yield record, self[record["i"]]
+
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path, META))
+
+
+def export_csv(archive, base_dir, file_name="carla_dataset"):
+    """
+    Writes the annotated frames through Log, one CSV per town under
+    base_dir, with the frames under base_dir/Img/. Returns the rows written.
+    """
+    from log import Log
+
+    logs = {}
+    rows = 0
+    try:
+        for record, frame in archive.annotated():
+            town = record["town"] or Log.town
+            if town not in logs:
+                logs[town] = Log(file_name, town, base_dir)
+            frame_num = record["frame"] if record["frame"] is not None else record["i"]
+            # The writer saves frames in the background, keep ours valid.
+            frame = np.array(frame)
+            for (x0, y0, x1, y1), label in zip(record["boxes"], record["labels"]):
+                logs[town].getData(frame, frame_num, [x0, x1, y0, y1], label)
+                rows += 1
+    finally:
+        for log in logs.values():
+            log.recDataCSV()
+    return rows
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def benchmark(path, width=1920, height=1080, frames=64, chunk_size=32):
+    """
+    Returns {format: {"write_ms", "read_ms", "mb"}} for frames written as
+    PNG files, a raw archive and a compressed archive.
+    """
+    import shutil
+
+    import cv2
+    from light_classifier import synthetic_frame
+
+    source = [synthetic_frame(width, height, 4, seed=i)[0] for i in range(8)]
+    order = np.random.RandomState(0).permutation(frames)
+    results = {}
+
+    def size_mb(directory):
+        # Blocks on disk, the last chunk file of an archive is sparse.
+        return sum(os.stat(os.path.join(directory, f)).st_blocks * 512 for f in os.listdir(directory)) / 1e6
+
+    directory = os.path.join(path, "png")
+    os.makedirs(directory)
+    start = time.perf_counter()
+    for i in range(frames):
+        cv2.imwrite(os.path.join(directory, "frame_{}.png".format(i)), source[i % len(source)])
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in order:
+        cv2.imread(os.path.join(directory, "frame_{}.png".format(i))).sum()
+    results["png"] = {"write_ms": write * 1000.0 / frames, "read_ms": (time.perf_counter() - start) * 1000.0 / frames,
+                      "mb": size_mb(directory)}
+
+    for compression in COMPRESSIONS:
+        name = "archive" if compression is None else "archive " + compression
+        directory = os.path.join(path, name.replace(" ", "_"))
+        start = time.perf_counter()
+        with FrameArchiveWriter(directory, width, height, chunk_size, compression) as writer:
+            for i in range(frames):
+                writer.append(source[i % len(source)], i, [[10, 10, 40, 90]], ["Red"])
+            append = time.perf_counter() - start
+        archive = FrameArchive(directory)
+        start = time.perf_counter()
+        for i in order:
+            archive[i].sum()
+        results[name] = {"write_ms": append * 1000.0 / frames,
+                         "read_ms": (time.perf_counter() - start) * 1000.0 / frames, "mb": size_mb(directory)}
+    shutil.rmtree(path)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("archive", nargs="?", help="Frame archive directory")
+    ap.add_argument("--info", action="store_true", help="Print the archive's size and annotations")
+    ap.add_argument("--export", default=None, help="Write the annotations as Log CSVs into this directory")
+    ap.add_argument("--benchmark", action="store_true", help="Compare PNG files with raw and compressed archives")
+    ap.add_argument("-n", "--frames", type=int, default=64, help="Frames of the benchmark")
+    args = vars(ap.parse_args())
+
+    if args["benchmark"]:
+        import tempfile
+        results = benchmark(tempfile.mkdtemp(prefix="frame_archive_"), frames=args["frames"])
+        print("{:16s} {:>10s} {:>10s} {:>10s}".format("format", "write ms", "read ms", "MB"))
+        for name, stats in results.items():
+            print("{:16s} {write_ms:10.2f} {read_ms:10.2f} {mb:10.1f}".format(name, **stats))
+        return
+
+    archive = FrameArchive(args["archive"])
+    if args["info"]:
+        boxes = sum(len(record["boxes"]) for record in archive.records)
+        towns = sorted(set(str(record["town"]) for record in archive.records))
+        print("{} frames of {}x{}, {} boxes, towns {}".format(len(archive), archive.width, archive.height, boxes,
+                                                             ", ".join(towns)))
+    if args["export"] is not None:
+        base_dir = os.path.join(args["export"], "")
+        print("{} rows exported".format(export_csv(archive, base_dir)))
+
+
+if __name__ == "__main__":
+    main()
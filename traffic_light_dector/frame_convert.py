@@ -0,0 +1,204 @@
+"""
+Conversion of CARLA camera buffers into the arrays used by the client.
+
+A sensor.camera.rgb image carries a BGRA raw_data buffer. FrameConverter turns
+it into:
+    frame       contiguous BGR frame handed to Light (one copy)
+    image       RGB view of frame for the pygame display (no copy)
+    image_data  letterboxed, normalized network input (one resize, one scale)
+
+All output arrays are preallocated once and reused. Conversions rotate over
+`buffers` slots, so a converted frame stays valid until `buffers` further
+frames have been converted; the pipelined mode needs one slot per frame in
+flight.
+
+The network input keeps the channel order the serial loop has always fed the
+graph: game_loop passed an RGB image to utils.image_preporcess, which swaps it
+once more, so the graph receives BGR.
+
+Run this module to compare per-frame bytes copied and time spent against the
+previous render()/game_loop conversion path:
+    python frame_convert.py -wi 1920 -he 1080
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+PAD_VALUE = 128.0
+
+
+class FrameConverter(object):
+    """
+    Converts CARLA BGRA buffers of a fixed size into preallocated outputs.
+    """
+
+    def __init__(self, width, height, input_size=416, buffers=1):
+        self.width = width
+        self.height = height
+        self.input_size = input_size
+
+        scale = min(float(input_size) / width, float(input_size) / height)
+        self.resized_size = (int(scale * width), int(scale * height))
+        self.offset = ((input_size - self.resized_size[0]) // 2, (input_size - self.resized_size[1]) // 2)
+
+        nw, nh = self.resized_size
+        self._frames = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(buffers)]
+        self._resized = [np.empty((nh, nw, 3), dtype=np.uint8) for _ in range(buffers)]
+        self._inputs = []
+        for _ in range(buffers):
+            image_data = np.full((1, input_size, input_size, 3), PAD_VALUE / 255.0, dtype=np.float32)
+            self._inputs.append(image_data)
+        self._slot = -1
+
+        self.frames_converted = 0
+        self.bytes_copied = 0
+
+    @property
+    def buffers(self):
+        return len(self._frames)
+
+    def bgra_view(self, raw_data):
+        """
+        Returns a (height, width, 4) view of raw_data without copying it.
+        """
+        return np.frombuffer(raw_data, dtype=np.uint8).reshape((self.height, self.width, 4))
+
+    def convert(self, raw_data):
+        """
+        Converts raw_data into the BGR frame of the next slot and returns the
+        frame dict used by the detection stages. image_data is filled in by
+        letterbox().
+        """
+        self._slot = (self._slot + 1) % len(self._frames)
+        frame = self._frames[self._slot]
+        cv2.cvtColor(self.bgra_view(raw_data), cv2.COLOR_BGRA2BGR, dst=frame)
+        self.frames_converted += 1
+        self.bytes_copied += frame.nbytes
+        return {
+            "frame": frame,
+            "image": frame[:, :, ::-1],
+            "frame_size": frame.shape[:2],
+            "slot": self._slot,
+        }
+
+    def letterbox(self, data):
+        """
+        Resizes data["frame"] into the network input of its slot and stores it
+        as data["image_data"]. Slots are independent, so different frames can
+        be letterboxed concurrently from several threads.
+        """
+        slot = data["slot"]
+        resized = self._resized[slot]
+        image_data = self._inputs[slot]
+        nw, nh = self.resized_size
+        dw, dh = self.offset
+
+        cv2.resize(data["frame"], self.resized_size, dst=resized)
+        np.multiply(resized, 1.0 / 255.0, out=image_data[0, dh:dh + nh, dw:dw + nw, :], casting="unsafe")
+        self.bytes_copied += resized.nbytes + resized.size * image_data.itemsize
+
+        data["image_data"] = image_data
+        return data
+
+    def __call__(self, raw_data):
+        return self.letterbox(self.convert(raw_data))
+
+
+def letterbox_frame(frame, input_size, image_data=None):
+    """
+    Letterboxes a BGR frame of any size like FrameConverter.letterbox, for
+    frames whose size changes from call to call, e.g. crops. Fills and
+    returns image_data, a (1, input_size, input_size, 3) float32 array
+    allocated when None.
+    """
+    height, width = frame.shape[:2]
+    scale = min(float(input_size) / width, float(input_size) / height)
+    nw, nh = max(1, int(scale * width)), max(1, int(scale * height))
+    dw, dh = (input_size - nw) // 2, (input_size - nh) // 2
+    if image_data is None:
+        image_data = np.empty((1, input_size, input_size, 3), dtype=np.float32)
+    image_data.fill(PAD_VALUE / 255.0)
+    resized = cv2.resize(frame, (nw, nh))
+    np.multiply(resized, 1.0 / 255.0, out=image_data[0, dh:dh + nh, dw:dw + nw, :], casting="unsafe")
+    return image_data
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def legacy_convert(raw_data, width, height, input_size):
+    """
+    The conversion steps of the previous render()/game_loop/image_preporcess
+    path. Returns (frame, image_data, bytes copied).
+    """
+    copied = 0
+    array = np.frombuffer(raw_data, dtype=np.dtype("uint8"))
+    array = np.reshape(array, (height, width, 4))
+    array = array[:, :, :3]
+    array = array[:, :, ::-1]
+    raw_image = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+    surface = np.ascontiguousarray(array.swapaxes(0, 1))  # pygame.surfarray.make_surface
+    frame = raw_image.copy()
+    raw_image = cv2.cvtColor(raw_image, cv2.COLOR_BGR2RGB)
+    image = np.copy(raw_image)
+    copied += raw_image.nbytes + surface.nbytes + frame.nbytes + raw_image.nbytes + image.nbytes
+
+    # utils.image_preporcess
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32)
+    scale = min(float(input_size) / width, float(input_size) / height)
+    nw, nh = int(scale * width), int(scale * height)
+    image_resized = cv2.resize(image, (nw, nh))
+    image_paded = np.full(shape=[input_size, input_size, 3], fill_value=PAD_VALUE)
+    dw, dh = (input_size - nw) // 2, (input_size - nh) // 2
+    image_paded[dh:nh + dh, dw:nw + dw, :] = image_resized
+    image_paded = image_paded / 255.
+    copied += image.size * 1 + image.nbytes + image_resized.nbytes + 2 * image_paded.nbytes
+    return frame, image_paded[np.newaxis, ...], copied
+
+
+def benchmark(width, height, input_size=416, iterations=100):
+    """
+    Times both conversion paths on a synthetic BGRA buffer.
+    Returns {path: (milliseconds per frame, bytes copied per frame)}.
+    """
+    raw_data = np.random.randint(0, 256, (height, width, 4), dtype=np.uint8).tobytes()
+    results = {}
+
+    start = time.perf_counter()
+    copied = 0
+    for _ in range(iterations):
+        copied += legacy_convert(raw_data, width, height, input_size)[2]
+    results["legacy"] = ((time.perf_counter() - start) * 1000.0 / iterations, copied // iterations)
+
+    converter = FrameConverter(width, height, input_size)
+    display = np.empty((width, height, 3), dtype=np.uint8)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        data = converter(raw_data)
+        display[...] = data["image"].swapaxes(0, 1)  # pygame.surfarray.blit_array
+    elapsed = time.perf_counter() - start
+    results["converter"] = (elapsed * 1000.0 / iterations,
+                            (converter.bytes_copied + display.nbytes * iterations) // iterations)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-wi", "--width", type=int, default=1920, help="Frame width")
+    ap.add_argument("-he", "--height", type=int, default=1080, help="Frame height")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("-n", "--iterations", type=int, default=100, help="Frames per path")
+    args = vars(ap.parse_args())
+
+    results = benchmark(args["width"], args["height"], args["input_size"], args["iterations"])
+    for path, (ms, copied) in results.items():
+        print("{:10s} {:8.3f} ms/frame {:12d} bytes copied/frame".format(path, ms, copied))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Frame handoff between a CARLA camera callback and the client loop.
+
+camera.listen() delivers images on a simulator thread. FrameSync keeps the
+latest `capacity` of them in a ring buffer keyed on the simulator frame
+number; wait_for(frame) blocks on a condition variable, without spinning,
+until the image of that tick arrives and returns it. Images are never handed
+out twice, so the loop cannot process a stale image of an earlier tick. When
+another thread ticks the world (see sim_io.py), wait_newest() returns the
+newest image instead.
+
+Counters:
+    received    images delivered by the callback
+    delivered   images returned by wait_for()/latest()
+    dropped     images pushed out of the ring, or skipped over, unread
+    late        images arriving for a frame the loop already moved past
+    missed      wait_for() calls served a newer image, theirs never came
+    timeouts    wait_for() calls that gave up
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class FrameSync(object):
+    """
+    Ring buffer of camera images. Pass put as the camera.listen() callback.
+    """
+
+    def __init__(self, capacity=2):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.late = 0
+        self.missed = 0
+        self.timeouts = 0
+        self._images = deque()
+        self._served = -1
+        self._condition = threading.Condition()
+
+    def stats(self):
+        return {"received": self.received, "delivered": self.delivered, "dropped": self.dropped,
+                "late": self.late, "missed": self.missed, "timeouts": self.timeouts}
+
+    def put(self, image):
+        with self._condition:
+            self.received += 1
+            if image.frame <= self._served:
+                self.late += 1
+                return
+            if len(self._images) == self.capacity:
+                self._images.popleft()
+                self.dropped += 1
+            self._images.append(image)
+            self._condition.notify_all()
+
+    def _take(self, frame):
+        # Returns the image of frame, or the oldest newer one, and forgets older ones.
+        while self._images and self._images[0].frame < frame:
+            self._images.popleft()
+            self.dropped += 1
+        if not self._images:
+            return None
+        image = self._images.popleft()
+        if image.frame > frame:
+            self.missed += 1
+        self._served = image.frame
+        self.delivered += 1
+        return image
+
+    def wait_for(self, frame, timeout=2.0):
+        """
+        Returns the image of the given simulator frame, or the first newer
+        one if that frame's image was lost. Returns None after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while not self._images or self._images[-1].frame < frame:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    if not self._images or self._images[-1].frame < frame:
+                        self.timeouts += 1
+                        self._served = max(self._served, frame)
+                        return None
+            return self._take(frame)
+
+    def wait_newest(self, timeout=2.0):
+        """
+        Returns the newest unread image, waiting for one if there is none.
+        Returns None after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while not self._images:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    if not self._images:
+                        self.timeouts += 1
+                        return None
+            return self._take(self._images[-1].frame)
+
+    def latest(self):
+        """
+        Returns the newest unread image without blocking, or None.
+        """
+        with self._condition:
+            if not self._images:
+                return None
+            return self._take(self._images[-1].frame)
+
+    def clear(self):
+        with self._condition:
+            self._images.clear()
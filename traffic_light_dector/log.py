@@ -1,4 +1,3 @@
-import csv
 from datetime import datetime
 import argparse
 
@@ -6,21 +5,32 @@ import numpy as np
 from math import ceil
 import cv2
 
+from dataset_writer import StreamingDatasetWriter
+from light_classifier import mask_colors
+
 class Log:
 
     base_dir = "Dataset/"
     log_cvs_file_name = "carla_dataset"
-    data = {"Filename":[], "Annotation tag": [], "Upper left corner X": [], "Upper left corner Y": [],
-            "Lower right corner X": [], "Lower right corner Y": [], "Origin file": [],
-            "Origin frame number": [], "Origin track": [], "Origin track frame number": []}
+    header = ["Filename", "Annotation tag", "Upper left corner X", "Upper left corner Y",
+              "Lower right corner X", "Lower right corner Y", "Origin file",
+              "Origin frame number", "Origin track", "Origin track frame number"]
     town = "town01"    
     header_list = []
+    img_extension = ".png"
     scale = 2.70 # w/h
+    writer = None
+    # StreamingDatasetWriter settings, see dataset_writer.py
+    batch_size = 64
+    flush_interval = 5.0
+    image_workers = 2
 
-    def __init__(self, file_name = None, town = None):
+    def __init__(self, file_name = None, town = None, base_dir = None):
         now = datetime.now()
         local_time = now.strftime("%d_%m_%Y-H_%M_%S_")
         
+        if(base_dir is not None):
+            self.base_dir = base_dir
         if(town is None):
             town  = self.town
         else:
@@ -31,14 +41,24 @@ class Log:
         else: 
             self.log_cvs_file_name = self.base_dir + local_time + file_name + "_" + town + ".csv"
         
+        self.writer = None
         self.getHeaders_list()
 
     def __del__(self):
         pass
     
     def getHeaders_list(self):
-        for key in self.data.items():
-            self.header_list.append(key[0])
+        self.header_list = list(self.header)
+
+    def getWriter(self):
+        """
+        Opens the streaming writer on the first annotation, so a Log that
+        never records anything leaves no file behind.
+        """
+        if(self.writer is None):
+            self.writer = StreamingDatasetWriter(self.log_cvs_file_name, self.header_list, self.batch_size,
+                                                 self.flush_interval, self.image_workers)
+        return self.writer
             
     def retifyBBx(self, bbx):
         w_h = (bbx[1]-bbx[0])/ (bbx[3] - bbx[2]) #w/h
@@ -54,75 +74,77 @@ class Log:
 
         return bbx    
     def getData(self, frame, frame_num, bbx, label):
-        self.data["Filename"].append(self.town + "_" + str(frame_num))
-        self.data["Annotation tag"].append(label)
-        self.data["Upper left corner X"].append(bbx[0])
-        self.data["Upper left corner Y"].append(bbx[2])
-        self.data["Lower right corner X"].append(bbx[1])
-        self.data["Lower right corner Y"].append(bbx[3])
-        self.data["Origin file"].append("None")
-        self.data["Origin frame number"].append(frame_num)
-        self.data["Origin track"].append("None")
-        self.data["Origin track frame number"].append(frame_num)
-        cv2.imwrite(self.base_dir + "/Img/" + self.data["Filename"] + self.img_extension, frame)
+        """
+        Streams one annotation row and saves frame under Img/ in the
+        background. bbx is [x0, x1, y0, y1].
+        """
+        file_name = self.town + "_" + str(frame_num)
+        writer = self.getWriter()
+        writer.write_row([file_name, label, bbx[0], bbx[2], bbx[1], bbx[3],
+                          "None", frame_num, "None", frame_num])
+        writer.write_image(self.base_dir + "Img/" + file_name + self.img_extension, frame)
+
+    def getFrameData(self, frame, frame_num, bbxs, labels, block=True):
+        """
+        Like getData for all annotations of a frame, saving the frame once.
+        bbxs are [x0, x1, y0, y1]. Without block nothing is written while the
+        image writer is busy; returns whether the frame was written.
+        """
+        file_name = self.town + "_" + str(frame_num)
+        writer = self.getWriter()
+        if not writer.write_image(self.base_dir + "Img/" + file_name + self.img_extension, frame, block):
+            return False
+        for bbx, label in zip(bbxs, labels):
+            writer.write_row([file_name, label, bbx[0], bbx[2], bbx[1], bbx[3],
+                              "None", frame_num, "None", frame_num])
+        return True
 
     def recDataCSV(self):
-        # names=self.header_list
-        # rows = zip(list1,list2,list3,list4,list5)
+        """
+        Flushes buffered rows and waits for pending images. Rows are written
+        continuously, so this only guarantees everything is on disk.
+        """
         print(self.log_cvs_file_name)
-        row = ""
-        with open(self.log_cvs_file_name,'w+') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=self.header_list)
-            writer.writeheader()
-            writer = csv.writer(csvfile, delimiter=' ', quoting=csv.QUOTE_MINIMAL)
-            for i in range(0, len(self.data["Filename"])):
-                for j in self.header_list:
-                    row += str(self.data[j][i])
-                    row += ";"
-                print(row)
-                writer.writerow(row)
-                row = ""
-            csvfile.close()
+        if(self.writer is not None):
+            self.writer.close()
+            self.writer = None
+
 
+def firstLitRow(frame):
+    """
+    Row of the first run of three lit pixels of a masked crop, scanning rows
+    top to bottom, or None without one.
+    """
+    lit = frame.any(axis=2)
+    runs = lit[:, :-2] & lit[:, 1:-1] & lit[:, 2:]
+    rows = np.flatnonzero(runs.any(axis=1))
+    return int(rows[0]) if rows.size else None
 
 def correctBBx(frame, bbx):
-    state = None
-    i = 0
-    j = 0
-    q = False
+    """
+    Shifts bbx, [y0, y1, x0, x1], towards the lit lamp of its crop frame: up
+    by twice its row for a green lamp found low in the crop, down by its row
+    for a red lamp near the top. Returns bbx, which is changed in place.
+    """
     # MASK
-    (B, G, R) = cv2.split(frame)
-    R[R < 200] = 0
-    G[G < 200] = 0
-    B[B > 0] = 0
-
-    frame = cv2.merge([B,G,R])    
-    # cv2.imshow("frame", frame)
-    # cv2.waitKey(0)
-    
-    for i in range(0, frame.shape[0]):
-        for j in range(0, frame.shape[1]):
-            if(np.mean(frame[i][j]) > 0 and np.mean(frame[i][j+1]) > 0 and np.mean(frame[i][j+2]) > 0):
-                q = True
-                break
-        if(q == True):
-            break
+    frame = mask_colors(frame)
+    i = firstLitRow(frame)
+    if(i is None):
+        return bbx
 
     if(frame[..., 1].max() == 255 and not frame[..., 2].max() == 255):
-        state ="Green"
-        print(i, j)
+        # Green
         if(i >= 5):
             bbx[0] -= 2*i
             bbx[1] -= 2*i
 
     elif(frame[..., 2].max() == 255 and frame[..., 1].mean() < 20):
-        state = "Red"
+        # Red
         if(i <= 5):
             bbx[0] += i
             bbx[1] += i
 
-    elif(frame[..., 1].max() == 255 and frame[..., 2].max() == 255):
-        state = "Yellow"
+    return bbx
 
 def main():
     # bbx = []
@@ -157,8 +179,9 @@ def main():
     # cv2.imshow("frame", frame_cropped)
     # cv2.waitKey(0)
     
-    log.getData(0, [1,1,1,1], "go")
-    log.getData(1, [1,1,1,1], "go")
+    frame = np.zeros((2, 2, 3), dtype=np.uint8)
+    log.getData(frame, 0, [1,1,1,1], "go")
+    log.getData(frame, 1, [1,1,1,1], "go")
     log.recDataCSV()
 
 if __name__ == "__main__":
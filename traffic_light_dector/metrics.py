@@ -0,0 +1,394 @@
+"""
+Per-stage latency instrumentation of the detection loop.
+
+Metrics keeps a fixed-bucket histogram of the latency of every stage (tick,
+camera, render, preprocess, inference, postprocess, light, display, ...),
+counters such as dropped frames and gauges such as queue depths and resident
+memory. Collectors registered with add_collector() refresh gauges right
+before every snapshot.
+
+MetricsExporter writes snapshots periodically on a background thread:
+    json        one JSON line per snapshot appended to a file that is rolled
+                over to <file>.1 at max_bytes
+    prometheus  the Prometheus text format, atomically replacing the file
+                (for the node exporter textfile collector)
+and can also serve them over HTTP on /metrics and /metrics.json.
+
+NullMetrics has the same interface and does nothing; its time() returns one
+shared no-op context manager, so instrumented code costs a method call per
+stage when metrics are off. Run this module to measure that overhead:
+    python metrics.py
+"""
+
+import argparse
+import bisect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+JSON = "json"
+PROMETHEUS = "prometheus"
+FORMATS = (JSON, PROMETHEUS)
+
+PREFIX = "traffic_light_"
+
+# Upper bounds in seconds, 0.5 ms to 5 s.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0,
+                   2.5, 5.0)
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in megabytes, the peak where the
+    current value is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+class Histogram(object):
+    """
+    Counts observations per bucket; percentiles are interpolated inside the
+    bucket they fall in.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        """
+        Returns count, mean, max and percentiles in milliseconds.
+        """
+        return {
+            "count": self.count,
+            "mean_ms": self.sum * 1000.0 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000.0,
+            "p50_ms": self.percentile(50) * 1000.0,
+            "p90_ms": self.percentile(90) * 1000.0,
+            "p99_ms": self.percentile(99) * 1000.0,
+        }
+
+
+class _Timer(object):
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    Thread-safe stage histograms, counters and gauges. Counters and gauges
+    take keyword labels, e.g. gauge("queue_depth", 2, queue="inference").
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.collectors = [lambda metrics: metrics.gauge("rss_mb", current_rss_mb())]
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def time(self, stage):
+        """
+        Context manager adding the duration of its block to stage.
+        """
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def add_collector(self, collector):
+        """
+        collector(metrics) is called before every snapshot to refresh gauges.
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in list(self.collectors):
+            try:
+                collector(self)
+            except Exception as error:
+                print("metrics collector failed: {!r}".format(error))
+
+    def snapshot(self):
+        """
+        Returns the current values as a JSON-serializable dict.
+        """
+        self.collect()
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                "stages": dict((name, h.summary()) for name, h in self.stages.items()),
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.counters.items()],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.gauges.items()],
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Returns the Prometheus text exposition format.
+        """
+        self.collect()
+        lines = []
+        with self._lock:
+            name = PREFIX + "stage_seconds"
+            lines.append("# TYPE {} histogram".format(name))
+            for stage, h in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, h.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, h.count))
+            for kind, values, suffix in (("counter", self.counters, "_total"), ("gauge", self.gauges, "")):
+                for metric in sorted(set(n for n, _ in values)):
+                    lines.append("# TYPE {}{}{} {}".format(PREFIX, metric, suffix, kind))
+                    for (n, labels), value in sorted(values.items()):
+                        if n == metric:
+                            lines.append("{}{}{}{} {!r}".format(PREFIX, metric, suffix, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+class NullMetrics(object):
+    """
+    Metrics that records nothing.
+    """
+
+    enabled = False
+
+    def time(self, stage):
+        return _NULL_TIMER
+
+    def observe(self, stage, seconds):
+        pass
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def add_collector(self, collector):
+        pass
+
+
+# ==============================================================================
+# -- export --------------------------------------------------------------------
+# ==============================================================================
+
+
+class MetricsExporter(object):
+    """
+    Writes snapshots of metrics to path every interval seconds and/or serves
+    them over HTTP on port. Call close() to stop and write a last snapshot.
+    """
+
+    def __init__(self, metrics, path=None, fmt=JSON, interval=5.0, port=None, max_bytes=16 * 1024 * 1024):
+        if fmt not in FORMATS:
+            raise ValueError("unknown metrics format '{}'".format(fmt))
+        self.metrics = metrics
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._start(self._loop, "metrics-writer")
+        if port is not None:
+            # Only the HTTP endpoint needs the server modules.
+            from http.server import HTTPServer
+
+            self.server = HTTPServer(("127.0.0.1", port), _handler(metrics))
+            self._start(self.server.serve_forever, "metrics-http")
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.fmt == PROMETHEUS:
+            partial = self.path + ".partial"
+            with open(partial, "w") as f:
+                f.write(self.metrics.to_prometheus())
+            os.replace(partial, self.path)
+            return
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a") as f:
+            f.write(self.metrics.to_json() + "\n")
+
+    def close(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.path is not None:
+            self.write()
+
+
+def _handler(metrics):
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = metrics.to_json(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return MetricsHandler
+
+
+def make_metrics(enabled, path=None, fmt=JSON, interval=5.0, port=None):
+    """
+    Returns (metrics, exporter); NullMetrics and no exporter when disabled.
+    """
+    if not enabled:
+        return NullMetrics(), None
+    metrics = Metrics()
+    exporter = None
+    if path is not None or port is not None:
+        exporter = MetricsExporter(metrics, path, fmt, interval, port)
+    return metrics, exporter
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def overhead(metrics, iterations=100000):
+    """
+    Returns microseconds spent per timed stage by metrics.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with metrics.time("stage"):
+            pass
+    return (time.perf_counter() - start) * 1e6 / iterations
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--iterations", type=int, default=100000, help="Timed blocks per measurement")
+    args = vars(ap.parse_args())
+
+    start = time.perf_counter()
+    for _ in range(args["iterations"]):
+        pass
+    loop_us = (time.perf_counter() - start) * 1e6 / args["iterations"]
+    print("empty loop: {:.3f} us, disabled: {:.3f} us, enabled: {:.3f} us per stage".format(
+        loop_us, overhead(NullMetrics(), args["iterations"]), overhead(Metrics(), args["iterations"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Cache of optimized model artifacts, so later launches skip the work.
+
+    tf           the frozen graph after TensorFlow's graph transforms (unused
+                 nodes stripped, Identity/CheckNumerics removed, constants
+                 and batch norms folded), loaded instead of yolov3_coco.pb
+    onnxruntime  the model as optimized by ONNX Runtime, loaded with graph
+                 optimizations disabled
+
+Artifacts are named after the source model and a key of its absolute path,
+size, modification time and the library version, so a changed model or
+library is rebuilt instead of being served stale.
+"""
+
+import hashlib
+import os
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "traffic_light_dector")
+
+TF_TRANSFORMS = [
+    "strip_unused_nodes",
+    "remove_nodes(op=Identity, op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+]
+
+
+def cache_path(model_file, suffix, cache_dir=DEFAULT_CACHE_DIR, extra=""):
+    """
+    Returns the cache file of model_file for one kind of artifact.
+    """
+    stat = os.stat(model_file)
+    key = "{}|{}|{}|{}".format(os.path.abspath(model_file), stat.st_size, int(stat.st_mtime), extra)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(cache_dir, "{}.{}.{}".format(name, digest, suffix))
+
+
+def optimized_tf_graph(pb_file, input_names, output_names, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the path of the transformed graph of pb_file, building it on the
+    first call. Falls back to pb_file where graph transforms are missing.
+    """
+    import tensorflow as tf
+
+    cached = cache_path(pb_file, "pb", cache_dir, tf.__version__)
+    if os.path.exists(cached):
+        return cached
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        print("graph transforms unavailable, not caching {}".format(pb_file))
+        return pb_file
+
+    graph_def = tf.GraphDef()
+    with open(pb_file, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    optimized = TransformGraph(graph_def, input_names, output_names, TF_TRANSFORMS)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = cached + ".partial"
+    with open(partial, "wb") as f:
+        f.write(optimized.SerializeToString())
+    os.replace(partial, cached)
+    print("cached optimized graph {}".format(cached))
+    return cached
+
+
+def onnxruntime_cache(model_file, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns (path, exists) of the ONNX Runtime optimized model of
+    model_file.
+    """
+    import onnxruntime
+
+    cached = cache_path(model_file, "ort.onnx", cache_dir, onnxruntime.__version__)
+    if not os.path.exists(cached):
+        os.makedirs(cache_dir, exist_ok=True)
+    return cached, os.path.exists(cached)
@@ -0,0 +1,268 @@
+"""
+Pipelined execution of the detection stages of the synchronous client.
+
+Frames travel as FramePacket objects through a chain of Stage objects. Stages
+are connected by BoundedQueue objects and run their work function on a thread
+or process pool, so capture, preprocess, inference and postprocess of different
+simulator ticks overlap instead of blocking each other.
+
+Every packet keeps the simulator frame id it was captured with. Stages keep
+packets in submission order, so the results leaving the pipeline are ordered
+by frame id even when a stage runs several workers.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+BACKPRESSURE_POLICIES = (BLOCK, DROP_OLDEST)
+
+THREAD = "thread"
+PROCESS = "process"
+EXECUTORS = (THREAD, PROCESS)
+
+
+class QueueClosed(Exception):
+    """
+    Raised when putting into, or getting from an empty, closed BoundedQueue.
+    """
+
+
+class FramePacket(object):
+    """
+    A unit of work tied to one simulator tick.
+    data is the dict the stage functions read from and write to.
+    """
+
+    def __init__(self, frame_id, data):
+        self.frame_id = frame_id
+        self.data = data
+        self.timestamps = {"created": time.time()}
+
+    def latency(self):
+        """
+        Returns seconds elapsed since the packet was created.
+        """
+        return time.time() - self.timestamps["created"]
+
+
+class BoundedQueue(object):
+    """
+    Thread-safe FIFO with a fixed capacity and a backpressure policy.
+
+    BLOCK makes put() wait for room, DROP_OLDEST discards the oldest queued
+    item to make room so producers never stall. Dropped items are counted.
+    """
+
+    def __init__(self, maxsize, policy=BLOCK):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("unknown backpressure policy '{}'".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, item, timeout=None):
+        """
+        Queues item. Raises queue.Full if a BLOCK queue stays full for
+        timeout seconds and QueueClosed if the queue is closed.
+        """
+        with self._cond:
+            if self.policy == DROP_OLDEST:
+                while len(self._items) >= self.maxsize:
+                    self._items.popleft()
+                    self.dropped += 1
+            elif not self._cond.wait_for(lambda: self._closed or len(self._items) < self.maxsize, timeout):
+                raise queue.Full
+            if self._closed:
+                raise QueueClosed
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest item. Raises queue.Empty on timeout and QueueClosed
+        once the queue is closed and drained.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or self._items, timeout):
+                raise queue.Empty
+            if not self._items:
+                raise QueueClosed
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def close(self):
+        """
+        Wakes up every waiter. Queued items can still be read.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def clear(self):
+        with self._cond:
+            self._items.clear()
+            self._cond.notify_all()
+
+
+class Stage(object):
+    """
+    One pipeline step running fn(data) -> data on a pool of workers.
+
+    With executor=PROCESS, fn and the packet data must be picklable, which in
+    practice means a module level function or a functools.partial of one.
+    """
+
+    def __init__(self, name, fn, workers=1, executor=THREAD):
+        if executor not in EXECUTORS:
+            raise ValueError("unknown executor '{}'".format(executor))
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.executor = executor
+        self.processed = 0
+        self.errors = 0
+
+        self._pool = None
+        self._pending = None
+        self._threads = []
+
+    def start(self, in_queue, out_queue):
+        pool_class = ThreadPoolExecutor if self.executor == THREAD else ProcessPoolExecutor
+        self._pool = pool_class(max_workers=self.workers)
+        # Bounds the number of frames in flight to the worker count and keeps
+        # completion order equal to submission order.
+        self._pending = queue.Queue(maxsize=self.workers)
+        self._threads = [
+            threading.Thread(target=self._dispatch, args=(in_queue,), name=self.name + "-dispatch", daemon=True),
+            threading.Thread(target=self._collect, args=(out_queue,), name=self.name + "-collect", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _dispatch(self, in_queue):
+        while True:
+            try:
+                packet = in_queue.get()
+            except QueueClosed:
+                break
+            try:
+                future = self._pool.submit(self.fn, packet.data)
+            except RuntimeError:
+                # Pool already shut down by Pipeline.close().
+                break
+            self._pending.put((packet, future))
+        self._pending.put(None)
+
+    def _collect(self, out_queue):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                out_queue.close()
+                return
+            packet, future = item
+            try:
+                packet.data = future.result()
+            except Exception as error:
+                self.errors += 1
+                print("[{}] frame {} failed: {!r}".format(self.name, packet.frame_id, error))
+                continue
+            packet.timestamps[self.name] = time.time()
+            self.processed += 1
+            try:
+                out_queue.put(packet)
+            except QueueClosed:
+                pass
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+class Pipeline(object):
+    """
+    Chain of stages joined by bounded queues.
+
+    put() feeds captured packets in, get()/drain() return finished packets in
+    frame order. maxsize and policy apply to every queue of the chain.
+    """
+
+    def __init__(self, stages, maxsize=2, policy=DROP_OLDEST):
+        self.stages = stages
+        self.queues = [BoundedQueue(maxsize, policy) for _ in range(len(stages) + 1)]
+        self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._started:
+            return
+        for i, stage in enumerate(self.stages):
+            stage.start(self.queues[i], self.queues[i + 1])
+        self._started = True
+
+    def put(self, packet, timeout=None):
+        self.queues[0].put(packet, timeout)
+
+    def get(self, timeout=None):
+        return self.queues[-1].get(timeout)
+
+    def drain(self):
+        """
+        Returns every finished packet without blocking, oldest first.
+        """
+        packets = []
+        while True:
+            try:
+                packets.append(self.queues[-1].get_nowait())
+            except (queue.Empty, QueueClosed):
+                return packets
+
+    def close(self, timeout=1.0):
+        """
+        Stops accepting frames and discards frames still in flight.
+        """
+        for q in self.queues:
+            q.close()
+            q.clear()
+        for stage in self.stages:
+            stage.join(timeout)
+            stage.shutdown()
+
+    def stats(self):
+        return {
+            "queue_depths": [len(q) for q in self.queues],
+            "dropped": [q.dropped for q in self.queues],
+            "processed": dict((stage.name, stage.processed) for stage in self.stages),
+            "errors": dict((stage.name, stage.errors) for stage in self.stages),
+        }
@@ -0,0 +1,200 @@
+"""
+Class-filtered, vectorized YOLOv3 postprocessing.
+
+utils.postprocess_boxes decodes every one of the ~10k predictions of all 80
+COCO classes before utils.nms loops over each class found, and Light then
+discards everything that is not a traffic light. ClassFilteredPostprocessor
+scores only the target classes, keeps the (prediction, class) pairs above the
+score threshold and decodes just those, then runs class-aware NMS with one
+IoU matrix for all classes (boxes of different classes are shifted apart so
+they never overlap).
+
+Results are the same as utils.postprocess_boxes followed by utils.nms with
+method 'nms', restricted to the target classes: a prediction only counts for
+a class if that class is its arg-max, exactly as before. The score buffer is
+preallocated per thread and reused across frames.
+
+Run this module to time both paths on synthetic predictions:
+    python postprocess.py --boxes 300
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import detector
+
+
+class ClassFilteredPostprocessor(object):
+    """
+    Turns pred_bbox into (K, 6) [x0, y0, x1, y1, score, class] detections in
+    frame coordinates for class_ids only (all classes if None). Calling it on
+    a frame dict fills data["bboxes"] like detector.postprocess.
+    """
+
+    def __init__(self, input_size, class_ids=(detector.TRAFFIC_LIGHT_CLASS,), num_classes=80,
+                 score_threshold=detector.SCORE_THRESHOLD, iou_threshold=detector.IOU_THRESHOLD):
+        self.input_size = input_size
+        self.num_classes = num_classes
+        self.class_ids = np.arange(num_classes) if class_ids is None else np.asarray(sorted(class_ids))
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Buffers stay with their thread, workers of a process pool make their own.
+        state = dict(self.__dict__)
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def __call__(self, data):
+        data["bboxes"] = self.run(data["pred_bbox"], data["frame_size"])
+        return data
+
+    def _scores(self, rows):
+        scores = getattr(self._local, "scores", None)
+        if scores is None or scores.shape[0] != rows:
+            scores = np.empty((rows, len(self.class_ids)), dtype=np.float32)
+            self._local.scores = scores
+        return scores
+
+    def run(self, pred_bbox, frame_size):
+        pred_bbox = np.asarray(pred_bbox)
+        scores = self._scores(pred_bbox.shape[0])
+        np.multiply(pred_bbox[:, 4:5], pred_bbox[:, 5 + self.class_ids], out=scores)
+        rows, cols = np.nonzero(scores > self.score_threshold)
+        if rows.size == 0:
+            return np.zeros((0, 6))
+
+        candidates = pred_bbox[rows]
+        classes = self.class_ids[cols]
+        # A prediction belongs to its arg-max class only.
+        keep = candidates[:, 5:].argmax(axis=1) == classes
+        rows, classes, candidates = rows[keep], classes[keep], candidates[keep]
+        detections = self.decode(candidates, scores[rows, cols[keep]], classes, frame_size)
+        return self.nms(detections)
+
+    def decode(self, candidates, scores, classes, frame_size):
+        """
+        Converts letterboxed (x, y, w, h) candidates to clipped frame boxes and
+        drops degenerate ones.
+        """
+        org_h, org_w = frame_size
+        xywh = candidates[:, 0:4]
+        coor = np.concatenate([xywh[:, :2] - xywh[:, 2:] * 0.5, xywh[:, :2] + xywh[:, 2:] * 0.5], axis=-1)
+
+        resize_ratio = min(self.input_size / float(org_w), self.input_size / float(org_h))
+        dw = (self.input_size - resize_ratio * org_w) / 2
+        dh = (self.input_size - resize_ratio * org_h) / 2
+        coor[:, 0::2] = (coor[:, 0::2] - dw) / resize_ratio
+        coor[:, 1::2] = (coor[:, 1::2] - dh) / resize_ratio
+
+        coor[:, :2] = np.maximum(coor[:, :2], 0)
+        coor[:, 2:] = np.minimum(coor[:, 2:], [org_w - 1, org_h - 1])
+        valid = (coor[:, 2] > coor[:, 0]) & (coor[:, 3] > coor[:, 1])
+        return np.concatenate([coor[valid], scores[valid, None], classes[valid, None]], axis=-1)
+
+    def nms(self, detections):
+        """
+        Greedy class-aware NMS. Returns detections grouped by class, highest
+        score first, like utils.nms.
+        """
+        if len(detections) == 0:
+            return np.zeros((0, 6))
+        order = np.lexsort((-detections[:, 4], detections[:, 5]))
+        detections = detections[order]
+
+        # Shift each class into its own region so one IoU matrix serves all.
+        offset = detections[:, 5:6] * (detections[:, :4].max() + 1)
+        boxes = detections[:, :4] + offset
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        x0 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+        y0 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+        x1 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+        y1 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+        inter = np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)
+        iou = np.maximum(inter / (area[:, None] + area[None, :] - inter), np.finfo(np.float32).eps)
+
+        suppressed = np.zeros(len(detections), dtype=bool)
+        keep = []
+        for i in range(len(detections)):
+            if suppressed[i]:
+                continue
+            keep.append(i)
+            suppressed |= iou[i] > self.iou_threshold
+        return detections[keep]
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def synthetic_predictions(input_size=416, num_classes=80, n_objects=300, lights=6, seed=0):
+    """
+    Returns a pred_bbox array with n_objects confident predictions, lights of
+    them traffic lights and the rest spread over the other classes.
+    """
+    rng = np.random.RandomState(seed)
+    rows = sum(3 * (input_size // stride) ** 2 for stride in (8, 16, 32))
+    pred = np.zeros((rows, 5 + num_classes), dtype=np.float32)
+    pred[:, 0:2] = rng.uniform(0, input_size, (rows, 2))
+    pred[:, 2:4] = rng.uniform(4, 80, (rows, 2))
+    pred[:, 4] = rng.uniform(0, 0.05, rows)
+    pred[:, 5:] = rng.dirichlet(np.ones(num_classes), rows)
+
+    objects = rng.choice(rows, n_objects, replace=False)
+    classes = rng.choice([c for c in range(num_classes) if c != detector.TRAFFIC_LIGHT_CLASS], n_objects)
+    classes[:lights] = detector.TRAFFIC_LIGHT_CLASS
+    pred[objects, 4] = rng.uniform(0.5, 1.0, n_objects)
+    pred[objects, 5:] = 0.001
+    pred[objects, 5 + classes] = 0.9
+    return pred
+
+
+def benchmark(n_objects=300, iterations=100, frame_size=(1080, 1920), input_size=416):
+    """
+    Returns milliseconds per frame of utils.postprocess_boxes + utils.nms +
+    the traffic light filter, and of ClassFilteredPostprocessor.
+    """
+    import tensorflow_yolov3.carla.utils as utils
+
+    pred = synthetic_predictions(input_size, n_objects=n_objects)
+    postprocessor = ClassFilteredPostprocessor(input_size)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        bboxes = utils.postprocess_boxes(pred, frame_size, input_size, detector.SCORE_THRESHOLD)
+        bboxes = utils.nms(bboxes, detector.IOU_THRESHOLD, method='nms')
+        legacy = [b for b in bboxes if int(b[5]) == detector.TRAFFIC_LIGHT_CLASS]
+    legacy_ms = (time.perf_counter() - start) * 1000.0 / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        filtered = postprocessor.run(pred, frame_size)
+    filtered_ms = (time.perf_counter() - start) * 1000.0 / iterations
+
+    if len(legacy) != len(filtered) or (len(legacy) and not np.allclose(np.array(legacy), filtered)):
+        print("warning: results differ ({} vs {} boxes)".format(len(legacy), len(filtered)))
+    return legacy_ms, filtered_ms
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-b", "--boxes", type=int, default=300, help="Confident predictions per frame")
+    ap.add_argument("-n", "--iterations", type=int, default=100, help="Frames per path")
+    args = vars(ap.parse_args())
+
+    legacy_ms, filtered_ms = benchmark(args["boxes"], args["iterations"])
+    print("postprocess_boxes + nms: {:.3f} ms/frame, class filtered: {:.3f} ms/frame".format(
+        legacy_ms, filtered_ms))
+
+
+if __name__ == "__main__":
+    main()
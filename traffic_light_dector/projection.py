@@ -0,0 +1,251 @@
+"""
+Projection of the map's traffic lights into the camera, for associating
+YOLOv3 boxes with world traffic lights.
+
+    intrinsics()        the pinhole matrix of a (width, height, fov) camera,
+                        built once per size and field of view and cached
+    TrafficLightIndex   corners of every traffic light of a town in world
+                        coordinates plus a grid over their positions, built
+                        once per town (town_index() caches it); traffic
+                        lights are static, only their states change
+    LightProjector      per frame: the lights within max_distance of the
+                        camera are looked up in the grid, their boxes are
+                        projected in one matrix product and detections are
+                        matched to them with one containment matrix
+
+A detection is associated with the nearest light whose projected box
+contains at least min_overlap of it. Only the states of the lights that
+could be visible are fetched from the simulator, which makes them free
+ground-truth labels for the classifier. Frames processed ticks after their
+capture are associated using the camera pose of the image (carla.Image
+transform) and the states capture() read at its tick.
+
+Coordinates follow CARLA: x forward, y right, z up, angles in degrees.
+"""
+
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from light_classifier import LABELS
+
+TRAFFIC_LIGHT_TYPE = "traffic.traffic_light"
+# Unit box corners, scaled by a bounding box extent.
+_CORNERS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=np.float64)
+# Traffic lights without a bounding box: a head of this extent, this high.
+DEFAULT_EXTENT = (0.3, 0.3, 0.6)
+DEFAULT_HEIGHT = 5.0
+
+
+@lru_cache(maxsize=8)
+def intrinsics(width, height, fov):
+    """
+    Returns the read-only 3x3 camera matrix of a width x height image with a
+    horizontal field of view of fov degrees. The principal point is the
+    image center.
+    """
+    calibration = np.identity(3)
+    calibration[0, 2] = width / 2.0
+    calibration[1, 2] = height / 2.0
+    calibration[0, 0] = calibration[1, 1] = width / (2.0 * np.tan(fov * np.pi / 360.0))
+    calibration.flags.writeable = False
+    return calibration
+
+
+def transform_matrix(transform):
+    """
+    Returns the 4x4 local-to-world matrix of a carla.Transform.
+    """
+    rotation = transform.rotation
+    location = transform.location
+    c_y, s_y = math.cos(math.radians(rotation.yaw)), math.sin(math.radians(rotation.yaw))
+    c_r, s_r = math.cos(math.radians(rotation.roll)), math.sin(math.radians(rotation.roll))
+    c_p, s_p = math.cos(math.radians(rotation.pitch)), math.sin(math.radians(rotation.pitch))
+    return np.array([
+        [c_p * c_y, c_y * s_p * s_r - s_y * c_r, -c_y * s_p * c_r - s_y * s_r, location.x],
+        [s_y * c_p, s_y * s_p * s_r + c_y * c_r, -s_y * s_p * c_r + c_y * s_r, location.y],
+        [s_p, -c_p * s_r, c_p * c_r, location.z],
+        [0.0, 0.0, 0.0, 1.0]])
+
+
+def project(points, camera_transform, calibration):
+    """
+    Projects (N, 3) world points. Returns (N, 2) pixel coordinates and the
+    (N,) depths in front of the camera; points behind it have depth <= 0.
+    """
+    world_to_camera = np.linalg.inv(transform_matrix(camera_transform))
+    local = points @ world_to_camera[:3, :3].T + world_to_camera[:3, 3]
+    # UE4 (forward, right, up) to camera (right, down, forward).
+    camera = np.stack([local[:, 1], -local[:, 2], local[:, 0]], axis=1)
+    depth = camera[:, 2]
+    pixels = camera @ np.asarray(calibration).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pixels = pixels[:, :2] / depth[:, None]
+    return pixels, depth
+
+
+def traffic_lights(world):
+    """
+    Returns the traffic light actors of a world.
+    """
+    return [actor for actor in world.get_actors() if actor.type_id.startswith(TRAFFIC_LIGHT_TYPE)]
+
+
+class TrafficLightIndex(object):
+    """
+    World-space boxes of a town's traffic lights and a uniform grid of their
+    centers for radius queries.
+    """
+
+    def __init__(self, corners, actors=None, cell_size=50.0):
+        self.corners = np.asarray(corners, dtype=np.float64).reshape(-1, 8, 3)
+        self.centers = self.corners.mean(axis=1)
+        self.actors = actors if actors is not None else [None] * len(self.corners)
+        self.cell_size = cell_size
+        self.cells = {}
+        for i, cell in enumerate(map(tuple, np.floor(self.centers[:, :2] / cell_size).astype(np.int64))):
+            self.cells.setdefault(cell, []).append(i)
+
+    def __len__(self):
+        return len(self.corners)
+
+    @classmethod
+    def from_world(cls, world, cell_size=50.0):
+        actors = traffic_lights(world)
+        corners = np.zeros((len(actors), 8, 3))
+        for i, actor in enumerate(actors):
+            box = getattr(actor, "bounding_box", None)
+            if box is not None and box.extent.x + box.extent.y + box.extent.z > 0:
+                center = np.array([box.location.x, box.location.y, box.location.z])
+                extent = np.array([box.extent.x, box.extent.y, box.extent.z])
+            else:
+                center = np.array([0.0, 0.0, DEFAULT_HEIGHT])
+                extent = np.array(DEFAULT_EXTENT)
+            local = _CORNERS * extent + center
+            matrix = transform_matrix(actor.get_transform())
+            corners[i] = local @ matrix[:3, :3].T + matrix[:3, 3]
+        return cls(corners, actors, cell_size)
+
+    def near(self, point, radius):
+        """
+        Returns the indices of the lights within radius of a world point.
+        """
+        x, y = point[0], point[1]
+        lo = np.floor((np.array([x, y]) - radius) / self.cell_size).astype(np.int64)
+        hi = np.floor((np.array([x, y]) + radius) / self.cell_size).astype(np.int64)
+        candidates = [i for cx in range(lo[0], hi[0] + 1) for cy in range(lo[1], hi[1] + 1)
+                      for i in self.cells.get((cx, cy), ())]
+        if not candidates:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.array(candidates)
+        distance = np.linalg.norm(self.centers[candidates] - np.asarray(point), axis=1)
+        return candidates[distance <= radius]
+
+
+_INDEXES = {}
+
+
+def town_index(world, cell_size=50.0):
+    """
+    Returns the TrafficLightIndex of the world's town, built on first use.
+    """
+    town = world.get_map().name
+    if town not in _INDEXES:
+        _INDEXES[town] = TrafficLightIndex.from_world(world, cell_size)
+    return _INDEXES[town]
+
+
+def containment(boxes, regions):
+    """
+    Returns the (K, M) fraction of each of K (x0, y0, x1, y1) boxes that lies
+    inside each of M regions.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    regions = np.asarray(regions, dtype=np.float64).reshape(-1, 4)
+    x0 = np.maximum(boxes[:, None, 0], regions[None, :, 0])
+    y0 = np.maximum(boxes[:, None, 1], regions[None, :, 1])
+    x1 = np.minimum(boxes[:, None, 2], regions[None, :, 2])
+    y1 = np.minimum(boxes[:, None, 3], regions[None, :, 3])
+    inter = np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(area, 1e-9)[:, None]
+
+
+class LightProjector(object):
+    """
+    Associates detections of one camera with the traffic lights of its town.
+    """
+
+    def __init__(self, index, width, height, fov, max_distance=80.0, min_overlap=0.5):
+        self.index = index
+        self.width = width
+        self.height = height
+        self.calibration = intrinsics(width, height, fov)
+        self.max_distance = max_distance
+        self.min_overlap = min_overlap
+
+    def visible(self, camera_transform):
+        """
+        Returns (indices, boxes, depths) of the lights in front of the camera
+        whose projected (x0, y0, x1, y1) boxes overlap the image.
+        """
+        location = camera_transform.location
+        candidates = self.index.near((location.x, location.y, location.z), self.max_distance)
+        if len(candidates) == 0:
+            return candidates, np.zeros((0, 4)), np.zeros(0)
+        pixels, depth = project(self.index.corners[candidates].reshape(-1, 3), camera_transform, self.calibration)
+        pixels = pixels.reshape(-1, 8, 2)
+        depth = depth.reshape(-1, 8)
+        # Partly behind the camera projects unreliably, skip those lights.
+        front = (depth > 0.1).all(axis=1)
+        boxes = np.concatenate([pixels.min(axis=1), pixels.max(axis=1)], axis=1)
+        inside = (front & (boxes[:, 2] > 0) & (boxes[:, 0] < self.width)
+                  & (boxes[:, 3] > 0) & (boxes[:, 1] < self.height))
+        boxes = np.clip(boxes[inside], 0, [self.width, self.height, self.width, self.height])
+        return candidates[inside], boxes, depth[inside].mean(axis=1)
+
+    def associate(self, camera_transform, detections):
+        """
+        Returns, for each (x0, y0, x1, y1, ...) detection row, the index of
+        its traffic light in the TrafficLightIndex or -1, and the visible
+        lights as returned by visible().
+        """
+        detections = np.asarray(detections, dtype=np.float64)
+        if detections.size == 0:
+            detections = detections.reshape(0, 4)
+        indices, boxes, depths = self.visible(camera_transform)
+        matches = np.full(len(detections), -1, dtype=np.int64)
+        if len(detections) == 0 or len(indices) == 0:
+            return matches, (indices, boxes, depths)
+        overlap = containment(detections[:, :4], boxes)
+        # The nearest of the lights that contain the detection.
+        distance = np.where(overlap >= self.min_overlap, depths[None, :], np.inf)
+        best = distance.argmin(axis=1)
+        found = np.isfinite(distance[np.arange(len(detections)), best])
+        matches[found] = indices[best[found]]
+        return matches, (indices, boxes, depths)
+
+    def capture(self, camera_transform):
+        """
+        Returns {index: state} of the lights visible from camera_transform,
+        read now. A frame processed some ticks after its capture is associated
+        with these instead of the states of the current tick.
+        """
+        indices = self.visible(camera_transform)[0]
+        return dict(zip(indices.tolist(), self.states(indices)))
+
+    def states(self, indices, captured=None):
+        """
+        Returns the simulator state of the given lights, GREEN, RED, YELLOW
+        or None, querying only those actors, or looking them up in captured
+        as returned by capture().
+        """
+        if captured is not None:
+            return [captured.get(int(i)) for i in indices]
+        states = []
+        for i in indices:
+            actor = self.index.actors[i]
+            state = None if actor is None else str(actor.get_state()).split(".")[-1]
+            states.append(state if state in LABELS else None)
+        return states
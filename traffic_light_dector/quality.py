@@ -0,0 +1,263 @@
+"""
+Closed-loop quality control of the client loop.
+
+The network input size, how often full inference runs and how often frames
+are shown are fixed at startup, so a slow machine falls behind the simulator
+and a fast one idles. QualityController measures the time each loop
+iteration spends working (the frame limiter's sleep excluded) and moves
+along a ladder of QualityLevels to hold the loop within a budget, the period
+of a target FPS or a latency limit:
+    quality_ladder()   from best to cheapest: every input size at full rate,
+                       then the smallest size with inference every 2, 3, ...
+                       ticks (the InferenceScheduler reuses or ROI-refines
+                       the detections in between), then frames shown every
+                       2, 3, ... ticks
+Decisions are made once per window of loop iterations on the 90th
+percentile of their loop times (percentile), so a level is only kept when
+nearly every loop fits, not on average. Levels running inference or display
+on every n-th tick are judged by loop times averaged over n ticks, the work
+of one inference. With the window's loop time at the percentile:
+    over budget        one level cheaper, or straight to the first cheaper
+                       level predicted to fit
+    within budget      one level better if it is predicted to fit
+A level's loop time is predicted from the windows measured right before and
+after the last switch between it and the current level: their ratio times
+the current loop time. A level never measured against the current one is
+predicted from its last measurement of the past retry_after windows, and
+tried when the current level leaves headroom below the budget if there is
+none. A level that was over budget is not tried again for retry_after
+windows, twice as long after each further failure, and only if predicted to
+fit, so a level known to be too slow is only retried once the loop got
+faster. The controller does not oscillate between a level that is too slow
+and one that is fast enough.
+
+Every adjustment is printed, recorded in adjustments, published as the
+quality_level, input_size, infer_every and display_every gauges, and with
+log_file appended to it as a JSON line.
+"""
+
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from metrics import NullMetrics
+
+QualityLevel = namedtuple("QualityLevel", ["input_size", "infer_every", "display_every"])
+QualityLevel.__doc__ = """
+Network input size, full inference every infer_every ticks and a frame shown
+every display_every ticks.
+"""
+
+
+def quality_ladder(sizes=(608, 416, 320), max_infer_every=4, max_display_every=4):
+    """
+    Returns the QualityLevels from best to cheapest.
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    levels = [QualityLevel(size, 1, 1) for size in sizes]
+    levels += [QualityLevel(sizes[-1], every, 1) for every in range(2, max_infer_every + 1)]
+    levels += [QualityLevel(sizes[-1], max_infer_every, every) for every in range(2, max_display_every + 1)]
+    return levels
+
+
+class QualityController(object):
+    """
+    Picks the QualityLevel of the next loop iterations from measured loop
+    times. Call update() once per iteration; it returns the new level when
+    it changed and None otherwise.
+    """
+
+    def __init__(self, levels, target_fps=None, latency_ms=None, start=None, window=20, percentile=90,
+                 headroom=0.25, retry_after=30, metrics=None, log_file=None):
+        if target_fps is None and latency_ms is None:
+            raise ValueError("a target FPS or a latency budget is needed")
+        budgets = [1.0 / target_fps] if target_fps else []
+        if latency_ms:
+            budgets.append(latency_ms / 1000.0)
+        self.budget = min(budgets)
+        self.levels = list(levels)
+        self.index = self.levels.index(start) if start is not None else 0
+        self.window = window
+        self.percentile = percentile
+        self.headroom = headroom
+        self.retry_after = retry_after
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.log_file = log_file
+
+        self.adjustments = []
+        self.windows = 0
+        # Level index -> (loop seconds, window) of its last measurement.
+        self.measured = {}
+        # (level index, other level index) -> their loop seconds in the
+        # windows right before and after the last switch between them.
+        self._pairs = {}
+        # Level index -> (times it was over budget in a row, last window it was).
+        self._failures = {}
+        # (level index, loop seconds) of the last window before a switch.
+        self._switched_from = None
+        self._samples = []
+        self._frames_at = [0] * len(self.levels)
+        self._publish()
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    def update(self, seconds, frame_id=None):
+        """
+        Records the working time of one loop iteration.
+        """
+        self._samples.append(seconds)
+        self._frames_at[self.index] += 1
+        if len(self._samples) < self.window:
+            return None
+        loop = self.loop_time(self._samples)
+        self._samples = []
+        self.windows += 1
+        self.measured[self.index] = (loop, self.windows)
+        if self._switched_from is not None:
+            previous, previous_loop = self._switched_from
+            self._pairs[(previous, self.index)] = (previous_loop, loop)
+            self._pairs[(self.index, previous)] = (loop, previous_loop)
+            self._switched_from = None
+        over = loop > self.budget
+        if over:
+            self._failures[self.index] = (self._failures.get(self.index, (0, 0))[0] + 1, self.windows)
+        else:
+            self._failures.pop(self.index, None)
+
+        target = self.index
+        if over and self.index < len(self.levels) - 1:
+            target = self.index + 1
+            for i in range(self.index + 1, len(self.levels)):
+                predicted = self.predict(i, loop)
+                if predicted is not None and predicted <= self.budget:
+                    target = i
+                    break
+        elif not over and self.index > 0 and self._may_retry(self.index - 1):
+            predicted = self.predict(self.index - 1, loop)
+            if predicted is None and loop < self.budget * (1.0 - self.headroom) or \
+                    predicted is not None and predicted <= self.budget:
+                target = self.index - 1
+        if target == self.index:
+            return None
+        self._switched_from = (self.index, loop)
+        return self._move(target, loop, frame_id)
+
+    def loop_time(self, samples):
+        """
+        Returns the loop seconds of a window at the current level: the
+        percentile of its loop times, averaged over the ticks of one
+        inference and display period first.
+        """
+        level = self.level
+        period = int(np.lcm(level.infer_every, level.display_every))
+        samples = np.asarray(samples, dtype=np.float64)
+        if period > 1 and len(samples) >= period:
+            samples = samples[:len(samples) // period * period].reshape(-1, period).mean(axis=1)
+        return float(np.percentile(samples, self.percentile))
+
+    def predict(self, index, loop):
+        """
+        Returns the predicted loop seconds of a level while the current one
+        takes loop seconds, or None without a usable measurement.
+        """
+        pair = self._pairs.get((index, self.index))
+        if pair is not None:
+            return pair[0] * loop / max(pair[1], 1e-9)
+        measured = self.measured.get(index)
+        if measured is None or self.windows - measured[1] > self.retry_after:
+            return None
+        return measured[0]
+
+    def _may_retry(self, index):
+        failures, window = self._failures.get(index, (0, 0))
+        return not failures or self.windows - window > self.retry_after * 2 ** (failures - 1)
+
+    def _move(self, target, loop, frame_id):
+        old = self.level
+        self.index = target
+        new = self.level
+        adjustment = {"time": time.time(), "frame": frame_id, "from": self.levels.index(old), "to": target,
+                      "input_size": new.input_size, "infer_every": new.infer_every,
+                      "display_every": new.display_every, "loop_ms": loop * 1000.0,
+                      "budget_ms": self.budget * 1000.0}
+        self.adjustments.append(adjustment)
+        print("quality {} -> {}: input {}, inference every {}, display every {} (loop p{} {:.1f} ms, budget "
+              "{:.1f} ms)".format(adjustment["from"], target, new.input_size, new.infer_every, new.display_every,
+                                  self.percentile, adjustment["loop_ms"], adjustment["budget_ms"]))
+        if self.log_file is not None:
+            with open(self.log_file, "a") as f:
+                f.write(json.dumps(adjustment) + "\n")
+        self._publish()
+        return new
+
+    def _publish(self):
+        level = self.level
+        self.metrics.gauge("quality_level", self.index)
+        self.metrics.gauge("input_size", level.input_size)
+        self.metrics.gauge("infer_every", level.infer_every)
+        self.metrics.gauge("display_every", level.display_every)
+
+    def stats(self):
+        """
+        Returns the number of adjustments, the current level and the loop
+        iterations spent at each level.
+        """
+        return {"adjustments": len(self.adjustments), "level": self.index,
+                "frames": {"{}/{}/{}".format(*level): frames
+                           for level, frames in zip(self.levels, self._frames_at) if frames}}
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def level_cost(level, inference_ms, other_ms=5.0, display_ms=8.0, reference_size=416):
+    """
+    Modelled loop time in seconds of a level: inference scales with the input
+    area and runs every infer_every ticks, display every display_every.
+    """
+    inference = inference_ms * (level.input_size / float(reference_size)) ** 2 / level.infer_every
+    return (other_ms + inference + display_ms / level.display_every) / 1000.0
+
+
+def simulate(controller, inference_ms, frames, noise=0.1, seed=0):
+    """
+    Runs the controller on modelled loop times. Returns the loop times.
+    """
+    rng = np.random.RandomState(seed)
+    times = []
+    for frame in range(frames):
+        seconds = level_cost(controller.level, inference_ms) * (1.0 + noise * rng.randn())
+        times.append(seconds)
+        controller.update(max(seconds, 0.0), frame)
+    return np.array(times)
+
+
+def main():
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fps", type=float, default=20.0, help="Target loop rate")
+    ap.add_argument("--inference-ms", default="25,60,150", help="Comma separated 416x416 inference times to model")
+    ap.add_argument("--sizes", default="608,416,320", help="Comma separated network input sizes")
+    ap.add_argument("-n", "--frames", type=int, default=2000, help="Modelled loop iterations per machine")
+    args = vars(ap.parse_args())
+
+    levels = quality_ladder([int(s) for s in args["sizes"].split(",")])
+    for inference_ms in [float(v) for v in args["inference_ms"].split(",")]:
+        print("machine with {:.0f} ms inference at 416:".format(inference_ms))
+        controller = QualityController(levels, args["fps"])
+        times = simulate(controller, inference_ms, args["frames"])
+        settled = times[len(times) // 2:]
+        print("  {} adjustments, settled at {}, {:.1f} fps over the second half ({:.0%} of loops over budget)".format(
+            len(controller.adjustments), controller.level, 1.0 / settled.mean(),
+            (settled > controller.budget).mean()))
+
+
+if __name__ == "__main__":
+    main()
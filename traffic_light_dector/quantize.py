@@ -0,0 +1,258 @@
+"""
+Reduced-precision conversions of the frozen YOLOv3 graph for CPU inference.
+
+    tflite-fp16   TensorFlow Lite, weights stored as float16 (half the size,
+                  computed in float32 on CPUs without fp16 kernels)
+    tflite-int8   TensorFlow Lite, int8 weights and activations, calibrated
+                  on recorded frames; inputs and outputs stay float32
+    onnx-int8     ONNX Runtime static QDQ quantization of the ONNX export,
+                  calibrated on the same frames
+
+Calibration frames come from any replay source (PNG directory, video, .npz or
+frame archive) and are letterboxed exactly like the client's frames. The
+models are written next to yolov3_coco.pb and run with --backend tflite or
+--backend onnxruntime --model <file>.
+
+No single-class pruning of the head is done: the 80-class outputs are
+computed either way, and ClassFilteredPostprocessor (--classes 9) already
+decodes only the traffic light scores.
+
+Run this module to convert and compare latency, memory and traffic light
+precision/recall against the float32 graph on the same replayed frames. Every
+model runs in a fresh interpreter, so its memory includes loading its runtime
+library:
+    python quantize.py --calibration Dataset/session.tlarchive --frames data/ --labels Dataset/carla_dataset.csv
+Without --labels the float32 detections serve as ground truth.
+"""
+
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+import detector
+from backends import (DEFAULT_ONNX, DEFAULT_PB, OnnxRuntimeBackend, TF1Backend, TFLiteBackend, load_inputs,
+                      make_backend)
+
+MODES = ("tflite-fp16", "tflite-int8", "onnx-int8")
+
+
+def output_path(model_file, mode):
+    root = os.path.splitext(model_file)[0]
+    precision = mode.split("-")[1]
+    return "{}_{}.{}".format(root, precision, "tflite" if mode.startswith("tflite") else "onnx")
+
+
+def convert_tflite(pb_file, path, mode, calibration=None, input_size=416):
+    """
+    Converts the frozen graph to TensorFlow Lite with fp16 weights, or with
+    int8 weights and activations calibrated on the calibration inputs.
+    """
+    import tensorflow as tf
+
+    names = [name.split(":")[0] for name in detector.RETURN_ELEMENTS]
+    converter = tf.compat.v1.lite.TFLiteConverter.from_frozen_graph(
+        pb_file, names[:1], names[1:], {names[0]: [1, input_size, input_size, 3]})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "tflite-fp16":
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        if not calibration:
+            raise ValueError("int8 conversion needs calibration frames")
+        converter.representative_dataset = lambda: ([image_data] for image_data in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(model)
+    return path
+
+
+def convert_onnx(onnx_file, path, calibration):
+    """
+    Quantizes the ONNX export statically to int8, calibrated on the inputs.
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    import onnxruntime
+
+    input_name = onnxruntime.InferenceSession(onnx_file, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.inputs = iter(calibration)
+
+        def get_next(self):
+            image_data = next(self.inputs, None)
+            return None if image_data is None else {input_name: image_data}
+
+    quantize_static(onnx_file, path, Reader(), quant_format=QuantFormat.QDQ, activation_type=QuantType.QInt8,
+                    weight_type=QuantType.QInt8)
+    return path
+
+
+def convert(mode, pb_file, onnx_file, calibration, input_size=416):
+    """
+    Writes the model of one mode next to its source and returns its path.
+    """
+    if mode not in MODES:
+        raise ValueError("unknown mode '{}', choose from {}".format(mode, ", ".join(MODES)))
+    if mode.startswith("tflite"):
+        return convert_tflite(pb_file, output_path(pb_file, mode), mode, calibration, input_size)
+    return convert_onnx(onnx_file, output_path(onnx_file, mode), calibration)
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def precision_recall(truth, found, iou_threshold=0.3):
+    """
+    Returns (precision, recall) of the found (K, >=4) boxes per frame against
+    the truth (N, 4) boxes, matching each truth box at most once.
+    """
+    from tiling import box_iou
+
+    true_positives = detections = total = 0
+    for boxes, found_boxes in zip(truth, found):
+        total += len(boxes)
+        detections += len(found_boxes)
+        if len(boxes) == 0 or len(found_boxes) == 0:
+            continue
+        iou = box_iou(np.asarray(found_boxes, dtype=np.float64)[:, :4], np.asarray(boxes, dtype=np.float64))
+        matched = np.zeros(len(boxes), dtype=bool)
+        for i in np.argsort(-iou.max(axis=1)):
+            candidates = np.flatnonzero((iou[i] >= iou_threshold) & ~matched)
+            if candidates.size:
+                j = candidates[iou[i, candidates].argmax()]
+                matched[j] = True
+                true_positives += 1
+    precision = true_positives / float(detections) if detections else 1.0
+    recall = true_positives / float(total) if total else 1.0
+    return precision, recall
+
+
+def evaluate(name, model_file, frames, input_size=416, threads=0):
+    """
+    Loads one backend and detects traffic lights on every BGR frame.
+    Returns (stats, per-frame detections).
+    """
+    from metrics import current_rss_mb
+    from postprocess import ClassFilteredPostprocessor
+
+    before = current_rss_mb()
+    backend = make_backend(name, model_file, 80, threads, 0)
+    backend.warmup(input_size)
+    memory = current_rss_mb() - before
+    postprocessor = ClassFilteredPostprocessor(input_size)
+    try:
+        inputs = load_inputs_of(frames, input_size)
+        found = []
+        latencies = []
+        for image_data, frame in zip(inputs, frames):
+            start = time.perf_counter()
+            pred_bbox = backend.predict(image_data)
+            latencies.append(time.perf_counter() - start)
+            found.append(postprocessor.run(pred_bbox, frame.shape[:2]))
+    finally:
+        backend.close()
+    ms = np.asarray(latencies) * 1000.0
+    return {"mean_ms": float(ms.mean()), "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)), "rss_mb": memory,
+            "file_mb": os.path.getsize(model_file) / 1e6}, found
+
+
+def evaluate_in_process(name, model_file, frames, input_size=416, threads=0):
+    """
+    Runs evaluate() in a fresh interpreter and returns its result. The RSS
+    growth of a model in the benchmark's own process would leave out the
+    runtime library loaded for an earlier one.
+    """
+    import multiprocessing
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(evaluate, (name, model_file, frames, input_size, threads))
+
+
+def load_inputs_of(frames, input_size):
+    """
+    Letterboxes BGR frames into network inputs.
+    """
+    from frame_convert import FrameConverter
+
+    inputs = []
+    converters = {}
+    for frame in frames:
+        size = frame.shape[:2]
+        if size not in converters:
+            converters[size] = FrameConverter(size[1], size[0], input_size)
+        converter = converters[size]
+        inputs.append(converter.letterbox({"frame": frame, "slot": 0})["image_data"].copy())
+    return inputs
+
+
+def main():
+    from replay import LimitedSource, PngDirectorySource, open_source
+    from tiling import load_labels
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pb", default=DEFAULT_PB, help="Frozen YOLOv3 graph")
+    ap.add_argument("--onnx", default=DEFAULT_ONNX, help="ONNX export of the graph, for onnx-int8")
+    ap.add_argument("--modes", default="tflite-fp16,tflite-int8", help="Comma separated: " + ", ".join(MODES))
+    ap.add_argument("--calibration", default=None, help="Replay source of calibration frames")
+    ap.add_argument("--calibration-frames", type=int, default=100, help="Calibration frames used")
+    ap.add_argument("--skip-convert", action="store_true", help="Benchmark models converted earlier")
+    ap.add_argument("--frames", default=None, help="Replay source to benchmark on, no benchmark if not given")
+    ap.add_argument("--pattern", default="frame_*.png", help="File pattern inside a PNG directory")
+    ap.add_argument("--labels", default=None, help="Log annotation CSV naming the frames of --frames")
+    ap.add_argument("-n", "--max-frames", type=int, default=50, help="Frames to benchmark")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("--threads", type=int, default=0, help="Intra-op threads, 0 for the backend default")
+    args = vars(ap.parse_args())
+
+    modes = args["modes"].split(",")
+    if not args["skip_convert"]:
+        calibration = None
+        if args["calibration"] is not None:
+            calibration = load_inputs(args["calibration"], args["calibration_frames"], args["input_size"])
+        for mode in modes:
+            start = time.perf_counter()
+            path = convert(mode, args["pb"], args["onnx"], calibration, args["input_size"])
+            print("{} written to {} in {:.1f} s".format(mode, path, time.perf_counter() - start))
+
+    if args["frames"] is None:
+        return
+    truth = None
+    if args["labels"] is not None:
+        labels = load_labels(args["labels"])
+        paths = PngDirectorySource(args["frames"], args["pattern"]).paths[:args["max_frames"]]
+        frames = [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+        truth = [labels.get(os.path.splitext(os.path.basename(path))[0], np.zeros((0, 4))) for path in paths]
+    else:
+        frames = [np.array(frame) for frame in
+                  LimitedSource(open_source(args["frames"], args["pattern"]), args["max_frames"])]
+
+    configurations = [("float32", TF1Backend.name, args["pb"])]
+    for mode in modes:
+        backend = TFLiteBackend.name if mode.startswith("tflite") else OnnxRuntimeBackend.name
+        configurations.append((mode, backend, output_path(args["pb"] if mode.startswith("tflite") else args["onnx"],
+                                                          mode)))
+    results = {}
+    reference = None
+    for label, backend, model_file in configurations:
+        stats, found = evaluate_in_process(backend, model_file, frames, args["input_size"], args["threads"])
+        if reference is None:
+            reference = truth if truth is not None else [f[:, :4] for f in found]
+        stats["precision"], stats["recall"] = precision_recall(reference, found)
+        results[label] = stats
+
+    print("{:12s} {:>9s} {:>9s} {:>9s} {:>8s} {:>8s} {:>9s} {:>7s}".format(
+        "model", "mean ms", "p50 ms", "p99 ms", "RSS MB", "file MB", "precision", "recall"))
+    for label, stats in results.items():
+        print("{:12s} {mean_ms:9.2f} {p50_ms:9.2f} {p99_ms:9.2f} {rss_mb:8.1f} {file_mb:8.1f} {precision:9.3f} "
+              "{recall:7.3f}".format(label, **stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Headless replay of recorded frames through the detection pipeline.
+
+Frames from a PNG directory (such as the data/frame_N.png files Light writes),
+a video file, an .npz archive or a frame archive (see frame_archive.py) are played through a fake_carla.FakeWorld and
+camera, then converted, letterboxed, run through an inference backend, decoded with
+NMS and classified by Light, exactly as game_loop does, but without a CARLA
+server or a display.
+
+Reports per-stage latency percentiles, frames per second and peak memory:
+    python replay.py data/ --pattern "frame_*.png" --json replay.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial
+
+import cv2
+import numpy as np
+
+import detector
+from backends import BACKENDS, TF1Backend, make_backend
+from fake_carla import FakeBlueprintLibrary, FakeWorld
+from frame_archive import FrameArchive, is_archive
+from frame_convert import FrameConverter
+from postprocess import ClassFilteredPostprocessor
+
+PERCENTILES = (50, 90, 99)
+
+
+# ==============================================================================
+# -- frame sources -------------------------------------------------------------
+# ==============================================================================
+
+
+def natural_key(path):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+
+class PngDirectorySource(object):
+    """
+    Yields BGR frames of the images in a directory in natural order.
+    """
+
+    def __init__(self, directory, pattern="frame_*.png"):
+        self.paths = sorted(glob.glob(os.path.join(directory, pattern)), key=natural_key)
+        if not self.paths:
+            raise IOError("no frames matching '{}' in {}".format(pattern, directory))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for path in self.paths:
+            frame = cv2.imread(path, cv2.IMREAD_COLOR)
+            if frame is not None:
+                yield frame
+
+
+class VideoSource(object):
+    """
+    Yields BGR frames of a video file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        capture = cv2.VideoCapture(self.path)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield frame
+        finally:
+            capture.release()
+
+
+class NpzSource(object):
+    """
+    Yields BGR frames of the (N, height, width, 3) uint8 "frames" array of an
+    .npz archive.
+    """
+
+    def __init__(self, path, key="frames"):
+        self.path = path
+        self.key = key
+
+    def __iter__(self):
+        with np.load(self.path) as archive:
+            for frame in archive[self.key]:
+                yield frame
+
+
+def open_source(path, pattern="frame_*.png"):
+    """
+    Picks the frame source matching path.
+    """
+    if is_archive(path):
+        return FrameArchive(path)
+    if os.path.isdir(path):
+        return PngDirectorySource(path, pattern)
+    if path.endswith(".npz"):
+        return NpzSource(path)
+    return VideoSource(path)
+
+
+class LimitedSource(object):
+    def __init__(self, source, max_frames):
+        self.source = source
+        self.max_frames = max_frames
+
+    def __iter__(self):
+        for i, frame in enumerate(self.source):
+            if i >= self.max_frames:
+                return
+            yield frame
+
+
+# ==============================================================================
+# -- statistics ----------------------------------------------------------------
+# ==============================================================================
+
+
+class StageTimer(object):
+    """
+    Collects wall-clock samples per stage name.
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Returns {stage: {"mean", "max", "p50", "p90", "p99"}} in milliseconds.
+        """
+        summary = {}
+        for name, samples in self.samples.items():
+            ms = np.asarray(samples) * 1000.0
+            stats = {"mean": float(ms.mean()), "max": float(ms.max())}
+            for p, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+                stats["p{}".format(p)] = float(value)
+            summary[name] = stats
+        return summary
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+# ==============================================================================
+# -- ReplayHarness -------------------------------------------------------------
+# ==============================================================================
+
+
+class ReplayHarness(object):
+    """
+    Drives the detection steps of game_loop from a FakeWorld.
+    inference is any callable taking and returning the frame dict, normally
+    a backends.InferenceBackend. postprocess defaults to detector.postprocess.
+    """
+
+    def __init__(self, source, inference, input_size=416, light=None, town="Town01", postprocess=None):
+        self.world = FakeWorld(source, town)
+        self.inference = inference
+        self.input_size = input_size
+        if postprocess is None:
+            postprocess = partial(detector.postprocess, input_size=input_size)
+        self.postprocess = postprocess
+        self.light = light
+        self.timer = StageTimer()
+        self.converter = None
+        self.frames = 0
+        self.detections = 0
+        self.image = None
+
+        camera_bp = FakeBlueprintLibrary().find('sensor.camera.rgb')
+        self.camera = self.world.spawn_actor(camera_bp)
+        self.camera.listen(self.set_image)
+
+    def set_image(self, image):
+        self.image = image
+
+    def step(self):
+        """
+        Processes one simulator tick. Returns the frame dict, or None once the
+        source is exhausted.
+        """
+        timer = self.timer
+        with timer.measure("tick"):
+            frame_id = self.world.tick()
+        if frame_id is None:
+            return None
+        if self.converter is None:
+            self.converter = FrameConverter(self.image.width, self.image.height, self.input_size)
+
+        with timer.measure("convert"):
+            data = self.converter.convert(self.image.raw_data)
+        with timer.measure("preprocess"):
+            data = self.converter.letterbox(data)
+        with timer.measure("inference"):
+            data = self.inference(data)
+        with timer.measure("postprocess"):
+            data = self.postprocess(data)
+        if self.light is not None:
+            with timer.measure("light"):
+                self.light.process_traffic_light(data["frame"], data["bboxes"])
+
+        data["frame_id"] = frame_id
+        self.frames += 1
+        self.detections += len(data["bboxes"])
+        return data
+
+    def run(self, trace_memory=False):
+        """
+        Replays every frame and returns the report dict.
+        """
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        while self.step() is not None:
+            pass
+        elapsed = time.perf_counter() - start
+
+        report = {
+            "frames": self.frames,
+            "detections": self.detections,
+            "seconds": elapsed,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "stages_ms": self.timer.summary(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if trace_memory:
+            report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+            tracemalloc.stop()
+        return report
+
+
+def print_report(report):
+    print("frames {frames}  detections {detections}  {seconds:.2f} s  {fps:.2f} FPS  "
+          "peak RSS {peak_rss_mb:.1f} MB".format(**report))
+    print("{:12s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format("stage", "mean", "p50", "p90", "p99", "max"))
+    for name, stats in report["stages_ms"].items():
+        print("{:12s} {mean:9.2f} {p50:9.2f} {p90:9.2f} {p99:9.2f} {max:9.2f}".format(name, **stats))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("source", help="PNG directory, video file, .npz or frame archive")
+    ap.add_argument("--pattern", default="frame_*.png", help="File pattern inside a PNG directory")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name, help="Inference backend")
+    ap.add_argument("--model", default=None, help="Model file of the backend")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("-n", "--max-frames", type=int, default=None, help="Stop after this many frames")
+    ap.add_argument("--no-light", action="store_true", help="Skip traffic light classification")
+    ap.add_argument("--trace-memory", action="store_true", help="Also report the tracemalloc peak")
+    ap.add_argument("--classes", default=None, help="Only decode these comma separated class ids, e.g. 9")
+    ap.add_argument("--json", default=None, help="Write the report to this file")
+    args = vars(ap.parse_args())
+
+    num_classes = 80
+    source = open_source(args["source"], args["pattern"])
+    if args["max_frames"] is not None:
+        source = LimitedSource(source, args["max_frames"])
+
+    backend = make_backend(args["backend"], args["model"], num_classes)
+    light = None
+    if not args["no_light"]:
+        from traffic_light import Light
+        light = Light(show=False)
+
+    try:
+        postprocess = None
+        if args["classes"] is not None:
+            postprocess = ClassFilteredPostprocessor(args["input_size"], [int(c) for c in args["classes"].split(",")])
+        harness = ReplayHarness(source, backend, args["input_size"], light, postprocess=postprocess)
+        report = harness.run(args["trace_memory"])
+    finally:
+        backend.close()
+
+    print_report(report)
+    if args["json"] is not None:
+        with open(args["json"], "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
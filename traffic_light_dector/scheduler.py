@@ -0,0 +1,177 @@
+"""
+Adaptive scheduling of YOLOv3 inference.
+
+InferenceScheduler runs full-frame detection every `full_every` ticks. Between
+those ticks it either reuses the previous detections ("skip") or runs the
+network only on windows around the traffic lights seen last ("roi"), which
+also magnifies small, distant lights. Full detection can itself be limited to
+a fixed region of the frame, such as the upper part of the forward camera
+where traffic lights appear.
+
+Counters report how many full and partial inferences ran and how many ticks
+reused earlier detections.
+"""
+
+from functools import partial
+
+import numpy as np
+
+import detector
+
+FULL = "full"
+ROI = "roi"
+SKIP = "skip"
+BETWEEN_MODES = (ROI, SKIP)
+
+
+def merge_windows(windows):
+    """
+    Replaces overlapping (x0, y0, x1, y1) windows by their union until none
+    overlap.
+    """
+    windows = [list(w) for w in windows]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(w) for w in windows]
+
+
+class InferenceScheduler(object):
+    """
+    Decides per tick between full, ROI and no inference, and runs it.
+
+    inference is a backends.InferenceBackend (or any callable on the frame dict).
+    roi is the (x0, y0, x1, y1) region of full detections in frame fractions,
+    None for the whole frame. margin grows ROI windows by that many box sizes
+    on every side and min_window is their smallest side in pixels.
+    postprocess is the frame dict step decoding pred_bbox, detector.postprocess
+    by default.
+    """
+
+    def __init__(self, inference, input_size, full_every=5, roi=None, between=ROI, margin=1.5,
+                 min_window=96, classes=(detector.TRAFFIC_LIGHT_CLASS,), postprocess=None):
+        if between not in BETWEEN_MODES:
+            raise ValueError("unknown scheduling mode '{}'".format(between))
+        self.inference = inference
+        self.input_size = input_size
+        self.full_every = max(1, full_every)
+        self.roi = roi
+        self.between = between
+        self.margin = margin
+        self.min_window = min_window
+        self.classes = classes
+        if postprocess is None:
+            postprocess = partial(detector.postprocess, input_size=input_size)
+        self.postprocess = postprocess
+        from frame_convert import letterbox_frame
+        self._letterbox_frame = letterbox_frame
+
+        self.full_inferences = 0
+        self.partial_inferences = 0
+        self.skipped = 0
+        self.last_decision = None
+        self._ticks = 0
+        self._bboxes = np.zeros((0, 6))
+        self._force_full = True
+        # Network input of the windows, reused from one window to the next.
+        self._window_input = None
+
+    def stats(self):
+        return {"full": self.full_inferences, "partial": self.partial_inferences, "skipped": self.skipped}
+
+    def plan(self):
+        """
+        Returns FULL, ROI or SKIP for the next tick.
+        """
+        if self._force_full or self._ticks % self.full_every == 0:
+            return FULL
+        if self.between == SKIP:
+            return SKIP
+        return ROI
+
+    def __call__(self, data, letterbox=None):
+        """
+        Fills data["bboxes"] for one tick. letterbox is the converter step used
+        for whole-frame detection (see FrameConverter.letterbox).
+        """
+        decision = self.plan()
+        self._ticks += 1
+        height, width = data["frame"].shape[:2]
+
+        if decision == FULL:
+            self._force_full = False
+            self.full_inferences += 1
+            if self.roi is None:
+                if letterbox is not None:
+                    data = letterbox(data)
+                else:
+                    data["image_data"] = self._letterbox_frame(data["frame"], self.input_size)
+                data = self.inference(data)
+                data = self.postprocess(data)
+                bboxes = np.asarray(data["bboxes"]).reshape(-1, 6)
+            else:
+                x0, y0, x1, y1 = self.roi
+                bboxes = self._detect_window(data, (int(x0 * width), int(y0 * height),
+                                                    int(x1 * width), int(y1 * height)))
+        elif decision == ROI:
+            windows = self._windows(width, height)
+            if windows:
+                bboxes = np.concatenate([self._detect_window(data, w) for w in windows], axis=0)
+                self.partial_inferences += len(windows)
+                if not self._tracked(bboxes).any():
+                    # Lost every light, look at the whole frame again next tick.
+                    self._force_full = True
+            else:
+                # Nothing to follow since the last full detection, which
+                # found no light either; wait for the next one on schedule.
+                bboxes = self._bboxes
+                self.skipped += 1
+        else:
+            bboxes = self._bboxes
+            self.skipped += 1
+
+        self.last_decision = decision
+        self._bboxes = bboxes
+        data["bboxes"] = list(bboxes)
+        return data
+
+    def _tracked(self, bboxes):
+        return np.isin(bboxes[:, 5].astype(np.int64), self.classes)
+
+    def _windows(self, width, height):
+        windows = []
+        for x0, y0, x1, y1 in self._bboxes[self._tracked(self._bboxes), :4]:
+            w = max((x1 - x0) * (1 + 2 * self.margin), self.min_window)
+            h = max((y1 - y0) * (1 + 2 * self.margin), self.min_window)
+            cx, cy = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+            windows.append((int(max(0, cx - w / 2)), int(max(0, cy - h / 2)),
+                            int(min(width, cx + w / 2)), int(min(height, cy + h / 2))))
+        return merge_windows(windows)
+
+    def _detect_window(self, data, window):
+        """
+        Runs detection on one window of the frame, returns boxes in frame
+        coordinates.
+        """
+        x0, y0, x1, y1 = window
+        frame = data["frame"][y0:y1, x0:x1]
+        if self._window_input is None or self._window_input.shape[1] != self.input_size:
+            self._window_input = np.empty((1, self.input_size, self.input_size, 3), dtype=np.float32)
+        crop = {"frame": frame, "frame_size": frame.shape[:2],
+                "image_data": self._letterbox_frame(frame, self.input_size, self._window_input)}
+        crop = self.inference(crop)
+        crop = self.postprocess(crop)
+        bboxes = np.array(crop["bboxes"], dtype=np.float64).reshape(-1, 6)
+        bboxes[:, [0, 2]] += x0
+        bboxes[:, [1, 3]] += y0
+        return bboxes
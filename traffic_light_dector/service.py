@@ -0,0 +1,503 @@
+"""
+Long-running traffic light detection service.
+
+Loads the model once, warms it up and serves detection to any number of local
+clients, so simulator clients and offline tools share one model process
+instead of each loading its own. Frames travel as raw uint8 buffers, BGR or
+CARLA's BGRA, with a shape header and are never re-encoded:
+
+    Unix socket  persistent connections; each request is the 28 byte header
+                 !4sIIIq (b"TLD1", height, width, channels, frame id or -1)
+                 followed by height * width * channels bytes, each reply a
+                 !I length followed by that many bytes of JSON
+    HTTP         POST /detect with the frame as body and the headers
+                 X-Frame-Shape: height,width,channels and X-Frame-Id;
+                 GET /stats
+
+Replies hold the traffic lights of the frame:
+    {"frame": 42, "lights": [{"bbox": [x0, y0, x1, y1], "score": 0.91,
+     "state": "Red"}], "inference_ms": 21.3, "total_ms": 24.0}
+state is Green, Red, Yellow or null, from light_classifier.classify_lights,
+the batched form of Light.get_state.
+
+Concurrent requests are grouped into batched backend runs by a
+BatchInferenceEngine (at most --max-batch-size frames, waiting at most
+--max-batch-wait ms for a batch to fill). At most --max-queue requests are
+in the service at once; further ones are answered "busy" right away (HTTP 503)
+instead of queueing without bound.
+
+    python service.py --unix /tmp/traffic_light_dector.sock --port 8500
+    python service.py --load /tmp/traffic_light_dector.sock --clients 4 --requests 100
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import detector
+from batching import BatchInferenceEngine
+from frame_convert import FrameConverter
+from light_classifier import classify_lights
+from postprocess import ClassFilteredPostprocessor
+
+MAGIC = b"TLD1"
+HEADER = struct.Struct("!4sIIIq")
+LENGTH = struct.Struct("!I")
+CHANNELS = (3, 4)
+MAX_FRAME_BYTES = 4096 * 4096 * 4
+DEFAULT_SOCKET = "/tmp/traffic_light_dector.sock"
+
+
+class ServiceBusy(Exception):
+    """
+    The service already holds its maximum of queued requests.
+    """
+
+
+class DetectionService(object):
+    """
+    Detects and classifies the traffic lights of raw frames from many threads,
+    batching their inference.
+    """
+
+    def __init__(self, backend, input_size=416, max_batch_size=8, max_wait=0.005, max_queue=32,
+                 class_ids=(detector.TRAFFIC_LIGHT_CLASS,), score_threshold=detector.LIGHT_SCORE_THRESHOLD):
+        self.backend = backend
+        self.input_size = input_size
+        self.max_queue = max_queue
+        self.score_threshold = score_threshold
+        self.engine = BatchInferenceEngine(backend, max_batch_size, max_wait)
+        self.postprocessor = ClassFilteredPostprocessor(input_size, class_ids, backend.num_classes)
+
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        self.engine.start()
+
+    def close(self):
+        self.engine.close()
+
+    def stats(self):
+        return {"requests": self.requests, "rejected": self.rejected, "errors": self.errors,
+                "in_flight": self.in_flight, "max_queue": self.max_queue, "batches": self.engine.batches,
+                "mean_batch_size": self.engine.mean_batch_size()}
+
+    def _converter(self, width, height):
+        # One converter per frame size and thread: its buffers stay ours until
+        # the reply is built.
+        converters = getattr(self._local, "converters", None)
+        if converters is None:
+            converters = self._local.converters = {}
+        converter = converters.get((width, height))
+        if converter is None:
+            converter = converters[(width, height)] = FrameConverter(width, height, self.input_size)
+        return converter
+
+    def convert(self, buffer, height, width, channels):
+        """
+        Returns the frame dict of a raw BGR or BGRA buffer, letterboxed.
+        """
+        if channels not in CHANNELS:
+            raise ValueError("frames must have 3 (BGR) or 4 (BGRA) channels, not {}".format(channels))
+        if height <= 0 or width <= 0:
+            raise ValueError("empty {}x{} frame".format(height, width))
+        if len(buffer) != height * width * channels:
+            raise ValueError("{} bytes for a {}x{}x{} frame".format(len(buffer), height, width, channels))
+        converter = self._converter(width, height)
+        if channels == 4:
+            return converter(buffer)
+        frame = np.frombuffer(buffer, dtype=np.uint8).reshape((height, width, 3))
+        data = {"frame": frame, "image": frame[:, :, ::-1], "frame_size": frame.shape[:2], "slot": 0}
+        return converter.letterbox(data)
+
+    def classify(self, frame, bboxes):
+        """
+        Returns the JSON ready lights of the traffic light detections good
+        enough for Light.
+        """
+        bboxes = bboxes[(bboxes[:, 5] == detector.TRAFFIC_LIGHT_CLASS) & (bboxes[:, 4] >= self.score_threshold)]
+        boxes = [[int(b[1]), int(b[3]), int(b[0]), int(b[2])] for b in bboxes]
+        return [{"bbox": list(light.bbox), "score": float(light.score), "state": light.label}
+                for light in classify_lights(frame, boxes, bboxes[:, 4])]
+
+    def detect(self, buffer, height, width, channels=3, frame_id=None):
+        """
+        Returns the reply dict of one frame. Raises ServiceBusy when max_queue
+        requests are already in the service, ValueError for a bad frame.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceBusy("{} requests queued".format(self.max_queue))
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+        try:
+            start = time.perf_counter()
+            data = self.convert(buffer, height, width, channels)
+            queued = time.perf_counter()
+            pred_bbox = self.engine.infer(data["image_data"])
+            inferred = time.perf_counter()
+            bboxes = self.postprocessor.run(pred_bbox, data["frame_size"])
+            lights = self.classify(data["frame"], bboxes)
+            return {"frame": frame_id, "lights": lights, "inference_ms": (inferred - queued) * 1000.0,
+                    "total_ms": (time.perf_counter() - start) * 1000.0}
+        except ValueError:
+            raise
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+
+def respond(service, buffer, height, width, channels, frame_id):
+    """
+    Returns (HTTP status, reply dict) of one request, errors included.
+    """
+    try:
+        return 200, service.detect(buffer, height, width, channels, frame_id)
+    except ServiceBusy as error:
+        return 503, {"frame": frame_id, "error": "busy", "message": str(error)}
+    except ValueError as error:
+        return 400, {"frame": frame_id, "error": "bad request", "message": str(error)}
+    except Exception as error:
+        return 500, {"frame": frame_id, "error": "internal", "message": repr(error)}
+
+
+def read_exactly(stream, size):
+    """
+    Reads size bytes into a new bytearray, or returns None at end of stream.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = stream.readinto(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+# ==============================================================================
+# -- servers -------------------------------------------------------------------
+# ==============================================================================
+
+
+class UnixHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the framed binary protocol until the client disconnects.
+    """
+
+    def reply(self, body):
+        body = json.dumps(body).encode("utf-8")
+        self.wfile.write(LENGTH.pack(len(body)) + body)
+
+    def handle(self):
+        service = self.server.service
+        while True:
+            header = read_exactly(self.rfile, HEADER.size)
+            if header is None:
+                return
+            magic, height, width, channels, frame_id = HEADER.unpack(header)
+            frame_id = None if frame_id < 0 else frame_id
+            size = height * width * channels
+            if magic != MAGIC or size > MAX_FRAME_BYTES:
+                # The stream can no longer be framed, give up on it.
+                self.reply({"frame": frame_id, "error": "bad request", "message": "bad header"})
+                return
+            buffer = read_exactly(self.rfile, size)
+            if buffer is None:
+                return
+            self.reply(respond(service, buffer, height, width, channels, frame_id)[1])
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+        self.service = service
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, UnixHandler)
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    """
+    POST /detect and GET /stats.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.reply(404, {"error": "not found"})
+            return
+        self.reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if self.path != "/detect" or length > MAX_FRAME_BYTES:
+            self.send_error(404 if self.path != "/detect" else 413)
+            self.close_connection = True
+            return
+        buffer = read_exactly(self.rfile, length)
+        if buffer is None:
+            self.close_connection = True
+            return
+        frame_id = self.headers.get("X-Frame-Id")
+        try:
+            frame_id = None if frame_id is None else int(frame_id)
+        except ValueError:
+            self.reply(400, {"frame": None, "error": "bad request", "message": "X-Frame-Id must be an integer"})
+            return
+        try:
+            height, width, channels = [int(v) for v in self.headers["X-Frame-Shape"].split(",")]
+        except (AttributeError, ValueError):
+            self.reply(400, {"frame": frame_id, "error": "bad request",
+                             "message": "X-Frame-Shape must be height,width,channels"})
+            return
+        self.reply(*respond(self.server.service, buffer, height, width, channels, frame_id))
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, port, service):
+        self.service = service
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), HttpHandler)
+
+
+def serve(service, unix_path=None, port=None):
+    """
+    Starts the requested servers on background threads and returns them.
+    """
+    servers = []
+    if unix_path is not None:
+        servers.append(UnixServer(unix_path, service))
+    if port is not None:
+        servers.append(HttpServer(port, service))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name="service", daemon=True).start()
+    return servers
+
+
+# ==============================================================================
+# -- client --------------------------------------------------------------------
+# ==============================================================================
+
+
+class DetectionClient(object):
+    """
+    Sends frames to a service at a Unix socket path or an http://host:port
+    address over one persistent connection. Not thread safe, use one client
+    per thread.
+    """
+
+    def __init__(self, address, timeout=10.0):
+        self.address = address
+        self.timeout = timeout
+        self._socket = None
+        self._stream = None
+        self._http = None
+        if address.startswith("http://"):
+            host, port = address[len("http://"):].rstrip("/").split(":")
+            self._http = http.client.HTTPConnection(host, int(port), timeout=timeout)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            self._socket.connect(address)
+            self._stream = self._socket.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def detect(self, frame, frame_id=None):
+        """
+        Returns the reply dict for a (height, width, 3) BGR or (height, width,
+        4) BGRA uint8 frame. Raises ServiceBusy when the service is full.
+        """
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        height, width, channels = frame.shape
+        if self._http is not None:
+            headers = {"X-Frame-Shape": "{},{},{}".format(height, width, channels),
+                       "Content-Type": "application/octet-stream"}
+            if frame_id is not None:
+                headers["X-Frame-Id"] = str(frame_id)
+            self._http.request("POST", "/detect", body=memoryview(frame).cast("B"), headers=headers)
+            reply = json.loads(self._http.getresponse().read().decode("utf-8"))
+        else:
+            header = HEADER.pack(MAGIC, height, width, channels, -1 if frame_id is None else frame_id)
+            self._socket.sendall(header)
+            self._socket.sendall(memoryview(frame).cast("B"))
+            length = read_exactly(self._stream, LENGTH.size)
+            if length is None:
+                raise ConnectionError("service closed the connection")
+            reply = json.loads(read_exactly(self._stream, LENGTH.unpack(length)[0]).decode("utf-8"))
+        if reply.get("error") == "busy":
+            raise ServiceBusy(reply["message"])
+        if "error" in reply:
+            raise RuntimeError("{}: {}".format(reply["error"], reply["message"]))
+        return reply
+
+    def close(self):
+        if self._http is not None:
+            self._http.close()
+        if self._stream is not None:
+            self._stream.close()
+            self._socket.close()
+
+
+# ==============================================================================
+# -- load test -----------------------------------------------------------------
+# ==============================================================================
+
+
+def load_test(address, clients=4, requests=100, width=1920, height=1080):
+    """
+    Sends requests synthetic frames from each of clients threads. Returns
+    {"fps", "p50_ms", "p99_ms", "busy", "lights"}.
+    """
+    from light_classifier import synthetic_frame
+
+    frames = [synthetic_frame(width, height, 4, seed=i)[0] for i in range(4)]
+    latencies = []
+    counts = {"busy": 0, "lights": 0}
+    lock = threading.Lock()
+
+    def run(worker):
+        with DetectionClient(address) as client:
+            for i in range(requests):
+                start = time.perf_counter()
+                try:
+                    reply = client.detect(frames[(worker + i) % len(frames)], i)
+                except ServiceBusy:
+                    with lock:
+                        counts["busy"] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+                    counts["lights"] += len(reply["lights"])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000.0 if latencies else np.zeros(1)
+    return {"fps": len(latencies) / wall, "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)), "busy": counts["busy"], "lights": counts["lights"]}
+
+
+def main():
+    from backends import BACKENDS, TF1Backend, make_backend
+    from model_cache import DEFAULT_CACHE_DIR
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--unix", default=None, help="Serve on this Unix socket path ({} if no --port)".format(
+        DEFAULT_SOCKET))
+    ap.add_argument("--port", type=int, default=None, help="Serve HTTP on this localhost port")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name, help="Inference backend")
+    ap.add_argument("--model", default=None, help="Model file of the backend")
+    ap.add_argument("--model-cache", default=DEFAULT_CACHE_DIR, help="Directory of cached optimized models")
+    ap.add_argument("--no-model-cache", action="store_true", help="Always load the model from --model")
+    ap.add_argument("--intra-op-threads", type=int, default=0, help="Threads inside one operator")
+    ap.add_argument("--inter-op-threads", type=int, default=0, help="Operators run in parallel")
+    ap.add_argument("--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("--classes", default=str(detector.TRAFFIC_LIGHT_CLASS),
+                    help="Comma separated COCO class ids to report")
+    ap.add_argument("--max-batch-size", type=int, default=8, help="Frames grouped into one backend run")
+    ap.add_argument("--max-batch-wait", type=float, default=5.0, help="Milliseconds a frame may wait for its batch")
+    ap.add_argument("--max-queue", type=int, default=32, help="Requests in the service before it answers busy")
+    ap.add_argument("--load", default=None, help="Load test the service at this socket path or http:// address")
+    ap.add_argument("--clients", type=int, default=4, help="Concurrent load test clients")
+    ap.add_argument("--requests", type=int, default=100, help="Frames per load test client")
+    ap.add_argument("-wi", "--width", type=int, default=1920, help="Load test frame width")
+    ap.add_argument("-he", "--height", type=int, default=1080, help="Load test frame height")
+    args = vars(ap.parse_args())
+
+    if args["load"] is not None:
+        results = load_test(args["load"], args["clients"], args["requests"], args["width"], args["height"])
+        print("{fps:.1f} frames/s, p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, {busy} busy, {lights} lights".format(
+            **results))
+        return
+
+    cache_dir = None if args["no_model_cache"] else args["model_cache"]
+    backend = make_backend(args["backend"], args["model"], 80, args["intra_op_threads"], args["inter_op_threads"],
+                           cache_dir)
+    batch_sizes = sorted({1, args["max_batch_size"]})
+    print("warm-up {:.2f} s".format(backend.warmup(args["input_size"], batch_sizes)))
+
+    class_ids = [int(c) for c in args["classes"].split(",")]
+    unix_path = args["unix"] if args["unix"] is not None or args["port"] is not None else DEFAULT_SOCKET
+    with DetectionService(backend, args["input_size"], args["max_batch_size"], args["max_batch_wait"] / 1000.0,
+                          args["max_queue"], class_ids) as service:
+        servers = serve(service, unix_path, args["port"])
+        addresses = [unix_path] if unix_path is not None else []
+        if args["port"] is not None:
+            addresses.append("http://127.0.0.1:{}".format(args["port"]))
+        print("serving on {}".format(", ".join(addresses)))
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            backend.close()
+            print(json.dumps(service.stats()))
+
+
+if __name__ == "__main__":
+    main()
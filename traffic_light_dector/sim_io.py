@@ -0,0 +1,312 @@
+"""
+Simulator I/O on its own thread, decoupled from rendering and detection.
+
+In the serial loop the world tick, car.get_control()/apply_control() and
+world.set_weather() run once per loop iteration, after detection and
+display, so driving gets sluggish as soon as detection slows down.
+SimulatorIO owns the world and the car on a dedicated thread and runs two
+periodic tasks on their own schedule:
+    tick      world.tick() at tick_rate Hz; the camera images reach the
+              detection side through the FrameSync as before, and a
+              Telemetry is published after every tick
+    control   applies the latest DriveCommand at control_rate Hz, keeping
+              the VehicleControl locally instead of fetching it each time
+Weather changes are queued and applied before the next tick.
+
+Commands and telemetry go through Channels, latest-value slots that never
+block either side: a slow reader only misses superseded values. Keyboard
+polling stays on the main thread, pygame requires it, but it now only
+publishes a DriveCommand.
+
+Control-loop jitter is the lateness of every control run against its
+schedule, stats() reports its percentiles with the achieved rates; with
+metrics enabled it is also observed as the control_jitter and tick_jitter
+stages.
+
+Run this module to measure the jitter of the control loop next to a slow
+detection loop on a FakeWorld:
+    python sim_io.py --detection-ms 80 --seconds 5
+"""
+
+import argparse
+import math
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from metrics import NullMetrics
+
+DriveCommand = namedtuple("DriveCommand", ["throttle", "reverse", "steer", "hand_brake"])
+DriveCommand.__doc__ = """
+Keys held by the driver: throttle and reverse as booleans, steer -1 (left),
+0 or 1 (right), hand_brake as a boolean.
+"""
+IDLE = DriveCommand(False, False, 0, False)
+
+Telemetry = namedtuple("Telemetry", ["frame", "timestamp", "speed", "throttle", "steer", "reverse", "hand_brake"])
+Telemetry.__doc__ = """
+State after a tick: simulator frame number, time.time() of the tick, speed
+in m/s and the control last applied.
+"""
+
+STEER_STEP = 0.05
+
+
+def steer_control(control, command):
+    """
+    Updates a VehicleControl from a DriveCommand the way the keyboard control
+    of BasicSynchronousClient always did.
+    """
+    control.throttle = 0
+    if command.throttle:
+        control.throttle = 1
+        control.reverse = command.reverse
+    if command.steer < 0:
+        control.steer = max(-1., min(control.steer - STEER_STEP, 0))
+    elif command.steer > 0:
+        control.steer = min(1., max(control.steer + STEER_STEP, 0))
+    else:
+        control.steer = 0
+    control.hand_brake = command.hand_brake
+    return control
+
+
+class Channel(object):
+    """
+    Latest-value slot between threads. put() replaces the value, get()
+    returns it without waiting; neither blocks the other side for longer
+    than a lock hand-over.
+    """
+
+    def __init__(self, value=None):
+        self.version = 0
+        self._value = value
+        self._lock = threading.Lock()
+
+    def put(self, value):
+        with self._lock:
+            self._value = value
+            self.version += 1
+
+    def get(self):
+        """
+        Returns (version, value); the version tells a reader whether the
+        value changed since it last looked.
+        """
+        with self._lock:
+            return self.version, self._value
+
+
+class PeriodicTask(object):
+    """
+    Schedule and lateness record of one task of SimulatorIO.
+    """
+
+    def __init__(self, name, rate, history=4096):
+        self.name = name
+        self.period = 1.0 / rate
+        self.runs = 0
+        self.overruns = 0
+        self.next_run = None
+        self.lateness = deque(maxlen=history)
+        self._first = None
+        self._last = None
+
+    def due(self, now):
+        return self.next_run is None or now >= self.next_run
+
+    def ran(self, now):
+        """
+        Records a run that started at now and schedules the next one.
+        Returns the run's lateness in seconds.
+        """
+        late = 0.0 if self.next_run is None else now - self.next_run
+        self.next_run = now + self.period if self.next_run is None else self.next_run + self.period
+        if self.next_run < now:
+            # Fell a whole period behind: skip the missed runs instead of bursting.
+            self.overruns += 1
+            self.next_run = now + self.period
+        self.lateness.append(late)
+        self.runs += 1
+        if self._first is None:
+            self._first = now
+        self._last = now
+        return late
+
+    def stats(self):
+        lateness = np.array(self.lateness) * 1000.0 if self.lateness else np.zeros(1)
+        elapsed = (self._last - self._first) if self.runs > 1 else 0.0
+        return {"runs": self.runs, "rate": (self.runs - 1) / elapsed if elapsed else 0.0,
+                "target_rate": 1.0 / self.period, "overruns": self.overruns,
+                "jitter_p50_ms": float(np.percentile(lateness, 50)),
+                "jitter_p99_ms": float(np.percentile(lateness, 99)), "jitter_max_ms": float(lateness.max())}
+
+
+class SimulatorIO(object):
+    """
+    Ticks the world and drives the car on a background thread. The caller
+    keeps reading camera images from its FrameSync.
+    """
+
+    def __init__(self, world, car, tick_rate=20.0, control_rate=20.0, metrics=None, drive=True):
+        self.world = world
+        self.car = car
+        self.drive = drive
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.commands = Channel(IDLE)
+        self.telemetry = Channel()
+        self.tick_task = PeriodicTask("tick", tick_rate)
+        self.control_task = PeriodicTask("control", control_rate)
+        self.error = None
+
+        self._weather = queue.Queue()
+        self._control = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.drive:
+            self._control = self.car.get_control()
+        self._thread = threading.Thread(target=self._loop, name="simulator-io", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def command(self, command):
+        """
+        Publishes the driver's keys, applied at the next control run.
+        """
+        self.commands.put(command)
+
+    def set_weather(self, weather):
+        """
+        Queues a weather change, applied before the next tick.
+        """
+        self._weather.put_nowait(weather)
+
+    def stats(self):
+        return {"tick": self.tick_task.stats(), "control": self.control_task.stats()}
+
+    def _run_control(self):
+        _, command = self.commands.get()
+        self.car.apply_control(steer_control(self._control, command))
+
+    def _run_tick(self):
+        while True:
+            try:
+                weather = self._weather.get_nowait()
+            except queue.Empty:
+                break
+            self.world.set_weather(weather)
+        frame = self.world.tick()
+        if frame is None:
+            frame = self.world.get_snapshot().frame
+        velocity = self.car.get_velocity()
+        speed = math.sqrt(velocity.x ** 2 + velocity.y ** 2 + velocity.z ** 2)
+        control = self._control if self._control is not None else self.car.get_control()
+        self.telemetry.put(Telemetry(frame, time.time(), speed, control.throttle, control.steer,
+                                     control.reverse, control.hand_brake))
+
+    def _loop(self):
+        tasks = [(self.tick_task, self._run_tick)]
+        if self.drive:
+            tasks.append((self.control_task, self._run_control))
+        try:
+            while not self._stop.is_set():
+                now = time.perf_counter()
+                for task, run in tasks:
+                    if task.due(now):
+                        self.metrics.observe(task.name + "_jitter", task.ran(now))
+                        run()
+                        now = time.perf_counter()
+                wait = min(task.next_run for task, _ in tasks) - time.perf_counter()
+                if wait > 0:
+                    self._stop.wait(wait)
+        except Exception as error:
+            # The detection side notices through running and re-raises.
+            self.error = error
+
+
+def print_stats(stats):
+    for name, task in sorted(stats.items()):
+        print("{}: {runs} runs at {rate:.1f}/{target_rate:.1f} Hz, {overruns} overruns, jitter p50 "
+              "{jitter_p50_ms:.2f} ms, p99 {jitter_p99_ms:.2f} ms, max {jitter_max_ms:.2f} ms".format(name, **task))
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def serial_control(world, car, detection_seconds, seconds, rate=20.0):
+    """
+    The previous loop: tick, detect, then apply control. Returns the stats
+    of its control runs against a schedule of rate Hz.
+    """
+    task = PeriodicTask("control", rate)
+    control = car.get_control()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        world.tick()
+        time.sleep(detection_seconds)
+        task.ran(time.perf_counter())
+        control = car.get_control()
+        car.apply_control(steer_control(control, IDLE))
+    return task.stats()
+
+
+def main():
+    import fake_carla
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--detection-ms", type=float, default=80.0, help="Simulated detection time per frame")
+    ap.add_argument("--seconds", type=float, default=5.0, help="Duration of each run")
+    ap.add_argument("--tick-rate", type=float, default=20.0, help="World ticks per second")
+    ap.add_argument("--control-rate", type=float, default=20.0, help="Control runs per second")
+    args = vars(ap.parse_args())
+
+    def world():
+        client = fake_carla.FakeClient()
+        client.load_world("Town01")
+        world = client.get_world()
+        car = world.spawn_actor(world.get_blueprint_library().filter("vehicle.*")[0])
+        return world, car
+
+    detection = args["detection_ms"] / 1000.0
+    stats = serial_control(*world(), detection_seconds=detection, seconds=args["seconds"],
+                           rate=args["control_rate"])
+    print("serial loop with {:.0f} ms detection".format(args["detection_ms"]))
+    print_stats({"control": stats})
+
+    with SimulatorIO(*world(), tick_rate=args["tick_rate"], control_rate=args["control_rate"]) as io:
+        deadline = time.perf_counter() + args["seconds"]
+        while time.perf_counter() < deadline:
+            io.command(DriveCommand(True, False, 1, False))
+            time.sleep(detection)
+    print("simulator I/O thread with {:.0f} ms detection".format(args["detection_ms"]))
+    print_stats(io.stats())
+
+
+if __name__ == "__main__":
+    main()
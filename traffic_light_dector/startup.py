@@ -0,0 +1,131 @@
+"""
+Startup timing of the detector.
+
+StartupTimer records named phases (imports, model, warm-up, world, first
+detection) from the moment it was created; yolov3_object_detection.py creates
+one before its imports and prints it at the first detection.
+
+Run this module to measure time-to-first-detection of fresh processes, with
+and without the model cache and the warm-up pass, without a CARLA server:
+    python startup.py --backends tf,onnxruntime --repeats 3
+Each run starts a new interpreter that imports the detection modules, builds
+the backend, optionally warms it up, then detects on one synthetic frame.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class StartupTimer(object):
+    """
+    Seconds from creation to each marked phase.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        self.phases.append((name, time.perf_counter() - self.start))
+
+    def report(self):
+        parts = []
+        previous = 0.0
+        for name, elapsed in self.phases:
+            parts.append("{} {:.2f} s (+{:.2f})".format(name, elapsed, elapsed - previous))
+            previous = elapsed
+        return "startup: " + ", ".join(parts)
+
+
+def first_detection(backend_name, model, cache_dir, warmup, input_size=416):
+    """
+    The measured child process: returns its phase timings.
+    """
+    timer = StartupTimer()
+    import numpy as np
+
+    import detector
+    from backends import make_backend
+    from frame_convert import FrameConverter
+    from light_classifier import synthetic_frame
+    from postprocess import ClassFilteredPostprocessor
+    timer.mark("imports")
+
+    backend = make_backend(backend_name, model, 80, cache_dir=cache_dir)
+    timer.mark("model")
+    if warmup:
+        backend.warmup(input_size)
+        timer.mark("warm-up")
+
+    frame, _ = synthetic_frame(1920, 1080, 4)
+    converter = FrameConverter(1920, 1080, input_size)
+    raw_data = np.dstack([frame, np.full(frame.shape[:2], 255, np.uint8)]).tobytes()
+    data = converter.letterbox(converter.convert(raw_data))
+    data = ClassFilteredPostprocessor(input_size, (detector.TRAFFIC_LIGHT_CLASS,))(backend(data))
+    timer.mark("first detection")
+    # A second frame shows the steady state the warm-up aims for.
+    start = time.perf_counter()
+    backend(data)
+    steady = time.perf_counter() - start
+    backend.close()
+    return {"phases": dict(timer.phases), "steady_inference": steady}
+
+
+def run_child(backend_name, model, cache_dir, warmup):
+    """
+    Runs first_detection in a fresh interpreter. Returns its timings plus
+    the process wall time, interpreter startup and exit included.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--backends", backend_name,
+               "--cache-dir", cache_dir or ""]
+    if model is not None:
+        command += ["--model", model]
+    if not warmup:
+        command.append("--no-warmup")
+    start = time.perf_counter()
+    output = subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    result["wall"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backends", default="tf", help="Comma separated backends to measure")
+    ap.add_argument("--model", default=None, help="Model file, the backend default if not given")
+    ap.add_argument("--repeats", type=int, default=3, help="Fresh processes per configuration")
+    ap.add_argument("--cache-dir", default=None, help="Model cache directory, a temporary one by default")
+    ap.add_argument("--no-warmup", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args["child"]:
+        print(json.dumps(first_detection(args["backends"], args["model"], args["cache_dir"] or None,
+                                         not args["no_warmup"])))
+        return
+
+    cache_dir = args["cache_dir"] or tempfile.mkdtemp(prefix="model_cache_")
+    print("{:12s} {:6s} {:7s} {:>9s} {:>9s} {:>9s} {:>11s} {:>9s}".format(
+        "backend", "cache", "warm-up", "imports", "model", "detect", "first det.", "steady"))
+    for backend_name in args["backends"].split(","):
+        configurations = [(None, False), (None, True), (cache_dir, True)]
+        # Populate the cache so the cached runs measure a warm start.
+        run_child(backend_name, args["model"], cache_dir, False)
+        for cache, warmup in configurations:
+            runs = [run_child(backend_name, args["model"], cache, warmup) for _ in range(args["repeats"])]
+            runs.sort(key=lambda r: r["phases"]["first detection"])
+            median = runs[len(runs) // 2]
+            phases = median["phases"]
+            detect = phases["first detection"] - phases.get("warm-up", phases["model"])
+            print("{:12s} {:6s} {:7s} {:9.2f} {:9.2f} {:9.3f} {:11.2f} {:9.3f}".format(
+                backend_name, "yes" if cache else "no", "yes" if warmup else "no", phases["imports"],
+                phases["model"] - phases["imports"], detect, phases["first detection"], median["steady_inference"]))
+
+
+if __name__ == "__main__":
+    main()
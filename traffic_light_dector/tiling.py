@@ -0,0 +1,322 @@
+"""
+Tiled, multi-scale YOLOv3 detection for small, distant traffic lights.
+
+Letterboxing a 1920x1080 frame into the 416x416 network input shrinks it
+4.6 times, so a distant traffic light is only a few pixels tall when it
+reaches the network. TiledDetector also cuts a region of the frame into
+overlapping tile_size x tile_size tiles, scales each to the input size
+(no scaling when tile_size == input_size, i.e. native resolution) and runs
+all of them, optionally together with the usual whole-frame input, through
+the backend in batches. Detections of every tile are moved back to frame
+coordinates and merged by cross-tile NMS, which also drops boxes cut at a
+tile border that lie mostly inside a better box.
+
+Run this module to compare recall and latency of single-shot inference and
+tiled configurations on replayed frames:
+    python tiling.py data/ --tiles 416:0.25,608:0.2 --labels Dataset/carla_dataset.csv
+Without --labels, recall is measured against the merged detections of all
+configurations.
+"""
+
+import argparse
+import csv
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import detector
+from batching import BatchInferenceEngine
+from postprocess import ClassFilteredPostprocessor
+
+
+def tile_windows(width, height, tile_size, overlap=0.25, region=None):
+    """
+    Returns (x0, y0, x1, y1) tiles of tile_size covering region, given as
+    (x0, y0, x1, y1) frame fractions (the whole frame if None). Neighbouring
+    tiles share at least overlap * tile_size pixels; the last tile of a row
+    or column is aligned to the region's edge.
+    """
+    if region is None:
+        region = (0.0, 0.0, 1.0, 1.0)
+    rx0, ry0 = int(region[0] * width), int(region[1] * height)
+    rx1, ry1 = int(region[2] * width), int(region[3] * height)
+    # Tiles stay square, the network input is.
+    tile_w = tile_h = min(tile_size, width, height)
+    # A region smaller than a tile grows to one tile, kept inside the frame.
+    if rx1 - rx0 < tile_w:
+        rx0 = max(0, min(rx0, width - tile_w))
+        rx1 = rx0 + tile_w
+    if ry1 - ry0 < tile_h:
+        ry0 = max(0, min(ry0, height - tile_h))
+        ry1 = ry0 + tile_h
+
+    def starts(lo, hi, size):
+        stride = max(1, int(size * (1.0 - overlap)))
+        positions = list(range(lo, hi - size + 1, stride))
+        if positions[-1] + size < hi:
+            positions.append(hi - size)
+        return positions
+
+    return [(x, y, x + tile_w, y + tile_h) for y in starts(ry0, ry1, tile_h) for x in starts(rx0, rx1, tile_w)]
+
+
+def cross_tile_nms(detections, iou_threshold=detector.IOU_THRESHOLD, containment=0.7):
+    """
+    Greedy NMS per class over detections from overlapping tiles. Besides
+    boxes overlapping a better one by iou_threshold, boxes covered by a
+    better one for more than containment of their own area are removed.
+    """
+    if len(detections) == 0:
+        return np.zeros((0, 6))
+    detections = detections[np.lexsort((-detections[:, 4], detections[:, 5]))]
+    boxes = detections[:, :4]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    x0 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y0 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x1 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y1 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    inter = np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)
+    iou = inter / np.maximum(area[:, None] + area[None, :] - inter, 1e-9)
+    # covered[i, j]: share of box j inside box i
+    covered = inter / np.maximum(area[None, :], 1e-9)
+    same_class = detections[:, 5][:, None] == detections[:, 5][None, :]
+    overlapping = same_class & ((iou > iou_threshold) | (covered > containment))
+
+    suppressed = np.zeros(len(detections), dtype=bool)
+    keep = []
+    for i in range(len(detections)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= overlapping[i]
+    return detections[keep]
+
+
+class TiledDetector(object):
+    """
+    Runs tiled detection on a frame dict and fills data["bboxes"].
+    inference is a backends.InferenceBackend; tiles go through it in runs of
+    at most max_batch_size. With full_frame the letterboxed whole frame
+    (data["image_data"] if set, else detector.preprocess) is run as well.
+    class_ids limits decoding to those classes, None keeps all.
+    """
+
+    def __init__(self, inference, input_size=416, tile_size=416, overlap=0.25, region=None, full_frame=True,
+                 max_batch_size=8, class_ids=(detector.TRAFFIC_LIGHT_CLASS,),
+                 score_threshold=detector.SCORE_THRESHOLD, iou_threshold=detector.IOU_THRESHOLD):
+        self.input_size = input_size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.region = region
+        self.full_frame = full_frame
+        self.max_batch_size = max(1, max_batch_size)
+        self.iou_threshold = iou_threshold
+        self.postprocessor = ClassFilteredPostprocessor(input_size, class_ids, score_threshold=score_threshold,
+                                                        iou_threshold=iou_threshold)
+        self.engine = BatchInferenceEngine(inference, self.max_batch_size)
+        self.tiles_run = 0
+        self._windows = {}
+        self._local = threading.local()
+
+    @property
+    def inference(self):
+        return self.engine.backend
+
+    @inference.setter
+    def inference(self, backend):
+        self.engine.backend = backend
+
+    def windows(self, width, height):
+        key = (width, height)
+        if key not in self._windows:
+            self._windows[key] = tile_windows(width, height, self.tile_size, self.overlap, self.region)
+        return self._windows[key]
+
+    def _inputs(self, count):
+        inputs = getattr(self._local, "inputs", None)
+        if inputs is None or inputs.shape[0] < count:
+            inputs = np.empty((count, self.input_size, self.input_size, 3), dtype=np.float32)
+            self._local.inputs = inputs
+        return inputs
+
+    def __call__(self, data):
+        frame = data["frame"]
+        height, width = frame.shape[:2]
+        windows = self.windows(width, height)
+
+        inputs = self._inputs(len(windows))
+        size = (self.input_size, self.input_size)
+        for i, (x0, y0, x1, y1) in enumerate(windows):
+            tile = frame[y0:y1, x0:x1]
+            if tile.shape[:2] != size:
+                tile = cv2.resize(tile, size, interpolation=cv2.INTER_LINEAR)
+            np.multiply(tile, 1.0 / 255.0, out=inputs[i], casting="unsafe")
+        images = list(inputs[:len(windows)])
+        if self.full_frame:
+            if "image_data" not in data:
+                data = detector.preprocess(data, self.input_size)
+            images.append(data["image_data"])
+
+        predictions = []
+        for i in range(0, len(images), self.max_batch_size):
+            predictions.extend(self.engine.run_batch(images[i:i + self.max_batch_size]))
+        self.tiles_run += len(windows)
+
+        detections = []
+        for (x0, y0, x1, y1), pred_bbox in zip(windows, predictions):
+            bboxes = self.postprocessor.run(pred_bbox, (y1 - y0, x1 - x0))
+            bboxes[:, [0, 2]] += x0
+            bboxes[:, [1, 3]] += y0
+            detections.append(bboxes)
+        if self.full_frame:
+            detections.append(self.postprocessor.run(predictions[-1], (height, width)))
+
+        data["bboxes"] = list(cross_tile_nms(np.concatenate(detections, axis=0), self.iou_threshold))
+        return data
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+class SingleShotDetector(object):
+    """
+    The usual whole-frame 416 detection, for comparison.
+    """
+
+    def __init__(self, inference, input_size=416):
+        self.inference = inference
+        self.input_size = input_size
+        self.postprocessor = ClassFilteredPostprocessor(input_size)
+
+    def __call__(self, data):
+        data = detector.preprocess(data, self.input_size)
+        data["pred_bbox"] = self.inference.predict(data["image_data"])
+        return self.postprocessor(data)
+
+
+def load_labels(csv_path):
+    """
+    Reads a Log annotation CSV into {file name: (N, 4) [x0, y0, x1, y1]}.
+    """
+    labels = {}
+    with open(csv_path) as f:
+        reader = csv.reader(f, delimiter=";")
+        next(reader)
+        for row in reader:
+            box = [float(v) for v in row[2:6]]
+            labels.setdefault(row[0], []).append(box)
+    return dict((name, np.array(boxes)) for name, boxes in labels.items())
+
+
+def box_iou(a, b):
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def recall(truth, found, iou_threshold=0.3):
+    """
+    Returns (matched, total) ground truth boxes over frames.
+    """
+    matched = total = 0
+    for boxes, detections in zip(truth, found):
+        total += len(boxes)
+        if len(boxes) and len(detections):
+            matched += int((box_iou(boxes, detections[:, :4]).max(axis=1) >= iou_threshold).sum())
+    return matched, total
+
+
+def benchmark(frames, detectors, truth=None):
+    """
+    Runs every named detector over the BGR frames. Returns
+    {name: {"recall", "mean_ms", "p50_ms", "p99_ms", "lights"}}.
+    """
+    found = {}
+    latencies = {}
+    for name, detect in detectors:
+        found[name], latencies[name] = [], []
+        for frame in frames:
+            data = {"frame": frame, "image": frame[:, :, ::-1], "frame_size": frame.shape[:2]}
+            start = time.perf_counter()
+            data = detect(data)
+            latencies[name].append(time.perf_counter() - start)
+            found[name].append(np.asarray(data["bboxes"]).reshape(-1, 6))
+
+    if truth is None:
+        # Pseudo ground truth: what any configuration found.
+        truth = [cross_tile_nms(np.concatenate([found[name][i] for name, _ in detectors], axis=0))[:, :4]
+                 for i in range(len(frames))]
+
+    results = {}
+    for name, _ in detectors:
+        matched, total = recall(truth, found[name])
+        ms = np.asarray(latencies[name]) * 1000.0
+        results[name] = {
+            "recall": matched / float(total) if total else 0.0,
+            "lights": int(sum(len(f) for f in found[name])),
+            "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p99_ms": float(np.percentile(ms, 99)),
+        }
+    return results
+
+
+def main():
+    from backends import BACKENDS, TF1Backend, make_backend
+    from replay import LimitedSource, PngDirectorySource, open_source
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("source", help="PNG directory, video file or .npz archive")
+    ap.add_argument("--pattern", default="frame_*.png", help="File pattern inside a PNG directory")
+    ap.add_argument("--labels", default=None, help="Log annotation CSV naming the frames of source")
+    ap.add_argument("--tiles", default="416:0.25", help="Comma separated tile_size:overlap configurations")
+    ap.add_argument("--region", default=None, help="x0,y0,x1,y1 frame fractions to tile")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name, help="Inference backend")
+    ap.add_argument("--model", default=None, help="Model file of the backend")
+    ap.add_argument("-s", "--input-size", type=int, default=416, help="Network input size")
+    ap.add_argument("-n", "--max-frames", type=int, default=50, help="Frames to evaluate")
+    args = vars(ap.parse_args())
+
+    region = None if args["region"] is None else [float(v) for v in args["region"].split(",")]
+    truth = None
+    if args["labels"] is not None:
+        labels = load_labels(args["labels"])
+        source = PngDirectorySource(args["source"], args["pattern"])
+        paths = source.paths[:args["max_frames"]]
+        names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+        frames = [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+        truth = [labels.get(name, np.zeros((0, 4))) for name in names]
+    else:
+        frames = list(LimitedSource(open_source(args["source"], args["pattern"]), args["max_frames"]))
+
+    backend = make_backend(args["backend"], args["model"])
+    try:
+        detectors = [("single {}".format(args["input_size"]), SingleShotDetector(backend, args["input_size"]))]
+        for config in args["tiles"].split(","):
+            tile_size, overlap = config.split(":")
+            detectors.append(("tiles {} / {}".format(tile_size, overlap),
+                              TiledDetector(backend, args["input_size"], int(tile_size), float(overlap), region)))
+        # Warm up the backend before timing.
+        SingleShotDetector(backend, args["input_size"])({"image": frames[0][:, :, ::-1]})
+        results = benchmark(frames, detectors, truth)
+    finally:
+        backend.close()
+
+    print("{:20s} {:>8s} {:>8s} {:>9s} {:>9s} {:>9s}".format("detector", "recall", "lights", "mean ms", "p50 ms",
+                                                             "p99 ms"))
+    for name, stats in results.items():
+        print("{:20s} {recall:8.3f} {lights:8d} {mean_ms:9.2f} {p50_ms:9.2f} {p99_ms:9.2f}".format(name, **stats))
+
+
+if __name__ == "__main__":
+    main()
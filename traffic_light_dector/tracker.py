@@ -0,0 +1,263 @@
+"""
+Temporal tracking of traffic light detections.
+
+LightTracker matches each frame's traffic light boxes to the tracks of the
+previous frames, first by IoU and then, for small boxes that moved more than
+their size, by centroid distance. A track keeps its id, lifetime and a
+smoothed state: a new color only replaces the current one after it was seen
+on `hysteresis` consecutive classifications, which removes flicker.
+
+Colors are only re-classified when a track's crop changed noticeably since
+its last classification, or while a new color is waiting for its hysteresis
+confirmations; all crops that need it go in one light_classifier batch. A
+change is measured on a small thumbnail of the classifier's own color
+statistics (share of saturated green, saturated red and bright green pixels
+per cell), so a lamp switching color always counts as a change while
+lighting and noise do not.
+"""
+
+from collections import deque
+
+import cv2
+import numpy as np
+
+from light_classifier import classify_lights, threshold_features
+
+THUMBNAIL_SIZE = (8, 16)  # (width, height), traffic lights are upright
+
+
+def iou_matrix(a, b):
+    """
+    Returns the (len(a), len(b)) IoU matrix of (x0, y0, x1, y1) boxes.
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def centroid_distances(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    ca = np.stack([(a[:, 0] + a[:, 2]) / 2, (a[:, 1] + a[:, 3]) / 2], axis=1)
+    cb = np.stack([(b[:, 0] + b[:, 2]) / 2, (b[:, 1] + b[:, 3]) / 2], axis=1)
+    return np.linalg.norm(ca[:, None, :] - cb[None, :, :], axis=2)
+
+
+def greedy_match(cost, valid):
+    """
+    Matches rows to columns by ascending cost among valid pairs.
+    Returns a list of (row, column).
+    """
+    matches = []
+    if cost.size == 0:
+        return matches
+    rows, cols = np.nonzero(valid)
+    order = np.argsort(cost[rows, cols], kind="stable")
+    used_rows, used_cols = set(), set()
+    for k in order:
+        r, c = rows[k], cols[k]
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        matches.append((r, c))
+    return matches
+
+
+def thumbnail(crop):
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def color_thumbnail(crop):
+    """
+    Returns the (16, 8, 3) shares of saturated green, saturated red and
+    bright green pixels of each thumbnail cell, the inputs of
+    light_classifier's rules.
+    """
+    features = threshold_features(crop)[..., :3].astype(np.float32)
+    features[..., 2] *= 1.0 / 255.0
+    return cv2.resize(features, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+
+class Track(object):
+    """
+    One traffic light followed over time.
+    """
+
+    def __init__(self, track_id, bbox, score, frame_id, history_size):
+        self.track_id = track_id
+        self.bbox = bbox
+        self.score = score
+        self.label = None
+        self.first_frame = frame_id
+        self.last_frame = frame_id
+        self.hits = 1
+        self.misses = 0
+        self.classifications = 0
+        # (frame_id, smoothed label) each time the smoothed label changes
+        self.history = deque(maxlen=history_size)
+
+        self._candidate = None
+        self._candidate_count = 0
+        self._thumbnail = None
+
+    @property
+    def lifetime(self):
+        """
+        Frames between the first and the last detection, both included.
+        """
+        return self.last_frame - self.first_frame + 1
+
+    @property
+    def visible(self):
+        return self.misses == 0
+
+    def observe(self, label, frame_id, hysteresis):
+        """
+        Feeds one classification into the smoothed state.
+        """
+        self.classifications += 1
+        if label is None or label == self.label:
+            self._candidate = None
+            self._candidate_count = 0
+            return
+        if self.label is None:
+            self._set_label(label, frame_id)
+            return
+        if label == self._candidate:
+            self._candidate_count += 1
+        else:
+            self._candidate = label
+            self._candidate_count = 1
+        if self._candidate_count >= hysteresis:
+            self._set_label(label, frame_id)
+
+    def _set_label(self, label, frame_id):
+        self.label = label
+        self._candidate = None
+        self._candidate_count = 0
+        self.history.append((frame_id, label))
+
+
+class LightTracker(object):
+    """
+    IoU / centroid tracker with color hysteresis for traffic lights.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_centroid_distance=20.0, max_misses=5, hysteresis=3,
+                 change_threshold=0.25, history_size=64, finished_size=256):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_distance = max_centroid_distance
+        self.max_misses = max_misses
+        self.hysteresis = hysteresis
+        self.change_threshold = change_threshold
+        self.history_size = history_size
+
+        self.tracks = []
+        self.finished = deque(maxlen=finished_size)
+        self.classified = 0
+        self.reused = 0
+        self._next_id = 0
+
+    def visible_tracks(self):
+        return [track for track in self.tracks if track.visible]
+
+    def update(self, frame, boxes, scores, frame_id):
+        """
+        Updates the tracks with the traffic light boxes of a BGR frame, given
+        as (y0, y1, x0, x1) rows like Light.getScore_Label builds them.
+        Returns the live tracks, visible ones first.
+        """
+        height, width = frame.shape[:2]
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        # (x0, y0, x1, y1), clipped to the frame
+        xyxy = np.stack([np.clip(boxes[:, 2], 0, width), np.clip(boxes[:, 0], 0, height),
+                         np.clip(boxes[:, 3], 0, width), np.clip(boxes[:, 1], 0, height)], axis=1)
+        keep = (xyxy[:, 2] > xyxy[:, 0]) & (xyxy[:, 3] > xyxy[:, 1])
+        xyxy = xyxy[keep]
+        scores = [s for s, k in zip(scores, keep) if k]
+
+        matches = self._match(xyxy)
+        matched_tracks = set(t for t, _ in matches)
+        matched_boxes = set(d for _, d in matches)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+
+        pending = []
+        for t, d in matches:
+            track = self.tracks[t]
+            track.bbox = tuple(int(v) for v in xyxy[d])
+            track.score = scores[d]
+            track.last_frame = frame_id
+            track.hits += 1
+            track.misses = 0
+            pending.append(track)
+        for d in range(len(xyxy)):
+            if d not in matched_boxes:
+                track = Track(self._next_id, tuple(int(v) for v in xyxy[d]), scores[d], frame_id, self.history_size)
+                self._next_id += 1
+                self.tracks.append(track)
+                pending.append(track)
+
+        self._classify(frame, pending, frame_id)
+
+        alive = []
+        for track in self.tracks:
+            if track.misses > self.max_misses:
+                self.finished.append(track)
+            else:
+                alive.append(track)
+        self.tracks = alive
+        return sorted(self.tracks, key=lambda track: track.misses)
+
+    def _match(self, xyxy):
+        if not self.tracks or len(xyxy) == 0:
+            return []
+        previous = np.array([track.bbox for track in self.tracks], dtype=np.float64)
+        iou = iou_matrix(previous, xyxy)
+        matches = greedy_match(-iou, iou >= self.iou_threshold)
+
+        rows = [t for t in range(len(self.tracks)) if t not in set(m[0] for m in matches)]
+        cols = [d for d in range(len(xyxy)) if d not in set(m[1] for m in matches)]
+        if rows and cols:
+            distances = centroid_distances(previous[rows], xyxy[cols])
+            for r, c in greedy_match(distances, distances <= self.max_centroid_distance):
+                matches.append((rows[r], cols[c]))
+        return matches
+
+    def _classify(self, frame, tracks, frame_id):
+        """
+        Re-classifies the tracks whose crop changed, in one batch.
+        """
+        changed = []
+        thumbnails = []
+        for track in tracks:
+            x0, y0, x1, y1 = track.bbox
+            thumb = color_thumbnail(frame[y0:y1, x0:x1])
+            if (track._thumbnail is None or track.label is None or track._candidate is not None
+                    or np.abs(thumb - track._thumbnail).max() > self.change_threshold):
+                changed.append(track)
+                thumbnails.append(thumb)
+            else:
+                self.reused += 1
+        if not changed:
+            return
+
+        boxes = [[t.bbox[1], t.bbox[3], t.bbox[0], t.bbox[2]] for t in changed]
+        results = dict((r.bbox, r) for r in classify_lights(frame, boxes, [t.score for t in changed]))
+        for track, thumb in zip(changed, thumbnails):
+            result = results.get(track.bbox)
+            track._thumbnail = thumb
+            track.observe(result.label if result is not None else None, frame_id, self.hysteresis)
+            self.classified += 1
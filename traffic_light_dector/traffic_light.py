@@ -1,22 +1,52 @@
 import cv2
 import numpy as np
-from tensorflow_yolov3.carla.config import cfg
-from tensorflow_yolov3.carla.utils import read_class_names
+import detector
 from log import Log
+from light_classifier import ClassifiedLight, classify_lights
+from display import Cv2Sink, NullSink
 from os import listdir
 
+def read_class_names(class_file_name):
+    """
+    Same as utils.read_class_names, without importing TensorFlow with utils.
+    """
+    names = {}
+    with open(class_file_name, 'r') as data:
+        for ID, name in enumerate(data):
+            names[ID] = name.strip('\n')
+    return names
+
+
 class Light(Log):
     state = None
     classes = None
     bbx = []
     scores = []
     img_index = 0
-    score_th = 0.50
+    score_th = detector.LIGHT_SCORE_THRESHOLD
     key = None
+    sink = None
+    lights = []
 
-    def __init__(self, town = "town01" ):
-        self.classes = read_class_names(cfg.YOLO.CLASSES)
-        Log.__init__(self, "carla_dataset", town)
+    def __init__(self, town = "town01", show = True, sink = None, file_name = "carla_dataset", base_dir = None,
+                 classes = None):
+        """
+        Crops are shown on sink, a display.DisplaySink. Without one they go
+        to HighGUI windows, or nowhere when show is False. file_name and
+        base_dir name the annotation CSV (see Log). classes maps class ids to
+        names, read from the tensorflow_yolov3 config when None.
+        """
+        if(classes is None):
+            from tensorflow_yolov3.carla.config import cfg
+            classes = read_class_names(cfg.YOLO.CLASSES)
+        self.classes = classes
+        # Per instance, the class lists would collect the candidates of every Light.
+        self.bbx = []
+        self.scores = []
+        if(sink is None):
+            sink = Cv2Sink() if show else NullSink()
+        self.sink = sink
+        Log.__init__(self, file_name, town, base_dir)
 
     def __del__(self):
         pass
@@ -46,32 +76,63 @@ class Light(Log):
         return frame
 
     def process_traffic_light(self, frame, bboxes):
+        """
+        Classifies every traffic light candidate of the frame in one batch.
+        self.lights keeps the ClassifiedLight results, self.state and the
+        returned bbox describe the first candidate with a known color.
+        """
         self.getScore_Label(bboxes)
-        key = None
-        semaphore = np.zeros_like(frame)
-        j = 0
+        lights = classify_lights(frame, self.bbx, self.scores)
+        self.bbx = []
+        self.scores = []
+        return self.show_lights(frame, lights)
+
+    def show_lights(self, frame, lights):
+        """
+        Shows the crops of lights classified elsewhere, e.g. by a detection
+        worker process, and sets self.lights and self.state like
+        process_traffic_light. Returns the bbox of the first known color.
+        """
+        self.state = None
+        self.lights = lights
         bbox = None
-        for i in range(0,len(self.bbx)):
-            semaphore = frame[self.bbx[i][0]:self.bbx[i][1], self.bbx[i][2]:self.bbx[i][3]]    
-            if(semaphore.shape[0] > 0 and semaphore.shape[1] > 0 and np.mean(semaphore) > 0):
-                semaphore_color = self.get_state(semaphore, self.scores[i])
-                # print(self.state)
-                cv2.imshow("Traffic Light", semaphore)
-                cv2.imshow("Traffic Light COLOR", semaphore_color)
-                self.key = cv2.waitKey(1) & 0xFF
+        for light in self.lights:
+            x0, y0, x1, y1 = light.bbox
+            semaphore = frame[y0:y1, x0:x1]
+            self.key = self.sink.show_crop(semaphore)
+
+            if(self.key == ord("r")):
+                self.img_index+=1
+                print("bbx ",[y0, y1, x0, x1])
+                cv2.imwrite("data/{}.png".format(self.img_index), semaphore)
+                cv2.imwrite("data/frame_{}.png".format(self.img_index), frame)
+            if(light.label is not None):
+                self.state = "{}, {}".format(light.label, light.score)
+                bbox = [(x0, y0), (x1, y1)]
+                break
+        return bbox
 
-                if(self.key == ord("r")):
-                    self.img_index+=1
-                    print("bbx ",self.bbx[i])
-                    cv2.imwrite("data/{}.png".format(self.img_index), semaphore)
-                    cv2.imwrite("data/frame_{}.png".format(self.img_index), frame)
-                if(self.state is not None):
-                    bbox = [(self.bbx[i][2], self.bbx[i][0]), (self.bbx[i][3], self.bbx[i][1])]
-                    break
-            j+=1
+    def track_traffic_light(self, frame, bboxes, frame_id, tracker):
+        """
+        Like process_traffic_light, but states come from a tracker.LightTracker
+        that keeps them across frames and only re-classifies changed crops.
+        self.lights holds the visible, labelled tracks. Returns the bbox of the visible track with the best score and a known
+        state.
+        """
+        self.getScore_Label(bboxes)
+        tracks = tracker.update(frame, self.bbx, self.scores, frame_id)
         self.bbx = []
         self.scores = []
-        return bbox
+        self.state = None
+        labelled = [t for t in tracks if t.visible and t.label is not None]
+        self.lights = [ClassifiedLight(t.label, t.score, t.bbox) for t in labelled]
+        if(not labelled):
+            return None
+        track = max(labelled, key=lambda t: t.score)
+        x0, y0, x1, y1 = track.bbox
+        self.key = self.sink.show_crop(frame[y0:y1, x0:x1])
+        self.state = "{}, {}".format(track.label, track.score)
+        return [(x0, y0), (x1, y1)]
         
 
 if __name__ == "__main__":
@@ -84,7 +145,7 @@ if __name__ == "__main__":
         img = cv2.imread(base_dir + im)
         # img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
         gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-        img = l.Hog(img, 0)
+        img = l.get_state(img, 0)
         print("Result = {}".format(l.state))
         cv2.imshow("Traffic Light", img)
         key = cv2.waitKey(0) & 0xFF
@@ -0,0 +1,437 @@
+"""
+Detection in a pool of worker processes fed through shared-memory frames.
+
+In one process, letterboxing, NMS and light classification contend for the
+GIL with pygame and the simulator client. DetectionPool runs N worker
+processes, each with its own model instance. The client writes every frame
+once into a SharedFrameRing, a ring of (height, width, 3) BGR slots in shared
+memory (multiprocessing.shared_memory, or a RawArray where it is missing,
+before Python 3.8). Only the slot index travels to a worker, which
+letterboxes, runs inference, postprocesses and classifies the lights on the
+shared frame. It returns the compact result: the detections and the
+ClassifiedLight list.
+
+    submit()   copies a frame into a free slot and hands it to the least
+               busy worker; with per_worker frames queued on every worker
+               it waits or, with block=False, drops the frame
+    poll()     returns the finished results in submission order; a result
+               keeps its slot, and so its frame, until the next poll()
+Slots only come back through poll(), a caller that stops polling has its
+frames dropped.
+
+Workers are spawned, never forked, so no TensorFlow or pygame state is
+inherited. A worker that dies is replaced; its frames go to the other
+workers, and a frame that has killed max_retries workers is returned as
+failed, so order is preserved either way.
+
+The pool only pays off with spare cores and a slow model. Every frame costs
+the client a copy into the ring and a queue round trip, about 3 ms at
+1280x720, and a worker woken for each frame computes with cold caches: on one
+core the stand-in model takes 11 ms per frame in process but 16 ms in a
+worker, so 1 or 2 workers give 50 and 46 frames/s against about 100 in process.
+With at least workers + 1 cores (the client keeps one busy) and a backend
+taking tens of milliseconds per frame, limited to a share of the cores with
+--threads, throughput grows with the workers instead.
+
+Run this module to measure how throughput scales with the worker count, 0
+being in-process detection:
+    python worker_pool.py --backend onnxruntime --workers 0,1,2,4 --frames data/
+"""
+
+import argparse
+import functools
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import detector
+
+READY, DONE, FAILED = "ready", "done", "failed"
+
+
+class SharedFrameRing(object):
+    """
+    slots frames of height x width BGR pixels in shared memory. Pickling a
+    ring (to pass it to a process) shares it rather than copying it.
+    """
+
+    def __init__(self, slots, width, height):
+        self.slots = slots
+        self.width = width
+        self.height = height
+        self.shape = (slots, height, width, 3)
+        size = int(np.prod(self.shape))
+        self._owner = True
+        if shared_memory is not None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._array = None
+            buffer = self._memory.buf
+        else:
+            self._memory = None
+            self._array = multiprocessing.RawArray("B", size)
+            buffer = self._array
+        self.frames = np.frombuffer(buffer, dtype=np.uint8, count=size).reshape(self.shape)
+
+    def __getstate__(self):
+        state = {"slots": self.slots, "width": self.width, "height": self.height}
+        if self._memory is not None:
+            state["name"] = self._memory.name
+        else:
+            # Only possible while starting a process, like any RawArray.
+            state["array"] = self._array
+        return state
+
+    def __setstate__(self, state):
+        self.slots, self.width, self.height = state["slots"], state["width"], state["height"]
+        self.shape = (self.slots, self.height, self.width, 3)
+        self._owner = False
+        self._memory = None
+        self._array = state.get("array")
+        if self._array is None:
+            self._memory = shared_memory.SharedMemory(name=state["name"])
+            buffer = self._memory.buf
+        else:
+            buffer = self._array
+        self.frames = np.frombuffer(buffer, dtype=np.uint8, count=int(np.prod(self.shape))).reshape(self.shape)
+
+    def frame(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        self.frames = None
+        if self._memory is not None:
+            if self._owner:
+                self._memory.unlink()
+            try:
+                self._memory.close()
+            except BufferError:
+                # Frames returned by poll() are still referenced, the mapping
+                # goes away with them.
+                pass
+            self._memory = None
+
+
+def detect_frame(frame, backend, converter, postprocessor, score_threshold=detector.LIGHT_SCORE_THRESHOLD):
+    """
+    Detection and light classification of one BGR frame, as done by a
+    worker. Returns (bboxes, lights).
+    """
+    from light_classifier import classify_lights
+
+    data = converter.letterbox({"frame": frame, "slot": 0})
+    bboxes = postprocessor.run(backend.predict(data["image_data"]), frame.shape[:2])
+    strong = bboxes[(bboxes[:, 5] == detector.TRAFFIC_LIGHT_CLASS) & (bboxes[:, 4] >= score_threshold)]
+    boxes = [[int(b[1]), int(b[3]), int(b[0]), int(b[2])] for b in strong]
+    return bboxes, classify_lights(frame, boxes, strong[:, 4])
+
+
+def _worker(worker_id, ring, tasks, results, loaded, backend_factory, input_size, class_ids):
+    from frame_convert import FrameConverter
+    from postprocess import ClassFilteredPostprocessor
+
+    backend = backend_factory()
+    backend.warmup(input_size)
+    converter = FrameConverter(ring.width, ring.height, input_size)
+    postprocessor = ClassFilteredPostprocessor(input_size, class_ids, backend.num_classes)
+    # Queued messages die with a crashed process, the event does not.
+    loaded.set()
+    results.put((READY, worker_id, None))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, slot = task
+            try:
+                bboxes, lights = detect_frame(ring.frame(slot), backend, converter, postprocessor)
+                results.put((DONE, worker_id, (seq, bboxes, lights)))
+            except Exception as error:
+                results.put((FAILED, worker_id, (seq, repr(error))))
+    finally:
+        backend.close()
+        ring.close()
+
+
+class _Worker(object):
+    def __init__(self, worker_id, process, tasks, loaded):
+        self.id = worker_id
+        self.process = process
+        self.tasks = tasks
+        self.loaded = loaded
+        self.ready = False
+        self.in_flight = {}
+
+
+class DetectionPool(object):
+    """
+    Worker processes detecting traffic lights on frames of one size.
+    backend_factory is a picklable callable returning a backend, e.g.
+    functools.partial(backends.make_backend, "onnxruntime", model_file).
+    """
+
+    def __init__(self, backend_factory, width, height, workers=2, input_size=416, per_worker=2,
+                 class_ids=(detector.TRAFFIC_LIGHT_CLASS,), max_retries=1, start_timeout=300.0):
+        self.backend_factory = backend_factory
+        self.width = width
+        self.height = height
+        self.input_size = input_size
+        self.per_worker = per_worker
+        self.capacity = workers * per_worker
+        self.class_ids = class_ids
+        self.max_retries = max_retries
+        self.start_timeout = start_timeout
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context("spawn")
+        # Frames in flight plus as many finished ones, waiting for an earlier
+        # frame or still held by the caller.
+        self.ring = SharedFrameRing(2 * self.capacity + 1, width, height)
+        self._results = self._context.Queue()
+        self._free = list(range(self.ring.slots))
+        self._held = []
+        self._tasks = {}
+        self._retries = {}
+        self._finished = {}
+        self._next_seq = 0
+        self._next_out = 0
+        self._workers = [self._spawn(i) for i in range(workers)]
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _spawn(self, worker_id):
+        tasks = self._context.Queue()
+        loaded = self._context.Event()
+        process = self._context.Process(
+            target=_worker, name="detector-{}".format(worker_id), daemon=True,
+            args=(worker_id, self.ring, tasks, self._results, loaded, self.backend_factory, self.input_size,
+                  self.class_ids))
+        process.start()
+        return _Worker(worker_id, process, tasks, loaded)
+
+    def wait_ready(self):
+        """
+        Blocks until every worker has loaded and warmed up its model.
+        """
+        deadline = time.time() + self.start_timeout
+        while not all(worker.ready for worker in self._workers):
+            if time.time() > deadline:
+                raise RuntimeError("detection workers did not start within {:.0f} s".format(self.start_timeout))
+            self._collect(0.1)
+
+    def stats(self):
+        return {"workers": len(self._workers), "submitted": self.submitted, "completed": self.completed,
+                "failed": self.failed, "dropped": self.dropped, "restarts": self.restarts,
+                "in_flight": self.in_flight()}
+
+    def in_flight(self):
+        """
+        Frames queued on or being detected by a worker.
+        """
+        return sum(len(worker.in_flight) for worker in self._workers)
+
+    def submit(self, frame, frame_id=None, bgra=False, block=True, timeout=None):
+        """
+        Copies a BGR frame, or converts a BGRA one, into a free slot and
+        queues it. Returns False if the frame was dropped.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.in_flight() >= self.capacity:
+            if not block or (deadline is not None and time.time() > deadline):
+                self.dropped += 1
+                return False
+            self._collect(0.05)
+        if not self._free:
+            self.dropped += 1
+            return False
+        slot = self._free.pop()
+        target = self.ring.frame(slot)
+        if bgra:
+            import cv2
+            bgra_view = np.frombuffer(frame, dtype=np.uint8).reshape((self.height, self.width, 4))
+            cv2.cvtColor(bgra_view, cv2.COLOR_BGRA2BGR, dst=target)
+        else:
+            np.copyto(target, frame)
+        seq = self._next_seq
+        self._next_seq += 1
+        self._tasks[seq] = (slot, frame_id)
+        self._dispatch(seq)
+        self.submitted += 1
+        return True
+
+    def _dispatch(self, seq):
+        worker = min(self._workers, key=lambda w: len(w.in_flight))
+        worker.in_flight[seq] = self._tasks[seq][0]
+        worker.tasks.put((seq, self._tasks[seq][0]))
+
+    def _collect(self, timeout=0.0):
+        """
+        Moves finished results into _finished and replaces dead workers.
+        """
+        try:
+            message = self._results.get(timeout=timeout) if timeout else self._results.get_nowait()
+            while True:
+                kind, worker_id, payload = message
+                worker = self._workers[worker_id]
+                if kind == READY:
+                    worker.ready = True
+                else:
+                    seq = payload[0]
+                    worker.in_flight.pop(seq, None)
+                    # A frame re-dispatched after a crash may come back twice.
+                    if seq in self._tasks and seq not in self._finished:
+                        self._finished[seq] = (kind, payload)
+                message = self._results.get_nowait()
+        except queue.Empty:
+            pass
+        for i, worker in enumerate(self._workers):
+            if not self._closed and not worker.process.is_alive():
+                self._restart(i)
+
+    def _restart(self, index):
+        dead = self._workers[index]
+        if not dead.loaded.is_set():
+            raise RuntimeError("detection worker {} exited with {} before loading its model".format(
+                dead.id, dead.process.exitcode))
+        print("detection worker {} exited with {}, restarting".format(dead.id, dead.process.exitcode))
+        self.restarts += 1
+        self._workers[index] = self._spawn(dead.id)
+        for seq in sorted(dead.in_flight):
+            # Workers take their frames in order, only the oldest one was
+            # being detected when the worker died.
+            if seq == min(dead.in_flight):
+                self._retries[seq] = self._retries.get(seq, 0) + 1
+            if self._retries.get(seq, 0) > self.max_retries:
+                self._finished[seq] = (FAILED, (seq, "worker died {} times".format(self._retries[seq])))
+            else:
+                self._dispatch(seq)
+
+    def poll(self, timeout=0.0):
+        """
+        Returns the results finished since the last call, in submission
+        order, as frame dicts: frame, image, frame_size, frame_id, bboxes and
+        lights, or error for failed frames. The frames stay valid until the
+        next poll(). Waits up to timeout seconds for the first result.
+        """
+        self._free.extend(self._held)
+        self._held = []
+        self._collect(timeout if self._next_out not in self._finished else 0.0)
+        results = []
+        while self._next_out in self._finished:
+            seq = self._next_out
+            kind, payload = self._finished.pop(seq)
+            slot, frame_id = self._tasks.pop(seq)
+            self._retries.pop(seq, None)
+            frame = self.ring.frame(slot)
+            data = {"frame": frame, "image": frame[:, :, ::-1], "frame_size": frame.shape[:2], "frame_id": frame_id}
+            if kind == DONE:
+                data["bboxes"], data["lights"] = payload[1], payload[2]
+                self.completed += 1
+            else:
+                data["error"] = payload[1]
+                self.failed += 1
+            self._held.append(slot)
+            results.append(data)
+            self._next_out += 1
+        return results
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            worker.tasks.put(None)
+        for worker in self._workers:
+            worker.process.join(5.0)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+        self.ring.close()
+
+
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+def throughput(backend_factory, frames, workers, input_size=416):
+    """
+    Returns frames per second of a pool of workers detecting on frames, all
+    of the same size, and whether results came back in order. No workers
+    detects in this process.
+    """
+    height, width = frames[0].shape[:2]
+    if workers == 0:
+        from frame_convert import FrameConverter
+        from postprocess import ClassFilteredPostprocessor
+
+        backend = backend_factory()
+        backend.warmup(input_size)
+        converter = FrameConverter(width, height, input_size)
+        postprocessor = ClassFilteredPostprocessor(input_size, num_classes=backend.num_classes)
+        start = time.perf_counter()
+        for frame in frames:
+            detect_frame(frame, backend, converter, postprocessor)
+        elapsed = time.perf_counter() - start
+        backend.close()
+        return len(frames) / elapsed, True
+    with DetectionPool(backend_factory, width, height, workers, input_size) as pool:
+        pool.wait_ready()
+        order = []
+        submitted = []
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            if pool.submit(frame, i):
+                submitted.append(i)
+            order.extend(data["frame_id"] for data in pool.poll())
+        while len(order) < len(submitted):
+            order.extend(data["frame_id"] for data in pool.poll(0.1))
+        elapsed = time.perf_counter() - start
+    return len(order) / elapsed, order == submitted
+
+
+def main():
+    from backends import BACKENDS, TF1Backend, make_backend
+    from replay import LimitedSource, open_source
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name, help="Inference backend")
+    ap.add_argument("--model", default=None, help="Model file of the backend")
+    ap.add_argument("--threads", type=int, default=1, help="Intra-op threads of each worker's backend")
+    ap.add_argument("--workers", default="0,1,2,4",
+                    help="Comma separated worker counts to compare, 0 for in-process detection")
+    ap.add_argument("--frames", default=None, help="Replay source, synthetic frames if not given")
+    ap.add_argument("-n", "--count", type=int, default=100, help="Frames per run")
+    args = vars(ap.parse_args())
+
+    if args["frames"] is not None:
+        frames = [np.array(f) for f in LimitedSource(open_source(args["frames"]), args["count"])]
+    else:
+        from light_classifier import synthetic_frame
+        frames = [synthetic_frame(1280, 720, 4, seed=i)[0] for i in range(args["count"])]
+    factory = functools.partial(make_backend, args["backend"], args["model"], 80, args["threads"], 1)
+    print("{} cores".format(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()))
+    for workers in [int(w) for w in args["workers"].split(",")]:
+        fps, ordered = throughput(factory, frames, workers)
+        print("{:2d} workers: {:7.2f} frames/s{}".format(workers, fps, "" if ordered else ", OUT OF ORDER"))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,16 +21,26 @@ Controls:
 # ==============================================================================
 
 
-import cv2
 import time
+from startup import StartupTimer
+
+STARTUP = StartupTimer()
+
 import numpy as np
 import argparse
 
-import tensorflow_yolov3.carla.utils as utils
-from traffic_light import Light
+import detector
+from pipeline import FramePacket, Pipeline, Stage, THREAD, BACKPRESSURE_POLICIES, DROP_OLDEST, EXECUTORS
+from backends import BACKENDS, DEFAULT_TFLITE, OnnxRuntimeBackend, TF1Backend, TFLiteBackend, make_backend
+from display import DISPLAY_KINDS, EveryNthSink, make_sink
+from scheduler import BETWEEN_MODES, InferenceScheduler, ROI
+from postprocess import ClassFilteredPostprocessor
+from frame_sync import FrameSync
+from sim_io import DriveCommand, SimulatorIO, print_stats, steer_control
+from model_cache import DEFAULT_CACHE_DIR
+from metrics import FORMATS, JSON, NullMetrics, make_metrics
+from functools import partial
 from random import randint
-import tensorflow as tf
-from PIL import Image
 
 
 import glob
@@ -50,24 +60,17 @@ except IndexError:
 # -- imports -------------------------------------------------------------------
 # ==============================================================================
 
-import carla
+# Imported by import_carla() when the client connects, --help and argument
+# errors never load it.
+carla = None
 
 import weakref
 import random
 
 import re
 
-try:
-    import pygame
-    from pygame.locals import K_ESCAPE
-    from pygame.locals import K_SPACE
-    from pygame.locals import K_a
-    from pygame.locals import K_d
-    from pygame.locals import K_s
-    from pygame.locals import K_w
-    from pygame.locals import K_c
-except ImportError:
-    raise RuntimeError('cannot import pygame, make sure pygame package is installed')
+# Imported by import_pygame() once a window is needed, headless runs never load it.
+pygame = None
 
 try:
     import numpy as np
@@ -82,6 +85,25 @@ VIEW_FOV = 90
 BB_COLOR = (248, 64, 24)
 
 
+def import_carla():
+    global carla
+    if carla is None:
+        import carla as module
+        carla = module
+    return carla
+
+
+def import_pygame():
+    global pygame
+    if pygame is None:
+        try:
+            import pygame as module
+        except ImportError:
+            raise RuntimeError('cannot import pygame, make sure pygame package is installed')
+        pygame = module
+    return pygame
+
+
 def find_weather_presets():
     rgx = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
     name = lambda x: ' '.join(m.group(0) for m in rgx.finditer(x))
@@ -108,9 +130,39 @@ class BasicSynchronousClient(object):
         self.display = None
         self.image = None
         self.raw_image = None
-        self.capture = True
-
-        self._weather_presets = find_weather_presets()
+        self.frame_data = None
+        self.converter = None
+        self.sink = None
+        self.tracker = None
+        self.scheduler = None
+        self.tiler = None
+        self.recorder = None
+        self.postprocess = None
+        self.metrics = NullMetrics()
+        self.frame_sync = FrameSync()
+        self.frame_timeout = 2.0
+        self.detected_frame = None
+        # (tick rate, control rate) to run simulator I/O on its own thread.
+        self.io_rates = None
+        self.io = None
+        # Set to associate detections with the map's traffic lights.
+        self.associate = False
+        self.projector = None
+        # Frame number -> (camera transform, light states) read at its tick.
+        self._captured = {}
+        self.light_matches = {"matched": 0, "agree": 0, "unmatched": 0}
+        # AutoLabeler keyword arguments to capture ground truth unattended.
+        self.autolabel = None
+        self.autolabeler = None
+        # DetectionPool of worker processes, replacing the in-process backend.
+        self.pool = None
+        # QualityController adapting the serial loop to its budget.
+        self.quality = None
+        self._quality_steps = {}
+
+        self.startup = None
+        # Filled in on first use by weather_presets().
+        self._weather_presets = None
         self._weather_index = randint(1,5)
 
 
@@ -156,160 +208,481 @@ class BasicSynchronousClient(object):
         weak_self = weakref.ref(self)
         self.camera.listen(lambda image: weak_self().set_image(weak_self, image))
 
-        calibration = np.identity(3)
-        calibration[0, 2] = 1920#VIEW_WIDTH / 2.0
-        calibration[1, 2] = 1080#VIEW_HEIGHT / 2.0
-        calibration[0, 0] = calibration[1, 1] = VIEW_WIDTH / (2.0 * np.tan(VIEW_FOV * np.pi / 360.0))
-        self.camera.calibration = calibration
+        from projection import intrinsics
+
+        self.camera.calibration = intrinsics(VIEW_WIDTH, VIEW_HEIGHT, VIEW_FOV)
         
+    def weather_presets(self):
+        if self._weather_presets is None:
+            self._weather_presets = find_weather_presets()
+        return self._weather_presets
+
     def next_weather(self, reverse=False):
         self._weather_index += -1 if reverse else 1
-        self._weather_index %= len(self._weather_presets)
-        preset = self._weather_presets[self._weather_index]
+        self.apply_weather()
+
+    def apply_weather(self):
+        """
+        Sets the weather preset of _weather_index, the one recordings are
+        labelled with.
+        """
+        presets = self.weather_presets()
+        self._weather_index %= len(presets)
+        preset = presets[self._weather_index]
         # self.hud.notification('Weather: %s' % preset[1])
-        self.world.set_weather(preset[0])
+        if self.io is not None:
+            self.io.set_weather(preset[0])
+        else:
+            self.world.set_weather(preset[0])
 
     def control(self, car):
         """
-        Applies control to main car based on pygame pressed keys.
+        Applies control to main car based on pygame pressed keys, or hands
+        them to the simulator I/O thread when there is one.
         Will return True If ESCAPE is hit, otherwise False to end main loop.
         """
 
         keys = pygame.key.get_pressed()
-        if keys[K_ESCAPE]:
+        if keys[pygame.K_ESCAPE]:
             return True
 
-        control = car.get_control()
-        control.throttle = 0
-        if keys[K_w]:
-            control.throttle = 1
-            control.reverse = False
-        elif keys[K_s]:
-            control.throttle = 1
-            control.reverse = True
-        if keys[K_a]:
-            control.steer = max(-1., min(control.steer - 0.05, 0))
-        elif keys[K_d]:
-            control.steer = min(1., max(control.steer + 0.05, 0))
-        else:
-            control.steer = 0
-        control.hand_brake = keys[K_SPACE]
+        steer = -1 if keys[pygame.K_a] else 1 if keys[pygame.K_d] else 0
+        command = DriveCommand(bool(keys[pygame.K_w] or keys[pygame.K_s]), not keys[pygame.K_w], steer,
+                               bool(keys[pygame.K_SPACE]))
 
-        if keys[K_c]:
+        if keys[pygame.K_c]:
             self.next_weather()
         
-        car.apply_control(control)
+        if self.io is not None:
+            self.io.command(command)
+        else:
+            car.apply_control(steer_control(car.get_control(), command))
         return False
 
     @staticmethod
     def set_image(weak_self, img):
         """
-        Sets image coming from camera sensor.
-        The self.capture flag is a mean of synchronization - once the flag is
-        set, next coming image will be stored.
+        Hands the image coming from the camera sensor to the frame sync,
+        game_loop picks it up by its frame number.
         """
 
         self = weak_self()
-        if self.capture:
-            self.image = img
-            self.capture = False
+        self.frame_sync.put(img)
 
-    def render(self, display):
+    def render(self):
         """
-        Transforms image from camera sensor and blits it to main pygame display.
+        Converts image from camera sensor. Showing it is left to the sink.
         """
 
         if self.image is not None:
-            array = np.frombuffer(self.image.raw_data, dtype=np.dtype("uint8"))
-            array = np.reshape(array, (self.image.height, self.image.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            self.raw_image = cv2.cvtColor(array,cv2.COLOR_BGR2RGB)
-            surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-            display.blit(surface, (0, 0))
+            self.frame_data = self.converter.convert(self.image.raw_data)
+            self.raw_image = self.frame_data["image"]
+
+    def capture_frame(self):
+        """
+        Renders the current camera image and returns the frame dict consumed
+        by the detection stages, tagged with the simulator frame number.
+        The arrays live in the converter's buffers, see FrameConverter.
+        """
+
+        with self.metrics.time("render"):
+            self.render()
+        self.frame_data["frame_id"] = self.image.frame
+        return self.image.frame, self.frame_data
+
+    def capture_lights(self, image):
+        """
+        Keeps the camera pose of image and the states of the traffic lights
+        visible from it, read at its tick, until its frame is shown. Frames
+        reach show_detections ticks later in the pipelined and worker modes,
+        and frame dicts cross process boundaries carla objects cannot, so
+        both are kept here by frame number.
+        """
+        transform = image.transform
+        self._captured[image.frame] = (transform, self.projector.capture(transform))
+
+    def captured_lights(self, frame_id):
+        """
+        Returns the (camera transform, light states) kept for frame_id, or
+        (None, None), and forgets those of earlier frames that were dropped.
+        """
+        for frame in [f for f in self._captured if f < frame_id]:
+            del self._captured[frame]
+        return self._captured.pop(frame_id, (None, None))
+
+    def detect_in_pool(self, image):
+        """
+        Queues the raw camera image to the detection worker processes and
+        returns the newest finished frame dict, or None. A frame finding
+        every slot busy is dropped rather than stalling the tick.
+        """
+
+        with self.metrics.time("submit"):
+            self.pool.submit(image.raw_data, image.frame, bgra=True, block=False)
+        newest = None
+        for data in self.pool.poll():
+            if "error" in data:
+                print("detection of frame {} failed: {}".format(data["frame_id"], data["error"]))
+            else:
+                newest = data
+        if newest is not None:
+            self.detected_frame = newest["frame_id"]
+        return newest
+
+    def apply_quality(self, level):
+        """
+        Switches the serial loop to a quality.QualityLevel: the input size of
+        the converter and the postprocessing, the scheduler's full inference
+        interval and the display cadence.
+        """
 
+        size = level.input_size
+        if size not in self._quality_steps:
+            postprocess = self.postprocess
+            if isinstance(postprocess, ClassFilteredPostprocessor):
+                postprocess = ClassFilteredPostprocessor(size, postprocess.class_ids, postprocess.num_classes,
+                                                         postprocess.score_threshold, postprocess.iou_threshold)
+            else:
+                postprocess = partial(detector.postprocess, input_size=size)
+            from frame_convert import FrameConverter
+            self._quality_steps[size] = (FrameConverter(VIEW_WIDTH, VIEW_HEIGHT, size), postprocess)
+        self.converter, self.postprocess = self._quality_steps[size]
+        self.scheduler.input_size = size
+        self.scheduler.postprocess = self.postprocess
+        self.scheduler.full_every = level.infer_every
+        self.sink.set_every(level.display_every)
+
+    def show_detections(self, light, data):
+        """
+        Classifies traffic lights of a processed frame and hands the results
+        to the display sink. Returns True if the quit key was pressed.
+        """
 
+        with self.metrics.time("light"):
+            if self.tracker is not None:
+                light.track_traffic_light(data["frame"], data["bboxes"], data["frame_id"], self.tracker)
+            elif "lights" in data:
+                # Already classified by a detection worker.
+                light.show_lights(data["frame"], data["lights"])
+            else:
+                light.process_traffic_light(data["frame"], data["bboxes"])
+        camera_transform = None
+        if self.projector is not None:
+            camera_transform, light_states = self.captured_lights(data["frame_id"])
+        if self.associate and camera_transform is not None:
+            with self.metrics.time("associate"):
+                self.match_lights(light, camera_transform, light_states)
+        if self.autolabeler is not None and camera_transform is not None:
+            with self.metrics.time("autolabel"):
+                self.autolabeler(data["frame"], data["frame_id"], data["bboxes"], camera_transform, light_states)
+        if self.recorder is not None:
+            with self.metrics.time("record"):
+                labelled = [l for l in light.lights if l.label is not None]
+                self.recorder.append(data["frame"], data["frame_id"], [l.bbox for l in labelled],
+                                     [l.label for l in labelled], light.town,
+                                     self.weather_presets()[self._weather_index][1])
+        with self.metrics.time("display"):
+            return self.sink.show(data)
+
+    def match_lights(self, light, camera_transform, light_states=None):
+        """
+        Associates the classified lights with the map's traffic lights seen
+        from camera_transform and counts how often the classifier agrees with
+        their simulator state, light_states if given (see capture_lights).
+        """
 
+        if not light.lights:
+            return
+        matches, _ = self.projector.associate(camera_transform, [l.bbox for l in light.lights])
+        found = matches >= 0
+        states = self.projector.states(matches[found], light_states)
+        labels = [l.label for l, f in zip(light.lights, found) if f]
+        self.light_matches["matched"] += len(states)
+        self.light_matches["agree"] += sum(1 for label, state in zip(labels, states) if label == state)
+        self.light_matches["unmatched"] += int((~found).sum())
+
+    def build_pipeline(self, backend, input_size, options):
+        """
+        Builds the preprocess -> inference -> postprocess pipeline.
+        Inference shares the backend, so it always runs on threads; the
+        opencv and tflite backends take one frame at a time.
+        """
 
-    def game_loop(self, num_classes, input_size, graph, return_tensors, town):
+        if options["executor"] == THREAD:
+            preprocess = self.converter.letterbox
+        else:
+            # Worker processes cannot write into the converter's buffers.
+            preprocess = partial(detector.preprocess, input_size=input_size)
+        stages = [
+            Stage("preprocess", preprocess, options["workers"], options["executor"]),
+            Stage("inference", backend, options["inference_workers"], THREAD),
+            Stage("postprocess", self.postprocess, options["workers"], options["executor"]),
+        ]
+        return Pipeline(stages, maxsize=options["queue_size"], policy=options["backpressure"])
+
+    def game_loop(self, backend, input_size, town, pipeline_options=None, display_kind="both", display_every=1,
+                  fast_world=False):
         """
         Main program loop.
+        backend is the backends.InferenceBackend used for detection.
+        With pipeline_options the detection stages run concurrently with the
+        simulator tick, otherwise every tick is processed serially.
+        display_kind selects the sink (see display.make_sink); "none" runs
+        headless with the car on autopilot and without pygame.
+        fast_world skips reload_world, and load_world when the server already
+        runs town.
         """        
+        headless = display_kind == "none"
+        if self.postprocess is None:
+            self.postprocess = partial(detector.postprocess, input_size=input_size)
+        pipeline = None
+        engine = None
+        buffers = 1
+        if pipeline_options is not None:
+            # One slot per frame that can be queued or in flight in any stage.
+            buffers = 2 + 3 * (pipeline_options["queue_size"] + pipeline_options["workers"]
+                               + pipeline_options["inference_workers"])
+        # OpenCV comes in with the converter, -h and argument errors do not wait for it.
+        from frame_convert import FrameConverter
+        from traffic_light import Light
+
+        self.converter = FrameConverter(VIEW_WIDTH, VIEW_HEIGHT, input_size, buffers)
         try:
-            pygame.init()
-            self.client = carla.Client('127.0.0.1', 2000)
+            draw = None
+            if not headless:
+                import_pygame().init()
+                from tensorflow_yolov3.carla.utils import draw_bounding_boxes as draw
+            self.client = import_carla().Client('127.0.0.1', 2000)
             self.client.set_timeout(2.0)
 
             # DEFAULT IS 'Town03'
-            self.client.load_world(town)
             self.world = self.client.get_world()
-            self.client.reload_world()
+            if not fast_world or self.world.get_map().name.split("/")[-1] != town:
+                self.client.load_world(town)
+                self.world = self.client.get_world()
+            if not fast_world:
+                self.client.reload_world()
+            if self.startup is not None:
+                self.startup.mark("world")
 
 
             self.setup_car()
             self.setup_camera()
-
-            self.display = pygame.display.set_mode((VIEW_WIDTH, VIEW_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF)
-            pygame_clock = pygame.time.Clock()
+            # The randomly picked starting weather, which frames are recorded with.
+            self.apply_weather()
+            if self.associate or self.autolabel is not None:
+                from projection import LightProjector, town_index
+
+                self.projector = LightProjector(town_index(self.world), VIEW_WIDTH, VIEW_HEIGHT, VIEW_FOV)
+
+            pygame_clock = None
+            if headless:
+                self.car.set_autopilot(True)
+            else:
+                self.display = pygame.display.set_mode((VIEW_WIDTH, VIEW_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF)
+                pygame_clock = pygame.time.Clock()
+            self.sink = make_sink(display_kind, self.display, draw, display_every)
+            if self.quality is not None:
+                if not isinstance(self.sink, EveryNthSink):
+                    self.sink = EveryNthSink(self.sink, 1)
+                self._quality_steps[input_size] = (self.converter, self.postprocess)
+                self.apply_quality(self.quality.level)
 
             self.set_synchronous_mode(True)
             # CLEAR TERMINAL
             os.system('cls' if os.name == 'nt' else 'clear')
-            light = Light()
+            light = Light(town, sink=self.sink)
+            if self.autolabel is not None:
+                from autolabel import AutoLabeler
+
+                self.autolabeler = AutoLabeler(self.projector, town, **self.autolabel)
             
-            with tf.Session(graph=graph) as sess:
-                while True:
-                    self.world.tick()
-    
-                    self.capture = True
-                    pygame_clock.tick_busy_loop(20)
+            if pipeline_options is not None and pipeline_options["max_batch_size"] > 1:
+                # Inference workers of the pipeline share batched backend runs.
+                from batching import BatchInferenceEngine
+
+                engine = BatchInferenceEngine(backend, pipeline_options["max_batch_size"],
+                                              pipeline_options["max_batch_wait"])
+                engine.start()
+                backend.engine = engine
+            if pipeline_options is not None:
+                pipeline = self.build_pipeline(backend, input_size, pipeline_options)
+                pipeline.start()
+                self.metrics.add_collector(partial(pipeline_gauges, pipeline))
+            self.metrics.add_collector(partial(frame_sync_gauges, self.frame_sync))
+            if self.io_rates is not None:
+                # Ticks and control run on the I/O thread from here on.
+                self.io = SimulatorIO(self.world, self.car, self.io_rates[0], self.io_rates[1], self.metrics,
+                                      drive=not headless)
+                self.io.start()
+
+            metrics = self.metrics
+            while True:
+                loop_start = time.perf_counter()
+                if self.io is not None:
+                    if not self.io.running:
+                        raise self.io.error or RuntimeError("simulator I/O stopped")
+                    # The newest image, whatever tick it belongs to.
+                    with metrics.time("camera"):
+                        image = self.frame_sync.wait_newest(self.frame_timeout)
+                    if image is None:
+                        print("no camera image for {:.1f} s".format(self.frame_timeout))
+                        continue
+                else:
+                    with metrics.time("tick"):
+                        tick_frame = self.world.tick()
+                    if tick_frame is None:
+                        tick_frame = self.world.get_snapshot().frame
+
+                    # Blocks until the camera image of this tick arrives.
+                    with metrics.time("camera"):
+                        image = self.frame_sync.wait_for(tick_frame, self.frame_timeout)
+                    if image is None:
+                        print("no camera image for frame {}".format(tick_frame))
+                        continue
+                self.image = image
+                if self.projector is not None:
+                    with metrics.time("capture_lights"):
+                        self.capture_lights(image)
+
+                limited = 0.0
+                if pygame_clock is not None and MAX_FPS:
+                    with metrics.time("frame_limit"):
+                        # Sleeps instead of spinning like tick_busy_loop.
+                        limit_start = time.perf_counter()
+                        pygame_clock.tick(MAX_FPS)
+                        limited = time.perf_counter() - limit_start
     
-                    self.render(self.display)
-                    
-                    frame = self.raw_image.copy()
-                    # print("shape = ",self.raw_image.shape)
-
-                    self.raw_image = cv2.cvtColor(self.raw_image, cv2.COLOR_BGR2RGB)
-                    frame_size = self.raw_image.shape[:2]
-                    image_data = utils.image_preporcess(np.copy(self.raw_image), [input_size, input_size])
-                    image_data = image_data[np.newaxis, ...]
+                if self.pool is None:
+                    frame_id, data = self.capture_frame()
+
+                if self.pool is not None:
+                    data = self.detect_in_pool(image)
+                elif pipeline is None and self.scheduler is not None:
+                    self.scheduler.inference = backend
+                    with metrics.time("scheduled_detection"):
+                        data = self.scheduler(data, self.converter.letterbox)
+                elif pipeline is None and self.tiler is not None:
+                    self.tiler.inference = backend
+                    with metrics.time("preprocess"):
+                        data = self.converter.letterbox(data)
+                    with metrics.time("tiled_detection"):
+                        data = self.tiler(data)
+                elif pipeline is None:
+                    with metrics.time("preprocess"):
+                        data = self.converter.letterbox(data)
                     # PREDITCTED MODELS:
-                    pred_sbbox, pred_mbbox, pred_lbbox = sess.run(
-                        [return_tensors[1], return_tensors[2], return_tensors[3]],
-                                feed_dict={ return_tensors[0]: image_data})
-
-                    pred_bbox = np.concatenate([np.reshape(pred_sbbox, (-1, 5 + num_classes)),
-                                                np.reshape(pred_mbbox, (-1, 5 + num_classes)),
-                                                np.reshape(pred_lbbox, (-1, 5 + num_classes))], axis=0)
-            
-                    bboxes =  utils.postprocess_boxes(pred_bbox, frame_size, input_size, 0.3)
-                    bboxes =  utils.nms(bboxes, 0.45, method='nms')
-                    
-                    bbox = light.process_traffic_light(frame, bboxes)
-                    if(light.state is not None and bbox is not None):
-                        # print(bbox)
-                        # print(light.state)
-                        # frame = cv2.rectangle(frame, bbox[0], bbox[1], (255,255,255), 2) 
-                        # cv2.putText(frame,light.state,(50, int(frame.shape[1]/2) - 30), cv2.FONT_HERSHEY_SIMPLEX, 1,(255,255,255), 2 ,cv2.LINE_AA)
-                        pass
-                    frame = cv2.resize(frame, (800,600), interpolation = cv2.INTER_CUBIC)
-                    cv2.imshow("Pygame", frame)
-                    key = cv2.waitKey(1)
-                    if(key == ord("q")):
-                        break
-                    
-                    utils.draw_bounding_boxes(pygame, self.display,  self.raw_image, bboxes)
-                    
-                    pygame.display.flip()
-                    pygame.event.pump()
-                    if self.control(self.car):
-                        return
+                    with metrics.time("inference"):
+                        data = backend(data)
+                    with metrics.time("postprocess"):
+                        data = self.postprocess(data)
+                else:
+                    pipeline.put(FramePacket(frame_id, data))
+                    packets = pipeline.drain()
+                    # Older results are superseded by the newest finished frame.
+                    data = packets[-1].data if packets else None
+                    if packets:
+                        self.detected_frame = packets[-1].frame_id
+                        observe_packets(metrics, packets)
+
+                if data is not None and self.show_detections(light, data):
+                    break
+                if data is not None and self.startup is not None:
+                    self.startup.mark("first detection")
+                    print(self.startup.report())
+                    self.startup = None
+                metrics.observe("loop", time.perf_counter() - loop_start)
+                if self.quality is not None:
+                    # The frame limiter's sleep is not work.
+                    level = self.quality.update(time.perf_counter() - loop_start - limited, self.image.frame)
+                    if level is not None:
+                        self.apply_quality(level)
+
+                if headless:
+                    continue
+                pygame.event.pump()
+                if self.control(self.car):
+                    return
 
         finally:
             # self.set_synchronous_mode(False)
+            if self.io is not None:
+                self.io.close()
+                print_stats(self.io.stats())
+                self.io = None
+            if pipeline is not None:
+                pipeline.close()
+            if engine is not None:
+                engine.close()
+                backend.engine = None
+            if self.pool is not None:
+                print("detection workers: {workers} workers, {submitted} frames submitted, {completed} completed, "
+                      "{failed} failed, {dropped} dropped, {restarts} restarts".format(**self.pool.stats()))
+            if self.quality is not None:
+                print("quality: {adjustments} adjustments, ended at level {level}, loops per input size/inference "
+                      "every/display every: {frames}".format(**self.quality.stats()))
+            if self.scheduler is not None:
+                print("inferences: {full} full, {partial} partial, {skipped} ticks reused".format(
+                    **self.scheduler.stats()))
+            print("camera frames: {received} received, {delivered} used, {dropped} dropped, {late} late, "
+                  "{missed} missed, {timeouts} timeouts".format(**self.frame_sync.stats()))
+            if self.autolabeler is not None:
+                self.autolabeler.close()
+                print("auto-labelling: {frames} frames, {detections} detections, {unmatched} unmatched, "
+                      "{duplicates} duplicates, {saved} saved, {dropped} dropped".format(
+                          **self.autolabeler.stats()))
+            if self.associate:
+                print("traffic lights: {matched} matched to the map, {agree} of them classified as their "
+                      "simulator state, {unmatched} unmatched".format(**self.light_matches))
+            if self.metrics.enabled:
+                print_stages(self.metrics)
+            if self.sink is not None:
+                print("display sink {}: {:.2f} ms/frame".format(self.sink.name, self.sink.cost_ms()))
+                self.sink.close()
             self.camera.destroy()
             self.car.destroy()
-            pygame.quit()
+            if not headless:
+                pygame.quit()
+
+
+def pipeline_gauges(pipeline, metrics):
+    """
+    Metrics collector publishing queue depths and drops of the pipeline.
+    """
+    stats = pipeline.stats()
+    for i, (depth, dropped) in enumerate(zip(stats["queue_depths"], stats["dropped"])):
+        metrics.gauge("queue_depth", depth, queue=str(i))
+        metrics.gauge("queue_dropped", dropped, queue=str(i))
+
+
+def frame_sync_gauges(frame_sync, metrics):
+    """
+    Metrics collector publishing the camera frame counters.
+    """
+    for name, value in frame_sync.stats().items():
+        metrics.gauge("camera_frames", value, kind=name)
+
+
+def observe_packets(metrics, packets):
+    """
+    Records how long finished packets spent in each pipeline stage,
+    queueing included, and counts the superseded ones.
+    """
+    for packet in packets:
+        previous = packet.timestamps["created"]
+        for name in ("preprocess", "inference", "postprocess"):
+            if name in packet.timestamps:
+                metrics.observe("pipeline_" + name, packet.timestamps[name] - previous)
+                previous = packet.timestamps[name]
+        metrics.observe("pipeline_latency", previous - packet.timestamps["created"])
+    if len(packets) > 1:
+        metrics.count("superseded_frames", len(packets) - 1)
+
+
+def print_stages(metrics):
+    print("{:20s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s}".format("stage", "count", "mean", "p50", "p99", "max"))
+    for name, stats in sorted(metrics.snapshot()["stages"].items()):
+        print("{:20s} {count:8d} {mean_ms:9.2f} {p50_ms:9.2f} {p99_ms:9.2f} {max_ms:9.2f}".format(name, **stats))
 
 
 # ==============================================================================
@@ -338,22 +711,138 @@ def main():
     """
 
     try:
-        return_elements = ["input/input_data:0", "pred_sbbox/concat_2:0", "pred_mbbox/concat_2:0", "pred_lbbox/concat_2:0"]
         pb_file         = "tensorflow_yolov3/yolov3_coco.pb"
+        if args["backend"] == OnnxRuntimeBackend.name:
+            pb_file     = "tensorflow_yolov3/yolov3_coco.onnx"
+        elif args["backend"] == TFLiteBackend.name:
+            pb_file     = DEFAULT_TFLITE
+        if args["model"] is not None:
+            pb_file     = args["model"]
         
         # video_path      = 0
         num_classes     = 80
         input_size      = 416
-        graph           = tf.Graph()
         
         THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
         my_file = os.path.join(THIS_FOLDER, pb_file)
         print("my_file:", my_file)
         
-        return_tensors  =  utils.read_pb_return_tensors(graph, my_file, return_elements)
+        STARTUP.mark("imports")
+        cache_dir = None if args["no_model_cache"] else args["model_cache"]
+        backend = None
+        pool = None
+        if args["worker_processes"] > 0:
+            # Every worker process loads and warms up its own model.
+            from worker_pool import DetectionPool
+
+            factory = partial(make_backend, args["backend"], my_file, num_classes, args["intra_op_threads"],
+                              args["inter_op_threads"], cache_dir)
+            pool = DetectionPool(factory, args["width"], args["height"], args["worker_processes"], input_size)
+            pool.wait_ready()
+            STARTUP.mark("model")
+        else:
+            backend = make_backend(args["backend"], my_file, num_classes, args["intra_op_threads"],
+                                   args["inter_op_threads"], cache_dir)
+            STARTUP.mark("model")
+        adaptive = args["adaptive_quality"]
+        quality_sizes = [int(size) for size in args["quality_sizes"].split(",")] if adaptive else []
+        if backend is not None and not args["no_warmup"]:
+            batch_sizes = [1]
+            if args["pipelined"] and args["max_batch_size"] > 1:
+                batch_sizes.append(args["max_batch_size"])
+            backend.warmup(input_size, batch_sizes)
+            STARTUP.mark("warm-up")
+        if backend is not None and quality_sizes:
+            # Every other input size the controller may switch to is warmed up
+            # now, and left out if the model cannot run it.
+            for size in sorted(set(quality_sizes) - set([input_size])):
+                try:
+                    backend.warmup(size)
+                except Exception as error:
+                    print("--quality-sizes: the {} model cannot run {}x{} inputs, not used ({!r})".format(
+                        args["backend"], size, size, error))
+                    quality_sizes.remove(size)
+            quality_sizes = quality_sizes or [input_size]
         
+        pipeline_options = None
+        if args["pipelined"]:
+            pipeline_options = {
+                "workers": args["workers"],
+                "inference_workers": args["inference_workers"],
+                "executor": args["executor"],
+                "queue_size": args["queue_size"],
+                "backpressure": args["backpressure"],
+                "max_batch_size": args["max_batch_size"],
+                "max_batch_wait": args["max_batch_wait"] / 1000.0,
+            }
+
         client = BasicSynchronousClient()
-        client.game_loop(num_classes, input_size, graph, return_tensors, loadTown())
+        client.startup = STARTUP
+        client.pool = pool
+        client.frame_sync = FrameSync(args["keep_frames"])
+        client.associate = args["associate"]
+        if args["autolabel"] is not None:
+            client.autolabel = {"base_dir": os.path.join(args["autolabel"], ""), "sample_every": args["sample_every"],
+                                "dedup_threshold": args["dedup_threshold"], "min_gap": args["min_gap"]}
+        if args["async_io"]:
+            client.io_rates = (args["tick_rate"], args["control_rate"])
+        client.metrics, exporter = make_metrics(args["metrics"] or args["metrics_file"] is not None
+                                                or args["metrics_port"] is not None, args["metrics_file"],
+                                                args["metrics_format"], args["metrics_interval"],
+                                                args["metrics_port"])
+        if args["classes"] is not None:
+            client.postprocess = ClassFilteredPostprocessor(input_size, [int(c) for c in args["classes"].split(",")],
+                                                            num_classes)
+        if args["track"]:
+            from tracker import LightTracker
+
+            client.tracker = LightTracker(hysteresis=args["hysteresis"])
+        if args["full_every"] > 1 or args["roi"] is not None:
+            # game_loop sets the inference to the backend.
+            roi = None if args["roi"] is None else [float(v) for v in args["roi"].split(",")]
+            client.scheduler = InferenceScheduler(None, input_size, args["full_every"], roi, args["between"],
+                                                  postprocess=client.postprocess)
+        if adaptive:
+            from quality import QualityController, QualityLevel, quality_ladder
+
+            if client.scheduler is None:
+                # Full inference every tick until the controller spaces it out.
+                client.scheduler = InferenceScheduler(None, input_size, 1, None, args["between"],
+                                                      postprocess=client.postprocess)
+            levels = quality_ladder(quality_sizes, args["max_infer_every"],
+                                    1 if args["display"] == "none" else args["max_display_every"])
+            start = QualityLevel(input_size, client.scheduler.full_every, args["display_every"])
+            target_fps = args["target_fps"] or args["fps"] or None
+            client.quality = QualityController(levels, target_fps, args["latency_budget"],
+                                               start if start in levels else None, metrics=client.metrics,
+                                               log_file=args["quality_log"])
+        if args["tile_size"] > 0:
+            # game_loop sets the inference to the backend.
+            from tiling import TiledDetector
+
+            region = None if args["tile_region"] is None else [float(v) for v in args["tile_region"].split(",")]
+            class_ids = (detector.TRAFFIC_LIGHT_CLASS,)
+            if args["classes"] is not None:
+                class_ids = [int(c) for c in args["classes"].split(",")]
+            client.tiler = TiledDetector(None, input_size, args["tile_size"], args["tile_overlap"], region,
+                                         class_ids=class_ids)
+        if args["record"] is not None:
+            from frame_archive import FrameArchiveWriter
+
+            client.recorder = FrameArchiveWriter(args["record"], args["width"], args["height"],
+                                                 compression=args["record_compression"])
+        try:
+            client.game_loop(backend, input_size, loadTown(), pipeline_options, args["display"],
+                             args["display_every"], args["fast_world"])
+        finally:
+            if backend is not None:
+                backend.close()
+            if pool is not None:
+                pool.close()
+            if client.recorder is not None:
+                client.recorder.close()
+            if exporter is not None:
+                exporter.close()
 
     finally:
         print('EXIT')
@@ -367,10 +856,128 @@ if __name__ == '__main__':
                     help="Video height")
     ap.add_argument("-t", "--town", type=int, default=1,
                     help="Loaded Town")
+    ap.add_argument("--pipelined", action="store_true",
+                    help="Run preprocess, inference and postprocess concurrently with the simulator tick")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Workers of the preprocess and postprocess stages")
+    ap.add_argument("--inference-workers", type=int, default=1,
+                    help="Threads sharing the inference backend (opencv and tflite run one frame at a time)")
+    ap.add_argument("--executor", choices=EXECUTORS, default=THREAD,
+                    help="Pool type of the preprocess and postprocess stages")
+    ap.add_argument("--queue-size", type=int, default=2,
+                    help="Capacity of each queue between pipeline stages")
+    ap.add_argument("--backpressure", choices=BACKPRESSURE_POLICIES, default=DROP_OLDEST,
+                    help="What a full queue does: drop its oldest frame or block the producer")
+    ap.add_argument("--max-batch-size", type=int, default=1,
+                    help="Frames grouped into one backend run in pipelined mode (needs as many --inference-workers)")
+    ap.add_argument("--max-batch-wait", type=float, default=5.0,
+                    help="Milliseconds a frame may wait for its batch to fill")
+    ap.add_argument("--worker-processes", type=int, default=0,
+                    help="Detect and classify in this many processes, each with its own model (replaces "
+                         "--pipelined, --full-every/--roi and --tile-size; needs a spare core per process)")
+    ap.add_argument("--adaptive-quality", action="store_true",
+                    help="Adapt input size, inference interval and display cadence to hold --target-fps "
+                         "(serial loop only)")
+    ap.add_argument("--target-fps", type=float, default=None,
+                    help="Loop rate held by --adaptive-quality, --fps if not given")
+    ap.add_argument("--latency-budget", type=float, default=None,
+                    help="Milliseconds of work per loop held by --adaptive-quality, if tighter than the rate")
+    ap.add_argument("--quality-sizes", default="608,416,320",
+                    help="Comma separated network input sizes --adaptive-quality may use")
+    ap.add_argument("--max-infer-every", type=int, default=4,
+                    help="Longest full inference interval --adaptive-quality may use")
+    ap.add_argument("--max-display-every", type=int, default=4,
+                    help="Longest display interval --adaptive-quality may use")
+    ap.add_argument("--quality-log", default=None,
+                    help="File the quality adjustments are appended to as JSON lines")
+    ap.add_argument("--display", choices=DISPLAY_KINDS, default="both",
+                    help="Where frames are shown, 'none' runs headless")
+    ap.add_argument("--display-every", type=int, default=1,
+                    help="Show only every n-th processed frame")
+    ap.add_argument("--track", action="store_true",
+                    help="Track traffic lights across frames and smooth their state")
+    ap.add_argument("--hysteresis", type=int, default=3,
+                    help="Consecutive classifications needed to change a tracked light's state")
+    ap.add_argument("--full-every", type=int, default=1,
+                    help="Run full-frame detection every K ticks (serial mode)")
+    ap.add_argument("--between", choices=BETWEEN_MODES, default=ROI,
+                    help="Between full detections run on windows around known lights or reuse boxes")
+    ap.add_argument("--roi", default=None,
+                    help="x0,y0,x1,y1 frame fractions full detection is limited to, e.g. 0,0,1,0.6")
+    ap.add_argument("--tile-size", type=int, default=0,
+                    help="Also detect on overlapping tiles of this many pixels, e.g. 416 for native scale (serial mode)")
+    ap.add_argument("--tile-overlap", type=float, default=0.25,
+                    help="Fraction of a tile shared with its neighbours")
+    ap.add_argument("--tile-region", default=None,
+                    help="x0,y0,x1,y1 frame fractions to tile, e.g. 0,0,1,0.6")
+    ap.add_argument("--record", default=None,
+                    help="Record every processed frame with its traffic lights into this frame archive")
+    ap.add_argument("--record-compression", choices=["zlib"], default=None,
+                    help="Compress full chunks of the recording")
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default=TF1Backend.name,
+                    help="Inference backend")
+    ap.add_argument("--model", default=None,
+                    help="Model file of the backend, defaults to yolov3_coco.pb (.onnx for onnxruntime, "
+                         "_int8.tflite for tflite)")
+    ap.add_argument("--model-cache", default=DEFAULT_CACHE_DIR,
+                    help="Directory of cached optimized models (tf and onnxruntime backends)")
+    ap.add_argument("--no-model-cache", action="store_true",
+                    help="Always load the model from --model")
+    ap.add_argument("--no-warmup", action="store_true",
+                    help="Skip the warm-up inference on blank input before the loop")
+    ap.add_argument("--fast-world", action="store_true",
+                    help="Skip reload_world, and load_world when the server already runs the town")
+    ap.add_argument("--intra-op-threads", type=int, default=0,
+                    help="Threads inside one operator, 0 for the backend default")
+    ap.add_argument("--inter-op-threads", type=int, default=0,
+                    help="Operators run in parallel, 0 for the backend default")
+    ap.add_argument("--classes", default=None,
+                    help="Only decode these comma separated COCO class ids, e.g. 9 for traffic lights")
+    ap.add_argument("--fps", type=int, default=20,
+                    help="Frame rate limit of the pygame window, 0 for none")
+    ap.add_argument("--keep-frames", type=int, default=2,
+                    help="Camera images buffered while the loop catches up")
+    ap.add_argument("--associate", action="store_true",
+                    help="Match detections to the map's traffic lights and compare with their simulator state")
+    ap.add_argument("--autolabel", default=None,
+                    help="Label detections with the simulator's traffic light states into this dataset directory "
+                         "(not with --async-io)")
+    ap.add_argument("--sample-every", type=int, default=1,
+                    help="Auto-label only every n-th processed frame")
+    ap.add_argument("--dedup-threshold", type=float, default=4.0,
+                    help="Skip crops of a light whose state is unchanged and look this similar (mean grey level "
+                         "difference), 0 keeps all")
+    ap.add_argument("--min-gap", type=int, default=0,
+                    help="Frames between two saved crops of the same light")
+    ap.add_argument("--async-io", action="store_true",
+                    help="Tick the world and apply control on a separate thread, detection takes the newest frame")
+    ap.add_argument("--tick-rate", type=float, default=20.0,
+                    help="World ticks per second with --async-io")
+    ap.add_argument("--control-rate", type=float, default=20.0,
+                    help="Control updates per second with --async-io")
+    ap.add_argument("--metrics", action="store_true",
+                    help="Record per-stage latency histograms and print them on exit")
+    ap.add_argument("--metrics-file", default=None,
+                    help="Export metrics snapshots to this file (implies --metrics)")
+    ap.add_argument("--metrics-format", choices=FORMATS, default=JSON,
+                    help="JSON lines or Prometheus text")
+    ap.add_argument("--metrics-interval", type=float, default=5.0,
+                    help="Seconds between exported snapshots")
+    ap.add_argument("--metrics-port", type=int, default=None,
+                    help="Serve /metrics and /metrics.json on this local port (implies --metrics)")
     args = vars(ap.parse_args())
+    if args["autolabel"] is not None and args["async_io"]:
+        # The I/O thread ticks on, states read when a frame is taken can be a tick late.
+        ap.error("--autolabel reads the light states at each frame's tick, which --async-io does not allow")
+    if args["worker_processes"] > 0 and args["pipelined"]:
+        # The pool replaces the pipeline's stages and holds the only models.
+        ap.error("--worker-processes detects in its own processes and cannot be combined with --pipelined")
+    if args["adaptive_quality"] and (args["pipelined"] or args["worker_processes"] > 0 or args["tile_size"] > 0):
+        ap.error("--adaptive-quality only adapts the serial loop, not --pipelined, --worker-processes or --tile-size")
 
     VIEW_WIDTH = args["width"]
     VIEW_HEIGHT = args["height"]
+    MAX_FPS = args["fps"]
     
     main()
 